@@ -0,0 +1,205 @@
+"""End to end throughput of the article_index and article crawlers against the
+mock ptt.cc of `mock_ptt.py`, on a temporary SQLite database.
+
+    python benchmarks/crawl_benchmark.py [--pages 20] [--latency 0.02] [--burst-every 0]
+                                         [--profile tuned] [--folder FOLDER]
+
+The mock site runs in a process of its own, so it does not compete with the
+crawlers for the GIL. `article_index` crawls the newest `--pages` index pages,
+`article` then crawls them and their articles with `--index FIRST LAST --add`.
+Reported per stage: pages or articles per second, fetch, parse and database
+milliseconds per item, from the `crawler.metrics` histograms, responses which
+failed, and the peak RSS of the benchmark process so far. The database
+writer runs on its own thread, its time overlaps the fetches. Delays of the
+config are 0, `--latency` stands in for the site.
+"""
+import argparse
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crawler.article import PttArticleCrawler  # noqa: E402
+from crawler.article_index import PttArticleIndexCrawler  # noqa: E402
+from crawler.metrics import (ARTICLES, DB_WRITE_SECONDS, HTTP_REQUEST_SECONDS,  # noqa: E402
+                             INDEX_PAGES, PARSE_SECONDS)
+from models import Base, PttDatabase  # noqa: E402
+from mock_ptt import add_site_args  # noqa: E402
+from sqlite_profile import PROFILES, write_config  # noqa: E402
+
+MOCK_PTT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_ptt.py')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_ptt(arguments) -> Tuple[subprocess.Popen, str]:
+    port = free_port()
+    command = [sys.executable, MOCK_PTT, 'serve', '--port', str(port),
+               '--pages', str(arguments.pages),
+               '--pushes', str(arguments.pushes),
+               '--hot-every', str(arguments.hot_every),
+               '--hot-pushes', str(arguments.hot_pushes),
+               '--latency', str(arguments.latency),
+               '--jitter', str(arguments.jitter),
+               '--burst-every', str(arguments.burst_every),
+               '--burst-length', str(arguments.burst_length),
+               '--seed', str(arguments.seed)]
+    if arguments.fixtures:
+        command += ['--fixtures', arguments.fixtures]
+    for board in arguments.over18:
+        command += ['--over18', board]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError('Mock ptt.cc did not start')
+            time.sleep(0.05)
+    return process, 'http://127.0.0.1:{port}'.format(port=port)
+
+
+def peak_rss_mib() -> float:
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def milliseconds_per(histogram, count: int, before, **labels) -> float:
+    total, _ = histogram.totals(**labels)
+    return (total - before) * 1000 / count if count else 0
+
+
+def report(stage: str, count: int, unit: str, elapsed: float, fetch: float, parse: float, db: float, errors: int):
+    print('{stage:<14} {count:>6} {unit:<9} {seconds:>8.2f} {rate:>9.2f} {fetch:>9.2f} {parse:>9.2f} '
+          '{db:>9.2f} {errors:>7} {rss:>9.1f}'.format(stage=stage, count=count, unit=unit, seconds=elapsed,
+                                                      rate=count / elapsed if elapsed else 0,
+                                                      fetch=fetch, parse=parse, db=db, errors=errors,
+                                                      rss=peak_rss_mib()))
+
+
+def run_article_index(config_path: str, board: str, first_page: int):
+    pages_before = INDEX_PAGES.value(crawler='article_index')
+    fetch_before, _ = HTTP_REQUEST_SECONDS.totals(kind='index')
+    db_before, _ = DB_WRITE_SECONDS.totals(writer='article_index')
+
+    start_time = time.perf_counter()
+    crawler = PttArticleIndexCrawler({'config_path': config_path,
+                                      'board_name': board,
+                                      'index': first_page,
+                                      'before': False})
+    crawler.crawling()
+    elapsed = time.perf_counter() - start_time
+    crawler.db_session.close()
+
+    pages = int(INDEX_PAGES.value(crawler='article_index') - pages_before)
+    report('article_index', pages, 'pages', elapsed,
+           milliseconds_per(HTTP_REQUEST_SECONDS, pages, fetch_before, kind='index'),
+           0,
+           milliseconds_per(DB_WRITE_SECONDS, pages, db_before, writer='article_index'),
+           0)
+
+
+def run_article(config_path: str, folder: str, board: str, first_page: int, last_page: int):
+    parsed_before = ARTICLES.value(result='parsed')
+    errors_before = ARTICLES.value(result='invalid') + ARTICLES.value(result='error')
+    fetch_before, _ = HTTP_REQUEST_SECONDS.totals(kind='article')
+    parse_before, _ = PARSE_SECONDS.totals()
+    db_before, _ = DB_WRITE_SECONDS.totals(writer='article')
+
+    start_time = time.perf_counter()
+    crawler = PttArticleCrawler({'config_path': config_path,
+                                 'board_name': board,
+                                 'start_date': None,
+                                 'since_date': None,
+                                 'database': False,
+                                 'tail': False,
+                                 'worker': False,
+                                 'enqueue': False,
+                                 'index': [first_page, last_page],
+                                 'upgrade': False,
+                                 'hot': False,
+                                 'json_folder': folder,
+                                 'json_prefix': '',
+                                 'verbose': False})
+    crawler.crawling()
+    elapsed = time.perf_counter() - start_time
+    crawler.db_session.close()
+
+    articles = int(ARTICLES.value(result='parsed') - parsed_before)
+    errors = int(ARTICLES.value(result='invalid') + ARTICLES.value(result='error') - errors_before)
+    report('article', articles, 'articles', elapsed,
+           milliseconds_per(HTTP_REQUEST_SECONDS, articles + errors, fetch_before, kind='article'),
+           milliseconds_per(PARSE_SECONDS, articles, parse_before),
+           milliseconds_per(DB_WRITE_SECONDS, articles, db_before, writer='article'),
+           errors)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    add_site_args(parser)
+    parser.set_defaults(pages=20, latency=0.02)
+    parser.add_argument('--board', type=str.lower, default='benchmark',
+                        help='board to crawl, the board of the recorded --fixtures')
+    parser.add_argument('--stage', choices=['article_index', 'article'], action='append',
+                        help='stages to run, default both')
+    parser.add_argument('--profile', choices=list(PROFILES), default='tuned',
+                        help='[Database] profile of sqlite_profile.py')
+    parser.add_argument('--folder', type=str,
+                        help='folder of the benchmark database, default the system temp folder')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the crawler logs, errors of the 503 responses included')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_args()
+    logging.getLogger().setLevel(logging.WARNING if arguments.verbose else logging.CRITICAL)
+
+    process, url = start_mock_ptt(arguments)
+    PttArticleCrawler.PTT_URL = url
+    PttArticleIndexCrawler.PTT_URL = url
+    try:
+        with tempfile.TemporaryDirectory(dir=arguments.folder) as folder:
+            config_path = write_config(folder, PROFILES[arguments.profile])
+            db = PttDatabase(dbtype='sqlite', dbname=os.path.join(folder, 'ptt.db'))
+            Base.metadata.create_all(db.engine)
+            db.engine.dispose()
+
+            print('{:<14} {:>6} {:<9} {:>8} {:>9} {:>9} {:>9} {:>9} {:>7} {:>9}'.format(
+                'stage', 'count', '', 'seconds', 'per sec', 'fetch ms', 'parse ms', 'db ms', 'errors',
+                'peak MiB'))
+            last_page = PttArticleCrawler._parse_last_page(
+                requests.get(url + '/bbs/{board}/index.html'.format(board=arguments.board),
+                             cookies={'over18': '1'}).text)
+            first_page = max(last_page - arguments.pages + 1, 1)
+            stages = OrderedDict([('article_index', lambda: run_article_index(config_path, arguments.board,
+                                                                              first_page)),
+                                  ('article', lambda: run_article(config_path, folder, arguments.board,
+                                                                  first_page, last_page))])
+            for name, stage in stages.items():
+                if not arguments.stage or name in arguments.stage:
+                    stage()
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""Run time of `PttExportHelper.go` in every format and of `QueryHelper.go` on
+a synthetic database of `generate_db.py`.
+
+    python benchmarks/export_benchmark.py [--config-path CONFIG] [--format json] [--repeat 1]
+                                          [--users 20000] [--articles 10000] [--folder FOLDER]
+
+Without `--config-path` a database is generated in a temporary folder first,
+with the generator arguments of `generate_db.py`. Generate a large one once
+and point `--config-path` at it to compare runs. Reported per run: the best
+seconds of `--repeat` runs, the size of the files written, and the peak RSS
+of the benchmark process so far, then the `@log` stage times of all runs.
+A run which writes no file failed, `go` logs its error instead of raising.
+"""
+import argparse
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import date
+from typing import Callable
+
+from sqlalchemy import func
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from export import PttExportHelper  # noqa: E402
+from generate_db import add_generator_args, generate  # noqa: E402
+from models import Article, Board, PttDatabase  # noqa: E402
+from query import QueryHelper  # noqa: E402
+from sqlite_profile import PROFILES, write_config  # noqa: E402
+from utils import PROFILER, load_config  # noqa: E402
+
+FORMATS = ['json', 'csv', 'ods']
+
+
+def peak_rss_mib() -> float:
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def folder_size_mib(folder: str) -> float:
+    return sum(entry.stat().st_size for entry in os.scandir(folder)) / 1024 / 1024
+
+
+def busiest_board(config_path: str) -> str:
+    db = PttDatabase.from_config(load_config(config_path)['Database'])
+    session = db.get_session()
+    try:
+        name, = session.query(Board.name) \
+            .join(Article, Article.board_id == Board.id) \
+            .group_by(Board.name) \
+            .order_by(func.count(Article.id).desc()) \
+            .first()
+        return name
+    finally:
+        session.close()
+        db.engine.dispose()
+
+
+def run(name: str, repeat: int, folder: str, go: Callable[[str], None]):
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(dir=folder) as output_folder:
+            start_time = time.perf_counter()
+            go(output_folder)
+            timings.append(time.perf_counter() - start_time)
+            size = folder_size_mib(output_folder)
+    print('{name:<14} {seconds:>9.2f} {size:>9} {rss:>9.1f}'.format(
+        name=name, seconds=min(timings), size='failed' if not size else '{:.1f}'.format(size),
+        rss=peak_rss_mib()))
+
+
+def close(helper):
+    # The export autoflushes the push times it parses, an open session would
+    # keep the SQLite write lock from the next run
+    if hasattr(helper, 'db_session'):
+        helper.db_session.close()
+        helper.db.engine.dispose()
+
+
+def export_go(config_path: str, file_format: str) -> Callable[[str], None]:
+    def go(output_folder: str):
+        helper = PttExportHelper()
+        helper.go({'config_path': config_path,
+                   'format': file_format,
+                   'output_folder': output_folder,
+                   'output_prefix': ''})
+        close(helper)
+    return go
+
+
+def query_go(config_path: str, board: str) -> Callable[[str], None]:
+    def go(output_folder: str):
+        helper = QueryHelper({'config_path': config_path,
+                              'board_name': board,
+                              'date_range': (date(2019, 1, 1), date.today()),
+                              'format': 'csv',
+                              'output_folder': output_folder,
+                              'output_prefix': ''})
+        helper.go()
+        close(helper)
+    return go
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config-path', type=str,
+                        help='config ini file of a generated database, default a new one')
+    parser.add_argument('--format', choices=FORMATS, action='append',
+                        help='export formats to run, default all')
+    parser.add_argument('--no-query', action='store_true', help='skip QueryHelper')
+    parser.add_argument('--board', type=str, help='board of the query, default the busiest one')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each, the best is reported')
+    parser.add_argument('--profile', choices=list(PROFILES), default='tuned',
+                        help='[Database] profile of sqlite_profile.py of a new database')
+    parser.add_argument('--folder', type=str,
+                        help='folder of the new database and the exports, default the system temp folder')
+    parser.add_argument('--verbose', action='store_true', help='show the export and query logs')
+    add_generator_args(parser)
+    return parser.parse_args()
+
+
+def benchmark(config_path: str, arguments):
+    board = arguments.board or busiest_board(config_path)
+    print('{:<14} {:>9} {:>9} {:>9}'.format('run', 'seconds', 'MiB', 'peak MiB'))
+    for file_format in arguments.format or FORMATS:
+        run('export ' + file_format, arguments.repeat, arguments.folder, export_go(config_path, file_format))
+    if not arguments.no_query:
+        run('query', arguments.repeat, arguments.folder, query_go(config_path, board))
+    print()
+    print('\n'.join(PROFILER.summary()))
+
+
+def main():
+    arguments = parse_args()
+    logging.getLogger().setLevel(logging.INFO if arguments.verbose else logging.CRITICAL)
+
+    if arguments.config_path:
+        benchmark(arguments.config_path, arguments)
+        return
+    with tempfile.TemporaryDirectory(dir=arguments.folder) as folder:
+        config_path = write_config(folder, PROFILES[arguments.profile])
+        start_time = time.perf_counter()
+        counts = generate(config_path, arguments)
+        print('generated {articles} articles, {pushes} pushes, {users} users in {seconds:.2f}s'.format(
+            articles=counts['article'], pushes=counts['push'], users=counts['user'],
+            seconds=time.perf_counter() - start_time))
+        benchmark(config_path, arguments)
+
+
+if __name__ == '__main__':
+    main()
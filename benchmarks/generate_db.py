@@ -0,0 +1,364 @@
+"""Synthetic database at production scale for the export and query benchmarks,
+written through the `models` package.
+
+    python benchmarks/generate_db.py (--folder FOLDER | --config-path CONFIG) [--users 20000]
+                                     [--articles 10000] [--pushes 40] [--ips 20000] [--seed 0]
+
+With `--folder` a SQLite database and its config.ini are created there, with
+`--config-path` the empty database of its `[Database]` is filled, PostgreSQL
+included. Production boards are in the order of `--users 300000 --articles
+100000`, a few million pushes.
+
+The shapes the export and query paths are sensitive to:
+- authors and pushers are drawn from a Zipf distribution over the users, a
+  few accounts write most of the pushes
+- push counts are Pareto distributed around `--pushes`, with bursts of pushes
+  seconds apart between quiet hours
+- articles have 1 to `VersionRotate` history versions, more for the busier
+  ones, every version shows the pushes seen by then
+- addresses come from a shared pool, Zipf distributed too, `--asn-coverage`
+  of them have `ip_asn` rows and users have a last login record from them
+"""
+import argparse
+import ipaddress
+import itertools
+import logging
+import os
+import random
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import (Article, ArticleHistory, ArticleHistoryPush, ArticleIndex, Base,  # noqa: E402
+                    Board, IpAsn, PttDatabase, Push, User, UserLastRecord)
+from sqlite_profile import PROFILES, write_config  # noqa: E402
+from utils import load_config  # noqa: E402
+
+# (asn, registry, country code, description), weighted towards Taiwanese networks
+NETWORKS = [(('3462', 'apnic', 'TW', 'HINET Data Communication Business Group, TW'), 40),
+            (('17421', 'apnic', 'TW', 'EMOME-NET Chunghwa Telecom Co., Ltd., TW'), 15),
+            (('24158', 'apnic', 'TW', 'TAIWANMOBILE-AS Taiwan Mobile Co., Ltd., TW'), 10),
+            (('4780', 'apnic', 'TW', 'SEEDNET Digital United Inc., TW'), 8),
+            (('9924', 'apnic', 'TW', 'TFN-TW Taiwan Fixed Network, TW'), 7),
+            (('2914', 'apnic', 'JP', 'NTT-COMMUNICATIONS-2914, US'), 5),
+            (('16509', 'arin', 'US', 'AMAZON-02, US'), 5),
+            (('15169', 'arin', 'US', 'GOOGLE, US'), 4),
+            (('4134', 'apnic', 'CN', 'CHINANET-BACKBONE No.31,Jin-rong Street, CN'), 4),
+            (('3320', 'ripe', 'DE', 'DTAG Internet service provider operations, DE'), 2)]
+PUSH_TAGS = ('推', '→', '噓')
+PUSH_TAG_WEIGHTS = (60, 30, 10)
+WORDS = ('我覺得 這個 真的 不行 推 好文 樓上 說得對 笑死 可憐 哈哈 其實 應該 沒有 已經 '
+         '還是 所以 大家 今天 一樣 問題 政府 台灣 八卦 有沒有 怎麼 可以 就是 what lol').split()
+ARTICLES_PER_PAGE = 20
+
+
+class ZipfSampler(object):
+    """Indexes 0..n-1 drawn with weights 1 / (index + 1) ** exponent"""
+
+    def __init__(self, rng: random.Random, n: int, exponent: float):
+        self.rng = rng
+        self.population = range(n)
+        self.cum_weights = list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, n + 1)))
+
+    def sample(self, k: int = 1) -> List[int]:
+        return self.rng.choices(self.population, cum_weights=self.cum_weights, k=k)
+
+
+class SyntheticPtt(object):
+    """Rows of the synthetic database, inserted with explicit primary keys"""
+
+    def __init__(self, db: PttDatabase, arguments, version_rotate: int):
+        self.db = db
+        self.session = db.get_session()
+        self.arguments = arguments
+        self.version_rotate = max(version_rotate, 1)
+        self.rng = random.Random(arguments.seed)
+        self.start = datetime(2019, 1, 1)
+        self.span = timedelta(days=arguments.days)
+        self.counts = OrderedDict((model.__tablename__, 0) for model in
+                                  (Board, User, IpAsn, UserLastRecord, ArticleIndex, Article,
+                                   ArticleHistory, Push, ArticleHistoryPush))
+        self.next_ids = {Article: 1, ArticleHistory: 1, Push: 1}
+        self.text = ' '.join(self.rng.choice(WORDS) for _ in range(4000))
+
+    def _insert(self, model, rows: List[Dict]):
+        if rows:
+            self.db.bulk_copy(self.session, model, rows, auto_commit=False)
+            self.counts[model.__tablename__] += len(rows)
+
+    def _ids(self, model, count: int) -> range:
+        first = self.next_ids[model]
+        self.next_ids[model] = first + count
+        return range(first, first + count)
+
+    def _check_empty(self):
+        for model in (Board, User, Article, IpAsn):
+            if self.session.query(model).first() is not None:
+                raise SystemExit('The database is not empty, table {table} has rows'.format(
+                    table=model.__tablename__))
+
+    def _random_text(self, mean_length: int, limit: int = None) -> str:
+        length = max(int(self.rng.lognormvariate(0, 0.8) * mean_length), 1)
+        length = min(length, limit or len(self.text), len(self.text))
+        offset = self.rng.randrange(len(self.text) - length + 1)
+        return self.text[offset:offset + length]
+
+    def generate_ips(self):
+        """Shared address pool, its `ip_asn` rows first"""
+        arguments = self.arguments
+        ips = set()
+        while len(ips) < arguments.ips:
+            ips.add(str(ipaddress.IPv4Address(self.rng.randrange(0x01000000, 0xDF000000))))
+        ips = sorted(ips)
+        self.rng.shuffle(ips)
+        networks, weights = zip(*NETWORKS)
+
+        covered = int(len(ips) * arguments.asn_coverage)
+        rows = []
+        for ip in ips[:covered]:
+            asn, registry, country_code, description = self.rng.choices(networks, weights)[0]
+            rows.append({'ip': ip,
+                         'asn': asn,
+                         'asn_date': self.start - timedelta(days=self.rng.randrange(3650)),
+                         'asn_registry': registry,
+                         'asn_cidr': str(ipaddress.ip_network(ip + '/16', strict=False)),
+                         'asn_country_code': country_code,
+                         'asn_description': description,
+                         'asn_raw': None,
+                         'lookup_datetime': self.start,
+                         'asn_inferred': False,
+                         'lookup_failures': 0})
+        for i in range(0, len(rows), arguments.batch_size):
+            self._insert(IpAsn, rows[i:i + arguments.batch_size])
+        self.session.commit()
+
+        self.ips = ips
+        self.covered_ips = ips[:covered] or ips
+        self.ip_sampler = ZipfSampler(self.rng, len(ips), arguments.ip_exponent)
+
+    def generate_users(self):
+        arguments = self.arguments
+        for first in range(1, arguments.users + 1, arguments.batch_size):
+            users = []
+            records = []
+            for user_id in range(first, min(first + arguments.batch_size, arguments.users + 1)):
+                users.append({'id': user_id,
+                              'username': 'u{id:07d}'.format(id=user_id),
+                              'login_times': int(self.rng.paretovariate(1.1) * 10),
+                              'valid_article_count': int(self.rng.paretovariate(1.3))})
+                if self.rng.random() < arguments.last_records:
+                    # exporting a user whose last ip has no ip_asn row fails
+                    last_login = self.start + self.span * self.rng.random()
+                    records.append({'id': user_id,
+                                    'user_id': user_id,
+                                    'last_login_datetime': last_login.replace(microsecond=0),
+                                    'last_login_ip': self.rng.choice(self.covered_ips),
+                                    'created_at': self.start + self.span})
+            self._insert(User, users)
+            self._insert(UserLastRecord, records)
+            self.session.commit()
+        self.user_sampler = ZipfSampler(self.rng, arguments.users, arguments.user_exponent)
+
+    def generate_boards(self) -> List[int]:
+        arguments = self.arguments
+        self._insert(Board, [{'id': board_id, 'name': 'synthetic{n}'.format(n=board_id - 1)}
+                             for board_id in range(1, arguments.boards + 1)])
+        self.session.commit()
+        # the first board is the busiest
+        return [board_id + 1 for board_id in ZipfSampler(self.rng, arguments.boards, 1).sample(arguments.articles)]
+
+    def _push_count(self) -> int:
+        alpha = self.arguments.push_alpha
+        scale = self.arguments.pushes * (alpha - 1) / alpha
+        return min(int(self.rng.paretovariate(alpha) * scale), self.arguments.max_pushes)
+
+    def _push_times(self, post_datetime: datetime, count: int) -> List[datetime]:
+        times = []
+        offset = 0
+        for _ in range(count):
+            # a new burst after a quiet spell, else seconds after the previous push
+            if self.rng.random() < 0.05:
+                offset += self.rng.expovariate(1 / 3600)
+            else:
+                offset += self.rng.expovariate(1 / 20)
+            times.append(post_datetime + timedelta(seconds=int(offset)))
+        return times
+
+    def _versions(self, push_count: int) -> int:
+        extra = self.arguments.updates * push_count / max(self.arguments.pushes, 1)
+        return min(1 + int(self.rng.expovariate(1 / extra)) if extra else 1, self.version_rotate)
+
+    def generate_articles(self):
+        arguments = self.arguments
+        board_ids = self.generate_boards()
+        board_articles = {}
+        slot = self.span / arguments.articles
+
+        for first in range(0, arguments.articles, arguments.batch_size):
+            batch = range(first, min(first + arguments.batch_size, arguments.articles))
+            authors = self.user_sampler.sample(len(batch))
+            indexes, articles, histories, pushes, history_pushes = [], [], [], [], []
+
+            for i, article_id, author in zip(batch, self._ids(Article, len(batch)), authors):
+                board_id = board_ids[i]
+                page = board_articles.get(board_id, 0) // ARTICLES_PER_PAGE + 1
+                board_articles[board_id] = board_articles.get(board_id, 0) + 1
+                # ptt times have whole seconds, the export parses them back
+                post_datetime = (self.start + slot * (i + self.rng.random() * 0.9)).replace(microsecond=0)
+                web_id = 'M.{timestamp}.A.{i:03X}'.format(timestamp=int(post_datetime.timestamp()),
+                                                          i=i % 4096)
+                indexes.append({'web_id': web_id, 'board_id': board_id, 'index': page})
+                articles.append({'id': article_id,
+                                 'web_id': web_id,
+                                 'user_id': author + 1,
+                                 'board_id': board_id,
+                                 'post_datetime': post_datetime,
+                                 'post_ip': self.ips[self.ip_sampler.sample()[0]]})
+
+                count = self._push_count()
+                push_ids = self._ids(Push, count)
+                push_times = self._push_times(post_datetime, count)
+                pushers = self.user_sampler.sample(count)
+                push_ips = self.ip_sampler.sample(count)
+                tags = self.rng.choices(PUSH_TAGS, PUSH_TAG_WEIGHTS, k=count)
+                for floor, (push_id, push_datetime, pusher, ip, tag) in enumerate(
+                        zip(push_ids, push_times, pushers, push_ips, tags)):
+                    content = self._random_text(20, limit=80)
+                    ip = self.ips[ip] if self.rng.random() < arguments.push_ip_ratio else None
+                    pushes.append({'id': push_id,
+                                   'article_id': article_id,
+                                   'floor': floor,
+                                   'content_hash': Push.content_hash_of(tag, pusher + 1, content, ip,
+                                                                        push_datetime),
+                                   'push_tag': tag,
+                                   'push_user_id': pusher + 1,
+                                   'push_content': content,
+                                   'push_ip': ip,
+                                   'push_datetime': push_datetime})
+
+                # every version shows the pushes of the versions before it
+                versions = self._versions(count)
+                last_push = push_times[-1] if push_times else post_datetime
+                version_span = (last_push - post_datetime) / versions + timedelta(minutes=10)
+                title = self._random_text(12, limit=60)
+                content = self._random_text(arguments.content_length)
+                for version, history_id in enumerate(self._ids(ArticleHistory, versions)):
+                    start_at = post_datetime + version_span * version
+                    histories.append({'id': history_id,
+                                      'article_id': article_id,
+                                      'title': title,
+                                      'content': content,
+                                      'start_at': start_at,
+                                      'end_at': start_at + version_span})
+                    shown = push_ids[:count * (version + 1) // versions]
+                    history_pushes.extend({'article_history_id': history_id, 'push_id': push_id}
+                                          for push_id in shown)
+
+            for model, rows in ((ArticleIndex, indexes), (Article, articles), (ArticleHistory, histories),
+                                (Push, pushes), (ArticleHistoryPush, history_pushes)):
+                self._insert(model, rows)
+            self.session.commit()
+            logging.info('Generated %d of %d articles, %d pushes', batch.stop, arguments.articles,
+                         self.counts[Push.__tablename__])
+
+    def _sync_sequences(self):
+        """Move the PostgreSQL sequences past the explicit primary keys"""
+        if self.db.dbtype != 'postgresql':
+            return
+        for model, next_id in ((Board, self.arguments.boards + 1),
+                               (User, self.arguments.users + 1),
+                               (UserLastRecord, self.arguments.users + 1),
+                               (Article, self.next_ids[Article]),
+                               (ArticleHistory, self.next_ids[ArticleHistory]),
+                               (Push, self.next_ids[Push])):
+            self.session.execute('SELECT setval(:sequence, :value, false)',
+                                 {'sequence': model.__table__.c.id.default.name, 'value': next_id})
+        self.session.commit()
+
+    def generate(self) -> Dict[str, int]:
+        """Fill the database, row count per table"""
+        self._check_empty()
+        self.generate_ips()
+        self.generate_users()
+        self.generate_articles()
+        self._sync_sequences()
+        self.session.close()
+        return self.counts
+
+
+def add_generator_args(parser: argparse.ArgumentParser):
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--articles', type=int, default=10000)
+    parser.add_argument('--boards', type=int, default=4, help='boards, Zipf distributed articles')
+    parser.add_argument('--pushes', type=int, default=40, help='mean pushes of an article')
+    parser.add_argument('--max-pushes', type=int, default=5000, help='pushes of the largest threads')
+    parser.add_argument('--push-alpha', type=float, default=1.3,
+                        help='Pareto shape of the push counts, lower is a heavier tail')
+    parser.add_argument('--updates', type=float, default=1,
+                        help='mean extra history versions of an article with --pushes pushes')
+    parser.add_argument('--versions', type=int, default=0,
+                        help='most history versions of an article, default VersionRotate of the config')
+    parser.add_argument('--ips', type=int, default=20000, help='addresses of the shared ip pool')
+    parser.add_argument('--asn-coverage', type=float, default=0.9, help='part of the pool with ip_asn rows')
+    parser.add_argument('--push-ip-ratio', type=float, default=0.3, help='part of the pushes with an ip')
+    parser.add_argument('--last-records', type=float, default=0.8, help='part of the users with a last login')
+    parser.add_argument('--user-exponent', type=float, default=1.1, help='Zipf exponent of authors and pushers')
+    parser.add_argument('--ip-exponent', type=float, default=0.8, help='Zipf exponent of the ip pool')
+    parser.add_argument('--days', type=int, default=365, help='days of posts')
+    parser.add_argument('--content-length', type=int, default=600, help='mean characters of an article')
+    parser.add_argument('--batch-size', type=int, default=1000, help='articles or users per transaction')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def generate(config_path: str, arguments) -> Dict[str, int]:
+    """Fill the empty database of `config_path`, row count per table"""
+    config = load_config(config_path)
+    db = PttDatabase.from_config(config['Database'])
+    Base.metadata.create_all(db.engine, checkfirst=True)
+    version_rotate = arguments.versions or config.getint('PttArticle', 'VersionRotate', fallback=30)
+    try:
+        return SyntheticPtt(db, arguments, version_rotate).generate()
+    finally:
+        db.engine.dispose()
+
+
+def report(counts: Dict[str, int], elapsed: float):
+    for table, count in counts.items():
+        print('{table:<24} {count:>10}'.format(table=table, count=count))
+    print('{:<24} {:>10.2f}'.format('seconds', elapsed))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument('--folder', type=str,
+                              help='folder of a new SQLite database and its config.ini')
+    target_group.add_argument('--config-path', type=str,
+                              help='config ini file of an empty database')
+    parser.add_argument('--profile', choices=list(PROFILES), default='tuned',
+                        help='[Database] profile of sqlite_profile.py with --folder')
+    parser.add_argument('--verbose', action='store_true', help='log the progress')
+    add_generator_args(parser)
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_args()
+    logging.getLogger().setLevel(logging.INFO if arguments.verbose else logging.WARNING)
+
+    config_path = arguments.config_path
+    if arguments.folder:
+        os.makedirs(arguments.folder, exist_ok=True)
+        config_path = write_config(arguments.folder, PROFILES[arguments.profile])
+        print('config {config_path}'.format(config_path=config_path))
+    start_time = time.perf_counter()
+    counts = generate(config_path, arguments)
+    report(counts, time.perf_counter() - start_time)
+
+
+if __name__ == '__main__':
+    main()
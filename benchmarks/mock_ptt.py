@@ -0,0 +1,385 @@
+"""Local stand-in of www.ptt.cc for the offline benchmarks.
+
+    python benchmarks/mock_ptt.py serve [--port 8000] [--pages 50] [--latency 0.05]
+    python benchmarks/mock_ptt.py record --board BOARD [--pages 2] [--folder benchmarks/fixtures]
+
+`serve` answers the index and article pages of every board. Pages recorded in
+`--fixtures` (`BOARD/index.html`, `BOARD/indexN.html`, `BOARD/WEB_ID.html`)
+are served as they are, the others are generated with the markup of ptt.cc:
+`--pages` index pages of 20 articles, one article in `--hot-every` with a
+thread of `--hot-pushes` pushes. Boards of `--over18` redirect requests
+without the `over18` cookie to `/ask/over18`, which sets it. `--burst-every`
+requests to articles, the next `--burst-length` are answered 503. Every
+response waits `--latency` seconds, plus up to `--jitter`.
+
+`record` saves the newest `--pages` index pages of a board and their articles
+from ptt.cc as fixtures.
+"""
+import argparse
+import hashlib
+import html
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+from urllib.parse import quote, unquote, urlsplit
+
+import requests
+
+PTT_TIMEZONE = timezone(timedelta(hours=8))
+ARTICLES_PER_PAGE = 20
+# web ids of page 1 start here, one article every 10 minutes
+FIRST_POST = datetime(2019, 1, 1, tzinfo=PTT_TIMEZONE)
+
+INDEX_PATH = re.compile(r'^/bbs/(\w+)/index(\d*)\.html$')
+ARTICLE_PATH = re.compile(r'^/bbs/(\w+)/([MG]\.\d+\.A(?:\.[0-9A-F]{3})?)\.html$')
+
+INDEX_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>看板 {board} 文章列表 - 批踢踢實業坊</title></head>
+<body>
+<div id="action-bar-container"><div class="action-bar"><div class="btn-group btn-group-paging">
+<a class="btn wide" href="/bbs/{board}/index1.html">最舊</a>
+{previous}
+<a class="btn wide" href="/bbs/{board}/index.html">最新</a>
+</div></div></div>
+<div id="main-container">
+<div class="r-list-container action-bar-margin bbs-screen">
+{entries}
+</div>
+</div>
+</body></html>
+"""
+
+ENTRY_TEMPLATE = """<div class="r-ent">
+<div class="nrec"><span class="hl f3">{pushes}</span></div>
+<div class="title"><a href="/bbs/{board}/{web_id}.html">{title}</a></div>
+<div class="meta"><div class="author">{author}</div><div class="date">{date}</div></div>
+</div>"""
+
+ARTICLE_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title} - 看板 {board} - 批踢踢實業坊</title></head>
+<body>
+<div id="main-container">
+<div id="main-content" class="bbs-screen bbs-content">
+<div class="article-metaline"><span class="article-meta-tag">作者</span><span class="article-meta-value">{author}</span></div>
+<div class="article-metaline-right"><span class="article-meta-tag">看板</span><span class="article-meta-value">{board}</span></div>
+<div class="article-metaline"><span class="article-meta-tag">標題</span><span class="article-meta-value">{title}</span></div>
+<div class="article-metaline"><span class="article-meta-tag">時間</span><span class="article-meta-value">{date}</span></div>
+{content}
+--
+<span class="f2">※ 發信站: 批踢踢實業坊(ptt.cc), 來自: {ip}
+</span><span class="f2">※ 文章網址: <a href="https://www.ptt.cc/bbs/{board}/{web_id}.html">https://www.ptt.cc/bbs/{board}/{web_id}.html</a>
+</span>{pushes}
+</div>
+</div>
+</body></html>
+"""
+
+PUSH_TEMPLATE = """<div class="push"><span class="hl push-tag">{tag} </span><span class="f3 hl push-userid">{userid}</span><span class="f3 push-content">: {content}</span><span class="push-ipdatetime"> {ip} {datetime}
+</span></div>"""
+
+OVER18_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>批踢踢實業坊</title></head>
+<body><div class="over18-notice">本網站已依網站內容分級規定處理</div>
+<form action="/ask/over18" method="post"><input type="hidden" name="from" value="{path}">
+<button class="btn-big" type="submit" name="yes" value="yes">我同意，我已年滿十八歲</button></form>
+</body></html>
+"""
+
+
+class MockPtt(object):
+    """Pages of the mock site, deterministic for a `seed`"""
+
+    def __init__(self, pages: int = 50, hot_every: int = 10, hot_pushes: int = 1000, pushes: int = 30,
+                 fixtures: str = '', over18_boards: Tuple[str, ...] = (), seed: int = 0):
+        self.pages = pages
+        self.hot_every = hot_every
+        self.hot_pushes = hot_pushes
+        self.pushes = pushes
+        self.fixtures = fixtures
+        self.over18_boards = {board.lower() for board in over18_boards}
+        self.seed = seed
+
+    def _fixture(self, board: str, name: str) -> Optional[bytes]:
+        if not self.fixtures:
+            return None
+        path = os.path.join(self.fixtures, board, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as fixture_file:
+            return fixture_file.read()
+
+    def web_id(self, page: int, i: int) -> str:
+        number = (page - 1) * ARTICLES_PER_PAGE + i
+        post_datetime = FIRST_POST + timedelta(minutes=10 * number)
+        return 'M.{timestamp}.A.{suffix:03X}'.format(timestamp=int(post_datetime.timestamp()),
+                                                    suffix=number % 4096)
+
+    def _random(self, web_id: str) -> random.Random:
+        digest = hashlib.md5('{seed}:{web_id}'.format(seed=self.seed, web_id=web_id).encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], 'little'))
+
+    def _push_count(self, web_id: str) -> int:
+        rng = self._random(web_id)
+        if self.hot_every and rng.randrange(self.hot_every) == 0:
+            return self.hot_pushes
+        return rng.randrange(self.pushes * 2 + 1)
+
+    def index_page(self, board: str, index: Optional[int]) -> Optional[bytes]:
+        fixture = self._fixture(board, 'index{index}.html'.format(index=index or ''))
+        if fixture is not None:
+            return fixture
+        index = index or self.pages
+        if not 1 <= index <= self.pages:
+            return None
+        entries = []
+        for i in range(ARTICLES_PER_PAGE):
+            web_id = self.web_id(index, i)
+            post_datetime = datetime.fromtimestamp(int(web_id.split('.')[1]), PTT_TIMEZONE)
+            entries.append(ENTRY_TEMPLATE.format(board=board,
+                                                 web_id=web_id,
+                                                 pushes=min(self._push_count(web_id), 99),
+                                                 title=html.escape('[閒聊] 測試文章 {web_id}'.format(web_id=web_id)),
+                                                 author='author{n}'.format(n=self._random(web_id).randrange(500)),
+                                                 date=post_datetime.strftime('%m/%d').lstrip('0')))
+        if index == self.pages:
+            # pinned articles come after the separator on the newest page
+            entries.append('<div class="r-list-sep"></div>')
+            entries.append(ENTRY_TEMPLATE.format(board=board, web_id=self.web_id(1, 0), pushes='',
+                                                 title='[公告] 板規', author='moderator', date='1/01'))
+        if index > 1:
+            previous = '<a class="btn wide" href="/bbs/{board}/index{index}.html">&lsaquo; 上頁</a>'.format(
+                board=board, index=index - 1)
+        else:
+            previous = '<a class="btn wide disabled">&lsaquo; 上頁</a>'
+        return INDEX_TEMPLATE.format(board=board,
+                                     previous=previous,
+                                     entries='\n'.join(entries)).encode('utf-8')
+
+    def article_page(self, board: str, web_id: str) -> Optional[bytes]:
+        fixture = self._fixture(board, '{web_id}.html'.format(web_id=web_id))
+        if fixture is not None:
+            return fixture
+        rng = self._random(web_id)
+        post_datetime = datetime.fromtimestamp(int(web_id.split('.')[1]), PTT_TIMEZONE)
+        pushes = []
+        for floor in range(self._push_count(web_id)):
+            push_datetime = post_datetime + timedelta(minutes=floor)
+            pushes.append(PUSH_TEMPLATE.format(tag=('推', '噓', '→')[rng.randrange(3)],
+                                               userid='user{n}'.format(n=rng.randrange(5000)),
+                                               content=html.escape('第 {floor} 樓的推文 {n}'.format(
+                                                   floor=floor + 1, n=rng.randrange(10 ** 6))),
+                                               ip='{a}.{b}.{c}.{d}'.format(a=rng.randrange(1, 224),
+                                                                           b=rng.randrange(256),
+                                                                           c=rng.randrange(256),
+                                                                           d=rng.randrange(256)),
+                                               datetime=push_datetime.strftime('%m/%d %H:%M')))
+        content = '\n'.join('內文第 {line} 行，測試用的文章內容 {n}。'.format(line=line, n=rng.randrange(10 ** 6))
+                            for line in range(rng.randrange(5, 40)))
+        return ARTICLE_TEMPLATE.format(board=board,
+                                       web_id=web_id,
+                                       author='author{n} (暱稱)'.format(n=rng.randrange(500)),
+                                       title=html.escape('[閒聊] 測試文章 {web_id}'.format(web_id=web_id)),
+                                       date=post_datetime.strftime('%a %b %d %H:%M:%S %Y'),
+                                       content=content,
+                                       ip='{a}.{b}.{c}.{d}'.format(a=rng.randrange(1, 224), b=rng.randrange(256),
+                                                                   c=rng.randrange(256), d=rng.randrange(256)),
+                                       pushes='\n'.join(pushes)).encode('utf-8')
+
+
+class MockPttServer(object):
+    """`MockPtt` served on `http://127.0.0.1:port` from a background thread, a
+    free port when `port` is 0"""
+
+    def __init__(self, site: MockPtt, port: int = 0, latency: float = 0, jitter: float = 0,
+                 burst_every: int = 0, burst_length: int = 5):
+        self.site = site
+        self.latency = latency
+        self.jitter = jitter
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.requests = 0
+        self.errors = 0
+        self._article_requests = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.handle(self)
+
+            def do_POST(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{port}'.format(port=self.httpd.server_port)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='MockPttServer', daemon=True)
+
+    def __enter__(self) -> 'MockPttServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, trace):
+        self.close()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _is_burst(self) -> bool:
+        with self._lock:
+            self._article_requests += 1
+            return bool(self.burst_every) and \
+                self._article_requests % self.burst_every >= self.burst_every - self.burst_length
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        with self._lock:
+            self.requests += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        url = urlsplit(request.path)
+        if request.command == 'POST':
+            length = int(request.headers.get('Content-Length') or 0)
+            request.rfile.read(length)
+        if url.path == '/ask/over18':
+            query = dict(part.split('=', 1) for part in url.query.split('&') if '=' in part)
+            back = unquote(query.get('from', '/'))
+            self._send(request, 302, b'', [('Location', back),
+                                           ('Set-Cookie', 'over18=1; Path=/')])
+            return
+
+        index_match = INDEX_PATH.match(url.path)
+        article_match = ARTICLE_PATH.match(url.path)
+        board = (index_match or article_match).group(1) if (index_match or article_match) else None
+        if board and board.lower() in self.site.over18_boards and \
+                'over18=1' not in (request.headers.get('Cookie') or ''):
+            self._send(request, 302, OVER18_TEMPLATE.format(path=html.escape(url.path)).encode('utf-8'),
+                       [('Location', '/ask/over18?from=' + quote(url.path, safe=''))])
+            return
+
+        body = None
+        if index_match:
+            body = self.site.index_page(board, int(index_match.group(2)) if index_match.group(2) else None)
+        elif article_match:
+            if self._is_burst():
+                with self._lock:
+                    self.errors += 1
+                self._send(request, 503, b'<html><body>503 Service Unavailable</body></html>')
+                return
+            body = self.site.article_page(board, article_match.group(2))
+        if body is None:
+            self._send(request, 404, b'<html><body>404 - Not Found.</body></html>')
+        else:
+            self._send(request, 200, body)
+
+    @staticmethod
+    def _send(request: BaseHTTPRequestHandler, status: int, body: bytes, headers: List[Tuple[str, str]] = ()):
+        request.send_response(status)
+        request.send_header('Content-Type', 'text/html; charset=utf-8')
+        request.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def record(board: str, pages: int, folder: str, delay: float = 1.0):
+    """Save the newest `pages` index pages of `board` and their articles from ptt.cc"""
+    ptt_url = 'https://www.ptt.cc'
+    board_folder = os.path.join(folder, board)
+    os.makedirs(board_folder, exist_ok=True)
+    session = requests.Session()
+    session.cookies['over18'] = '1'
+
+    def save(path: str, name: str) -> str:
+        resp = session.get(ptt_url + path, timeout=30)
+        resp.raise_for_status()
+        with open(os.path.join(board_folder, name), 'wb') as fixture_file:
+            fixture_file.write(resp.content)
+        time.sleep(delay)
+        return resp.content.decode('utf-8')
+
+    content = save('/bbs/{board}/index.html'.format(board=board), 'index.html')
+    previous = re.search(r'href="/bbs/\w+/index(\d+).html">&lsaquo;', content)
+    index = int(previous.group(1)) + 1 if previous else 1
+    for page in range(index, max(index - pages, 0), -1):
+        content = save('/bbs/{board}/index{index}.html'.format(board=board, index=page),
+                       'index{index}.html'.format(index=page))
+        for web_id in dict.fromkeys(re.findall(r'href="/bbs/\w+/([MG]\.\d+\.A(?:\.[0-9A-F]{3})?)\.html"',
+                                               content)):
+            save('/bbs/{board}/{web_id}.html'.format(board=board, web_id=web_id),
+                 '{web_id}.html'.format(web_id=web_id))
+    print('Recorded {pages} index pages of {board} in {folder}'.format(pages=pages, board=board,
+                                                                       folder=board_folder))
+
+
+def add_site_args(parser: argparse.ArgumentParser):
+    parser.add_argument('--pages', type=int, default=50, help='generated index pages per board')
+    parser.add_argument('--pushes', type=int, default=30, help='mean pushes of an article')
+    parser.add_argument('--hot-every', type=int, default=10, help='one article in N is a large push thread')
+    parser.add_argument('--hot-pushes', type=int, default=1000, help='pushes of a large push thread')
+    parser.add_argument('--fixtures', type=str, default='', help='folder of recorded pages')
+    parser.add_argument('--over18', type=str, action='append', default=[], help='boards asking for over18')
+    parser.add_argument('--latency', type=float, default=0, help='seconds before every response')
+    parser.add_argument('--jitter', type=float, default=0, help='random seconds added to the latency')
+    parser.add_argument('--burst-every', type=int, default=0, help='article requests between 503 bursts')
+    parser.add_argument('--burst-length', type=int, default=5, help='503 responses of a burst')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def server_from_args(arguments, port: int = 0) -> MockPttServer:
+    site = MockPtt(pages=arguments.pages,
+                   hot_every=arguments.hot_every,
+                   hot_pushes=arguments.hot_pushes,
+                   pushes=arguments.pushes,
+                   fixtures=arguments.fixtures,
+                   over18_boards=tuple(arguments.over18),
+                   seed=arguments.seed)
+    return MockPttServer(site, port=port,
+                         latency=arguments.latency,
+                         jitter=arguments.jitter,
+                         burst_every=arguments.burst_every,
+                         burst_length=arguments.burst_length)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    add_site_args(serve_parser)
+    record_parser = subparsers.add_parser('record')
+    record_parser.add_argument('--board', type=str, required=True)
+    record_parser.add_argument('--pages', type=int, default=2)
+    record_parser.add_argument('--folder', type=str,
+                               default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+    record_parser.add_argument('--delay', type=float, default=1.0)
+    arguments = parser.parse_args()
+
+    if arguments.command == 'record':
+        record(arguments.board, arguments.pages, arguments.folder, arguments.delay)
+        return
+    with server_from_args(arguments, arguments.port) as server:
+        print('Serving the mock ptt.cc on {url}'.format(url=server.url))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
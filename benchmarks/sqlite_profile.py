@@ -0,0 +1,153 @@
+"""Pages per second written by the `PttArticleCrawler` database writer on SQLite,
+with the default settings and with the tuning profile of `[Database]`.
+
+    python benchmarks/sqlite_profile.py [--pages 20] [--articles 20] [--pushes 30] [--versions 2]
+                                        [--folder FOLDER]
+
+Every page is `--articles` parsed articles with `--pushes` pushes each, written
+`--versions` times (the later versions run the `--upgrade` path). No network
+access is needed, records are generated in the shape returned by `parse`.
+Run it with `--folder` on the disk the crawler uses, fsync costs dominate there.
+"""
+import argparse
+import configparser
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crawler.article import PttArticleCrawler  # noqa: E402
+from models import Base, PttDatabase  # noqa: E402
+
+BOARD = 'benchmark'
+PROFILES = OrderedDict([
+    ('default', {}),
+    ('tuned', OrderedDict([('JournalMode', 'WAL'),
+                           ('Synchronous', 'NORMAL'),
+                           ('MmapSize', '268435456'),
+                           ('CacheSize', '-65536'),
+                           ('BusyTimeout', '30000')])),
+])
+
+
+def make_page(page: int, articles: int, pushes: int, version: int) -> List[Dict[str, object]]:
+    records = []
+    post_datetime = datetime(2019, 1, 1) + timedelta(hours=page)
+    for i in range(articles):
+        web_id = 'M.{timestamp}.A.{i:03X}'.format(timestamp=int(post_datetime.timestamp()) + i, i=i)
+        # a new version adds pushes on top of the previous ones
+        messages = [{'push_tag': ('推', '噓', '→')[floor % 3],
+                     'push_userid': 'user{n}'.format(n=(page * 7 + floor) % 500),
+                     'push_content': 'push {floor} of {web_id}'.format(floor=floor, web_id=web_id),
+                     'push_ipdatetime': '10.{a}.{b}.{c} 01/02 12:{m:02d}'.format(a=page % 256,
+                                                                               b=i,
+                                                                               c=floor % 256,
+                                                                               m=floor % 60)}
+                    for floor in range(pushes + version * (pushes // 5))]
+        records.append({'url': 'https://www.ptt.cc/bbs/{board}/{web_id}.html'.format(board=BOARD, web_id=web_id),
+                        'board': BOARD,
+                        'article_id': web_id,
+                        'article_title': '[benchmark] page {page} article {i}'.format(page=page, i=i),
+                        'author': 'author{n} (benchmark)'.format(n=i % 50),
+                        'date': post_datetime.strftime('%a %b %d %H:%M:%S %Y'),
+                        'content': 'content of {web_id} version {version} '.format(web_id=web_id,
+                                                                                  version=version) * 20,
+                        'ip': '192.168.{a}.{b}'.format(a=page % 256, b=i),
+                        'message_count': {},
+                        'messages': messages})
+    return records
+
+
+def write_config(folder: str, pragmas: Dict[str, str]) -> str:
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config['Database'] = OrderedDict([('Type', 'sqlite'),
+                                      ('Name', os.path.join(folder, 'ptt.db'))])
+    config['Database'].update(pragmas)
+    config['PttArticle'] = {'Delaytime': '0',
+                            'NextPageDelaytime': '0',
+                            'Timeout': '10',
+                            'Output': 'database',
+                            'VersionRotate': '30'}
+    config['IpAsn'] = {'Enrichment': 'false'}
+    config_path = os.path.join(folder, 'config.ini')
+    with open(config_path, 'w') as configfile:
+        config.write(configfile)
+    return config_path
+
+
+def run(name: str, pragmas: Dict[str, str], arguments) -> float:
+    with tempfile.TemporaryDirectory(dir=arguments.folder) as folder:
+        config_path = write_config(folder, pragmas)
+        db = PttDatabase(dbtype='sqlite', dbname=os.path.join(folder, 'ptt.db'))
+        Base.metadata.create_all(db.engine)
+        db.engine.dispose()
+
+        crawler = PttArticleCrawler({'config_path': config_path,
+                                     'board_name': BOARD,
+                                     'start_date': None,
+                                     'since_date': None,
+                                     'database': True,
+                                     'tail': False,
+                                     'index': None,
+                                     'upgrade': True,
+                                     'hot': False,
+                                     'worker': False,
+                                     'enqueue': False,
+                                     'json_folder': folder,
+                                     'json_prefix': '',
+                                     'verbose': False})
+        pages = [[make_page(page, arguments.articles, arguments.pushes, version)
+                  for page in range(arguments.pages)]
+                 for version in range(arguments.versions)]
+
+        start_time = time.perf_counter()
+        for version_pages in pages:
+            for records in version_pages:
+                crawler.writer.put(crawler._output_database, records)
+        crawler.writer.close()
+        elapsed = time.perf_counter() - start_time
+        crawler.db_session.close()
+        crawler.db.engine.dispose()
+
+    written = arguments.pages * arguments.versions
+    print('{name:<10} {pages:>6} {seconds:>10.2f} {rate:>10.2f}'.format(name=name,
+                                                                      pages=written,
+                                                                      seconds=elapsed,
+                                                                      rate=written / elapsed))
+    return written / elapsed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--articles', type=int, default=20)
+    parser.add_argument('--pushes', type=int, default=30)
+    parser.add_argument('--versions', type=int, default=2)
+    parser.add_argument('--folder', type=str,
+                        help='folder of the benchmark databases, default the system temp folder')
+    parser.add_argument('--profile', choices=list(PROFILES), action='append',
+                        help='profiles to run, default all')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print('{:<10} {:>6} {:>10} {:>10}'.format('profile', 'pages', 'seconds', 'pages/s'))
+    rates = OrderedDict()
+    for name in arguments.profile or PROFILES:
+        rates[name] = run(name, PROFILES[name], arguments)
+    if 'default' in rates and 'tuned' in rates:
+        print('speedup {:.2f}x'.format(rates['tuned'] / rates['default']))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ from enum import Enum
 from crawler.article import PttArticleCrawler
 from crawler.article_index import PttArticleIndexCrawler
 from crawler.asn import PttIpAsnCrawler
+from crawler.prune import PttHistoryPruner
 from crawler.user import PttUserCrawler
 
 
@@ -11,3 +12,4 @@ class CrawlerModule(Enum):
     article = 2
     asn = 3
     user = 4
+    prune = 5
@@ -2,12 +2,14 @@ import argparse
 import logging
 from logging.handlers import RotatingFileHandler
 
-from utils import valid_date_type
+from utils import PROFILER, load_config, valid_date_type
 
-from crawler import CrawlerModule, PttArticleCrawler, PttIpAsnCrawler, PttUserCrawler, PttArticleIndexCrawler
+from crawler import (CrawlerModule, PttArticleCrawler, PttArticleIndexCrawler, PttHistoryPruner,
+                     PttIpAsnCrawler, PttUserCrawler)
 from crawler.crawler_arg import (add_article_arg_parser, add_article_index_arg_parser,
-                                 add_asn_arg_parser, add_user_arg_parser,
-                                 get_base_parser)
+                                 add_asn_arg_parser, add_prune_arg_parser,
+                                 add_user_arg_parser, get_base_parser)
+from crawler.metrics import MetricsExporter
 
 
 def parse_argument():
@@ -37,7 +39,14 @@ def parse_argument():
                                              help='user module help')
     add_user_arg_parser(parser_user)
 
+    parser_prune = main_subparsers.add_parser('prune',
+                                              parents=[base_subparser],
+                                              help='article history rotation module help')
+    add_prune_arg_parser(parser_prune)
+
     args = parser.parse_args()
+    if args.module == 'article' and args.enqueue and not args.database:
+        parser_article.error('--enqueue requires --database')
     arguments = vars(args)
     return arguments
 
@@ -62,18 +71,29 @@ def main():
 
     logging.info('Started')
 
-    if module == CrawlerModule.article:
-        crawler = PttArticleCrawler(args)
-        crawler.crawling()
-    elif module == CrawlerModule.asn:
-        crawler = PttIpAsnCrawler(args)
-        crawler.crawling()
-    elif module == CrawlerModule.user:
-        crawler = PttUserCrawler(args)
-        crawler.crawling()
-    elif module == CrawlerModule.article_index:
-        crawler = PttArticleIndexCrawler(args)
-        crawler.crawling()
+    config = load_config(args['config_path'] or 'config.ini')
+    PROFILER.configure_from_config(config)
+    metrics_exporter = MetricsExporter.from_config(config)
+    try:
+        if module == CrawlerModule.article:
+            crawler = PttArticleCrawler(args)
+            crawler.crawling()
+        elif module == CrawlerModule.asn:
+            crawler = PttIpAsnCrawler(args)
+            crawler.crawling()
+        elif module == CrawlerModule.user:
+            crawler = PttUserCrawler(args)
+            crawler.crawling()
+        elif module == CrawlerModule.article_index:
+            crawler = PttArticleIndexCrawler(args)
+            crawler.crawling()
+        elif module == CrawlerModule.prune:
+            pruner = PttHistoryPruner(args)
+            pruner.pruning()
+    finally:
+        if metrics_exporter:
+            metrics_exporter.close()
+        PROFILER.log_summary()
 
     logging.info('Finished')
 
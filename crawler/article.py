@@ -7,16 +7,26 @@ import re
 import sys
 import time
 from datetime import datetime
-from typing import Dict, List
+from functools import partial
+from typing import Dict, Iterator, List, Tuple
 
 import requests
 from bs4 import BeautifulSoup
+from sqlalchemy import or_
 
-from models import (Article, ArticleHistory, ArticleIndex, Board, IpAsn,
-                    PttDatabase, Push, User, UserLastRecord)
-from utils import PostException, load_config, log
+from models import (Article, ArticleHistory, ArticleHistoryPush, ArticleIndex, Board,
+                    IpAddress, IpAsn, PttDatabase, Push, User, UserLastRecord)
+from utils import PostException, load_config, log, web_id_datetime, web_id_ranges
 
+from .asn import PttIpAsnEnricher
+from .crawled import CrawledWebIds
 from .crawler_arg import add_article_arg_parser, get_base_parser
+from .metrics import (ARTICLES, DB_WRITE_ERRORS, DB_WRITE_SECONDS, HTTP_REQUEST_SECONDS, HTTP_REQUESTS,
+                      INDEX_PAGES, PARSE_SECONDS)
+from .prune import HistoryPruner
+from .recrawl import RecrawlScheduler
+from .work_queue import CrawlWorkQueue
+from .writer import PttDatabaseWriter
 
 
 class PttArticleCrawler:
@@ -26,6 +36,7 @@ class PttArticleCrawler:
     PTT_Article_Format = '/bbs/{board}/{web_id}.html'
     DELAY_TIME = 1.0
     NEXT_PAGE_DELAY_TIME = 5.0
+    DB_PAGE_SIZE = 1000
 
     @log('Initialize')
     def __init__(self, arguments: Dict):
@@ -34,8 +45,14 @@ class PttArticleCrawler:
 
         self._init_config(config_path)
         self._init_database()
+        self.asn_enricher = PttIpAsnEnricher.from_config(config_path, self.config, self.writer)
+        self.pruner = None
+        if self.article_config.getboolean('PruneInline', fallback=True):
+            self.pruner = HistoryPruner(self.db, self.write_session, self.VERSION_ROTATE,
+                                        batch_size=self.article_config.getint('PruneBatchSize', fallback=500))
 
         self.board = arguments['board_name']
+        self.crawled = None
         self.timeout = None
         # self.timeout = float(self.article_config['Timeout'])
 
@@ -44,8 +61,12 @@ class PttArticleCrawler:
         self.cookies = {'over18': '1'}
 
         self.start_date = arguments['start_date']
+        self.since_date = arguments['since_date'] or self.start_date
         self.from_database = arguments['database']
-        if not self.from_database:
+        self.tail = arguments['tail']
+        self.worker = arguments['worker']
+        self.enqueue = arguments['enqueue']
+        if not (self.from_database or self.tail or self.worker):
             self.start_index, self.end_index = (arguments['index'] if arguments['index']
                                                 else (1, self.getLastPage(self.board, self.timeout)))
         else:
@@ -53,6 +74,10 @@ class PttArticleCrawler:
         
 
         self.upgrade_action = arguments['upgrade']
+        self.hot = arguments['hot']
+        self.work_queue = None
+        if self.worker or self.enqueue or self.tail:
+            self.work_queue = CrawlWorkQueue.from_config(self.db, self.config)
 
         self.json_folder = arguments['json_folder']
         self.json_prefix = arguments['json_prefix']
@@ -84,9 +109,11 @@ class PttArticleCrawler:
                 self.database_output = False
 
     def _init_database(self):
-        self.db = PttDatabase(dbtype=self.database_config['Type'],
-                              dbname=self.database_config['Name'])
+        self.db = PttDatabase.from_config(self.database_config)
         self.db_session = self.db.get_session()
+        self.writer = PttDatabaseWriter.from_config(self.db, self.database_config, name='article')
+        self.write_session = self.writer.session
+        self.group_commit = self.writer.group_commit
 
     def _output_json(self, result: Dict[str, object], index):
         json_name = '{prefix}{board}_{index}.json'.format(prefix=self.json_prefix,
@@ -100,19 +127,110 @@ class PttArticleCrawler:
                       ensure_ascii=False)
 
     def _output_index_to_database(self, result: List[tuple]):
-        board, _ = self.db.get_or_create(self.db_session, Board, {
-                                         'name': self.board}, {'name': self.board})
-        # board = self.db.get(self.db_session,
-        #                     Board,
-        #                     {'name': self.board})
-        index_list = []
-        for web_id, link, index in result:
-            logging.debug('web_id = %s, link = %s, index = %d, board.id = %d',
-                          web_id, link, index, board.id)
-            index_list.append({'web_id': web_id,
-                               'board_id': board.id,
-                               'index': index})
-        self.db.bulk_update(self.db_session, ArticleIndex, index_list)
+        with self.group_commit.record(count=0):
+            board, _ = self.db.get_or_create(self.write_session, Board,
+                                             {'name': self.board}, {'name': self.board},
+                                             auto_commit=False)
+            index_list = []
+            for web_id, link, index in result:
+                logging.debug('web_id = %s, link = %s, index = %d, board.id = %d',
+                              web_id, link, index, board.id)
+                index_list.append({'web_id': web_id,
+                                   'board_id': board.id,
+                                   'index': index})
+            self.db.bulk_copy_upsert(self.write_session, ArticleIndex, index_list, auto_commit=False)
+
+    def _get_index_page(self, index: int = None) -> Tuple[int, List[Tuple[str, str, int]]]:
+        """Index and (web_id, link, index) of the articles of an index page,
+        the newest page when `index` is None"""
+        ptt_index_url = (self.PTT_URL +
+                         self.PTT_Board_Format).format(board=self.board,
+                                                       index=index or '')
+        logging.debug('Processing index: %s, Url = %s',
+                      index, ptt_index_url)
+
+        try:
+            with HTTP_REQUEST_SECONDS.time(kind='index'):
+                resp = requests.get(url=ptt_index_url,
+                                    headers=self.headers,
+                                    cookies=self.cookies,
+                                    timeout=self.timeout)
+        except requests.RequestException:
+            HTTP_REQUESTS.inc(kind='index', status='error')
+            raise
+        HTTP_REQUESTS.inc(kind='index', status=resp.status_code)
+        self.cookies = resp.cookies
+        self.cookies['over18'] = '1'
+
+        if resp.status_code != 200:
+            logging.error('Processing index error, status_code = %d, Url = %s',
+                          resp.status_code, ptt_index_url)
+            resp.raise_for_status()
+        if index is None:
+            index = self._parse_last_page(resp.text)
+
+        soup = BeautifulSoup(resp.text, 'html.parser')
+        divs = soup.find("div",
+                         "r-list-container action-bar-margin bbs-screen")
+        children = divs.findChildren("div",
+                                     recursive=False)
+
+        article_link_list = []
+        for div in children:
+            # ex. link would be <a href="/bbs/PublicServan/M.1127742013.A.240.html">Re: [問題] 職等</a>
+            if 'r-list-sep' in div['class']:
+                break
+            elif 'r-ent' in div['class']:
+                try:
+                    href = div.find('a')['href']
+                    link = self.PTT_URL + href
+                    article_id = re.sub(
+                        '\.html', '', href.split('/')[-1])
+                    article_link_list.append((article_id, link, index))
+                except Exception as e:
+                    logging.warning('%s href 404', div)
+            else:
+                continue
+        INDEX_PAGES.inc(crawler='article')
+        return index, article_link_list
+
+    def _is_before_since_date(self, web_id: str) -> bool:
+        post_datetime = web_id_datetime(web_id)
+        if post_datetime is None:
+            logging.debug('No post time in web_id %s, it is crawled', web_id)
+            return False
+        return post_datetime < self.since_date
+
+    def _find_start_index(self, start_date: datetime) -> int:
+        """First index page listing an article posted on or after `start_date`.
+
+        Index pages are in posting order, so the page is found by binary search
+        between `start_index` and `end_index`, with the post time encoded in
+        the web_ids of a page. Pages without a dated article are passed over
+        to the next page.
+        """
+        low, high = self.start_index, self.end_index
+        probes = 0
+        while low < high:
+            middle = (low + high) // 2
+            index = middle
+            newest = None
+            while newest is None and index < high:
+                _, article_link_list = self._get_index_page(index)
+                dates = [web_id_datetime(web_id) for web_id, _, _ in article_link_list]
+                dates = [date for date in dates if date]
+                probes += 1
+                time.sleep(self.NEXT_PAGE_DELAY_TIME)
+                if dates:
+                    newest = max(dates)
+                else:
+                    index += 1
+            if newest is not None and newest < start_date:
+                low = index + 1
+            else:
+                high = middle
+        logging.info('Start date %s is on index %d, %d pages probed', start_date, low, probes)
+        return low
 
     @log('Output_Database')
     def _output_database(self, result: List[Dict[str, object]]):
@@ -122,7 +240,7 @@ class PttArticleCrawler:
                 match = re.search(
                     r'([\d.]*)\W?(\d{2}\/\d{2}\ \d{2}:\d{2})', push_ipdatetime)
                 if match:
-                    push_ip = match.group(1)
+                    push_ip = IpAddress.normalize(match.group(1))
                     push_datetime = datetime.strptime(
                         match.group(2), "%m/%d %M:%S")
 
@@ -139,104 +257,58 @@ class PttArticleCrawler:
                     return match.group(1)
             return author
 
+        start = time.perf_counter()
+        rotate_article_ids = []
+        crawled_web_ids = []
+        written_web_ids = []
         for record in result:
+            written = False
             try:
-                author_username = parse_author(record['author'])
-                if not author_username:
-                    logging.warning('author is empty, record = %s', record)
-                    author_username = ''
-                author_conditon = {'username': author_username}
-                author_values = {'username': author_username,
-                                 'login_times': 0,
-                                 'valid_article_count': 0}
-                if not self.upgrade_action:
-                    article = self.db.get(self.db_session,
-                                          Article,
-                                          {'web_id': record['article_id']})
-                    if article:
-                        continue
+                unresolved_ip_list = []
+                with self.group_commit.record():
+                    author_username = parse_author(record['author'])
+                    if not author_username:
+                        logging.warning('author is empty, record = %s', record)
+                        author_username = ''
+                    author_conditon = {'username': author_username}
+                    author_values = {'username': author_username,
+                                     'login_times': 0,
+                                     'valid_article_count': 0}
+                    user, _ = self.db.get_or_create(self.write_session,
+                                                    User,
+                                                    author_conditon,
+                                                    author_values,
+                                                    auto_commit=False)
+                    board, _ = self.db.get_or_create(self.write_session, Board,
+                                                     {'name': record['board']},
+                                                     {'name': record['board']},
+                                                     auto_commit=False)
 
-                user, _ = self.db.get_or_create(self.db_session,
-                                                User,
-                                                author_conditon,
-                                                author_values,
-                                                auto_commit=False)
-                board, _ = self.db.get_or_create(self.db_session, Board,
-                                                 {'name': record['board']},
-                                                 {'name': record['board']},
-                                                 auto_commit=False)
+                    post_ip = IpAddress.normalize(record['ip'])
 
-                try:
-                    record['date'] = datetime.strptime(record['date'], '%a %b %d %H:%M:%S %Y')                    
-                except:
-                    record['date'] = None
-
-                article, is_new_article = self.db.get_or_create(self.db_session, Article,
-                                                                {'web_id': record['article_id']},
-                                                                {'web_id': record['article_id'],
-                                                                    'user_id': user.id,
-                                                                    'board_id': board.id,
-                                                                    'post_datetime': record['date'],
-                                                                    'post_ip': record['ip']},
-                                                                auto_commit=False)
-
-                if record['ip']:
-                    _, _ = self.db.get_or_create(self.db_session,
-                                                 IpAsn,
-                                                 {'ip': record['ip']},
-                                                 {'ip': record['ip'],
-                                                  'asn': None,
-                                                  'asn_cidr': None,
-                                                  'asn_country_code': None,
-                                                  'asn_date': None,
-                                                  'asn_description': None,
-                                                  'asn_raw': None,
-                                                  'asn_registry': None},
-                                                 auto_commit=False)
-                if not is_new_article:
-                    article.history[0].end_at = datetime.now()
-                    self.db_session.flush()
-
-                history = self.db.create(self.db_session,
-                                         ArticleHistory,
-                                         {'article_id': article.id,
-                                          'title': record['article_title'],
-                                          'content': record['content'],
-                                          'start_at': datetime.now(),
-                                          'end_at': datetime.now()},
-                                         auto_commit=False)
-
-                # 更新到最近的文章歷史記錄推文
-                push_list = []
-                for (floor, message) in enumerate(record['messages']):
-                    push_userid = message['push_userid']
-                    if not push_userid:
-                        logging.warning('push_userid is empty, message = %s', message)
-                        push_userid = ''
-                    push_user_condition = {'username': push_userid}
-                    push_user_values = {'username': push_userid,
-                                        'login_times': 0,
-                                        'valid_article_count': 0}
-                    push_user, _ = self.db.get_or_create(self.db_session,
-                                                         User,
-                                                         push_user_condition,
-                                                         push_user_values,
-                                                         auto_commit=False)
-                    push_ip, push_datetime = parser_push_ipdatetime(
-                        message['push_ipdatetime'])
-
-                    push_list.append(Push(article_history_id=history.id,
-                                          floor=(floor+1),
-                                          push_tag=message['push_tag'],
-                                          push_user_id=push_user.id,
-                                          push_content=message['push_content'],
-                                          push_ip=push_ip,
-                                          push_datetime=push_datetime))
-                    if push_ip:
-                        _, _ = self.db.get_or_create(self.db_session,
+                    # record is shared with the json output, it is left untouched
+                    try:
+                        post_datetime = datetime.strptime(record['date'], '%a %b %d %H:%M:%S %Y')
+                    except:
+                        post_datetime = None
+
+                    article, is_new_article = self.db.get_or_create(self.write_session, Article,
+                                                                    {'web_id': record['article_id']},
+                                                                    {'web_id': record['article_id'],
+                                                                        'user_id': user.id,
+                                                                        'board_id': board.id,
+                                                                        'post_datetime': post_datetime,
+                                                                        'post_ip': post_ip},
+                                                                    auto_commit=False)
+                    if not self.upgrade_action and not is_new_article:
+                        written = True
+                        continue
+
+                    if post_ip:
+                        ip_asn, _ = self.db.get_or_create(self.write_session,
                                                      IpAsn,
-                                                     {'ip': push_ip},
-                                                     {'ip': push_ip,
+                                                     {'ip': post_ip},
+                                                     {'ip': post_ip,
                                                       'asn': None,
                                                       'asn_cidr': None,
                                                       'asn_country_code': None,
@@ -245,35 +317,137 @@ class PttArticleCrawler:
                                                       'asn_raw': None,
                                                       'asn_registry': None},
                                                      auto_commit=False)
+                        if ip_asn.asn is None:
+                            unresolved_ip_list.append(ip_asn.ip)
+                    if not is_new_article:
+                        last_history = self.write_session.query(ArticleHistory) \
+                            .filter(ArticleHistory.article_id == article.id) \
+                            .order_by(ArticleHistory.start_at.desc()) \
+                            .first()
+                        if last_history:
+                            last_history.end_at = datetime.now()
+                            self.write_session.flush()
+
+                    history = self.db.create(self.write_session,
+                                             ArticleHistory,
+                                             {'article_id': article.id,
+                                              'title': record['article_title'],
+                                              'content': record['content'],
+                                              'start_at': datetime.now(),
+                                              'end_at': datetime.now()},
+                                             auto_commit=False)
+
+                    # 更新到最近的文章歷史記錄推文
+                    push_list = []
+                    for (floor, message) in enumerate(record['messages']):
+                        push_userid = message['push_userid']
+                        if not push_userid:
+                            logging.warning('push_userid is empty, message = %s', message)
+                            push_userid = ''
+                        push_ip, push_datetime = parser_push_ipdatetime(
+                            message['push_ipdatetime'])
+                        push_list.append((floor + 1, message, push_userid, push_ip, push_datetime))
+
+                    push_users = self.db.get_or_create_all(self.write_session,
+                                                           User,
+                                                           'username',
+                                                           [{'username': push_userid,
+                                                             'login_times': 0,
+                                                             'valid_article_count': 0}
+                                                            for _, _, push_userid, _, _ in push_list],
+                                                           auto_commit=False)
+                    push_ip_list = [push_ip for _, _, _, push_ip, _ in push_list if push_ip]
+                    if push_ip_list:
+                        push_ip_asns = self.db.get_or_create_all(self.write_session,
+                                                                 IpAsn,
+                                                                 'ip',
+                                                                 [{'ip': push_ip} for push_ip in push_ip_list],
+                                                                 auto_commit=False)
+                        unresolved_ip_list += [ip for ip, ip_asn in push_ip_asns.items()
+                                               if ip_asn.asn is None]
+
+                    # 推文內容只儲存一次，各版本的歷史記錄以關聯表指向推文
+                    exist_push_ids = {}
+                    if not is_new_article:
+                        exist_push_ids = {(floor, content_hash): push_id for push_id, floor, content_hash in
+                                          self.write_session.query(Push.id, Push.floor, Push.content_hash)
+                                          .filter(Push.article_id == article.id)}
+
+                    new_push_list = []
+                    history_push_keys = []
+                    for floor, message, push_userid, push_ip, push_datetime in push_list:
+                        push_user_id = push_users[push_userid].id
+                        content_hash = Push.content_hash_of(message['push_tag'],
+                                                            push_user_id,
+                                                            message['push_content'],
+                                                            push_ip,
+                                                            push_datetime)
+                        key = (floor, content_hash)
+                        history_push_keys.append(key)
+                        if key not in exist_push_ids:
+                            exist_push_ids[key] = None
+                            new_push_list.append({'article_id': article.id,
+                                                  'floor': floor,
+                                                  'content_hash': content_hash,
+                                                  'push_tag': message['push_tag'],
+                                                  'push_user_id': push_user_id,
+                                                  'push_content': message['push_content'],
+                                                  'push_ip': push_ip,
+                                                  'push_datetime': push_datetime})
+
+                    self.db.bulk_copy(self.write_session, Push, new_push_list,
+                                      return_ids=True, auto_commit=False)
+                    for push in new_push_list:
+                        exist_push_ids[(push['floor'], push['content_hash'])] = push['id']
+                    self.db.bulk_copy(self.write_session,
+                                      ArticleHistoryPush,
+                                      [{'article_history_id': history.id,
+                                        'push_id': exist_push_ids[key]}
+                                       for key in history_push_keys],
+                                      auto_commit=False)
+                    written = True
 
-                self.db.bulk_insert(
-                    self.db_session, push_list, auto_commit=False)
-
-                article = self.db.get(self.db_session,
-                                      Article,
-                                      {'id': article.id})
-
-                if len(article.history) >= self.VERSION_ROTATE:
-                    for h in article.history[self.VERSION_ROTATE:]:
-                        self.db_session.delete(h)
-                    self.db_session.flush()
-
-                self.db_session.commit()
-            except:
+                if not is_new_article:
+                    rotate_article_ids.append(article.id)
+                else:
+                    crawled_web_ids.append(article.web_id)
+                if self.asn_enricher:
+                    self.group_commit.after_commit(partial(self.asn_enricher.enqueue, unresolved_ip_list))
+            except Exception:
+                written = False
+                DB_WRITE_ERRORS.inc(writer='article')
                 logging.exception('record = %s', record)
+            finally:
+                if written:
+                    written_web_ids.append(record['article_id'])
+
+        if self.crawled and crawled_web_ids:
+            self.group_commit.after_commit(partial(self.crawled.add, crawled_web_ids))
+        if self.pruner and rotate_article_ids:
+            self.group_commit.after_commit(partial(self.pruner.prune, rotate_article_ids))
+        DB_WRITE_SECONDS.observe(time.perf_counter() - start, writer='article')
+        return written_web_ids
 
     def parse(self, link, article_id, board, timeout=3):
         """Ref: https://github.com/jwlin/ptt-web-crawler/blob/f8c04076004941d3f7584240c86a95a883ae16de/PttWebCrawler/crawler.py#L99"""
-        resp = requests.get(url=link,
-                            headers=self.headers,
-                            cookies=self.cookies,
-                            verify=True,
-                            timeout=timeout)
+        try:
+            with HTTP_REQUEST_SECONDS.time(kind='article'):
+                resp = requests.get(url=link,
+                                    headers=self.headers,
+                                    cookies=self.cookies,
+                                    verify=True,
+                                    timeout=timeout)
+        except requests.RequestException:
+            HTTP_REQUESTS.inc(kind='article', status='error')
+            raise
+        HTTP_REQUESTS.inc(kind='article', status=resp.status_code)
         self.cookies = resp.cookies
         self.cookies['over18'] = '1'
         if resp.status_code != 200:
+            ARTICLES.inc(result='invalid')
             return {"error": "invalid url"}
             # return json.dumps({"error": "invalid url"}, sort_keys=True, ensure_ascii=False)
+        parse_start = time.perf_counter()
         soup = BeautifulSoup(resp.text, 'html.parser')
         main_content = soup.find(id="main-content")
         metas = main_content.select('div.article-metaline')
@@ -381,20 +555,26 @@ class PttArticleCrawler:
             'messages': messages
         }
         # print 'original:', data
+        PARSE_SECONDS.observe(time.perf_counter() - parse_start)
+        ARTICLES.inc(result='parsed')
         return data
         # return json.dumps(data, sort_keys=True, ensure_ascii=False)
 
     def getLastPage(self, board, timeout=3):
         """Ref: https://github.com/jwlin/ptt-web-crawler/blob/f8c04076004941d3f7584240c86a95a883ae16de/PttWebCrawler/crawler.py#L189"""
         resp = requests.get(
-            url='https://www.ptt.cc/bbs/' + board + '/index.html',
+            url=self.PTT_URL + self.PTT_Board_Format.format(board=board, index=''),
             headers=self.headers,
             cookies=self.cookies,
             timeout=timeout
         )
         self.cookies = resp.cookies
         self.cookies['over18'] = '1'
-        content = resp.content.decode('utf-8')
+        return self._parse_last_page(resp.content.decode('utf-8'))
+
+    @staticmethod
+    def _parse_last_page(content: str) -> int:
+        """Index of the newest page, one after the page its "previous" link points to"""
         first_page = re.search(
             r'href="/bbs/\w+/index(\d+).html">&lsaquo;', content)
         if first_page is None:
@@ -406,67 +586,65 @@ class PttArticleCrawler:
         logging.debug('Start date = %s', self.start_date)
         logging.debug('Start = %d, End = %d', self.start_index, self.end_index)
         logging.debug('From database = %s', str(self.from_database))
-        if self.from_database:
-            self._crawling_from_db()
-        else:
-            self._crawling_from_arg()
+        try:
+            if self.from_database and self.enqueue:
+                self._enqueue_from_db()
+            elif self.from_database:
+                self._crawling_from_db()
+            elif self.worker:
+                self._crawling_worker()
+            elif self.tail:
+                self._crawling_tail()
+            else:
+                self._crawling_from_arg()
+        finally:
+            try:
+                if self.asn_enricher:
+                    # the ips of the open batch are queued once it is committed
+                    try:
+                        self.writer.commit()
+                    finally:
+                        self.asn_enricher.close()
+            finally:
+                self.writer.close()
 
     @log()
     def _crawling_from_arg(self):
         last_page = self.end_index
         board, _ = self.db.get_or_create(self.db_session, Board, {
                                          'name': self.board}, {'name': self.board})
+        if self.start_date:
+            self.start_index = self._find_start_index(self.start_date)
+
+        crawled_pages = set()
+        if not self.upgrade_action:
+            self.crawled = CrawledWebIds.from_config(self.db, self.db_session, board.id, self.article_config)
+            # New articles are appended to the last page
+            crawled_pages = self.crawled.crawled_pages() - {self.end_index}
         while last_page >= self.start_index:
-            ptt_index_url = (self.PTT_URL +
-                             self.PTT_Board_Format).format(board=self.board,
-                                                           index=last_page)
-            logging.debug('Processing index: %d, Url = %s',
-                          last_page, ptt_index_url)
-
-            resp = requests.get(url=ptt_index_url,
-                                headers=self.headers,
-                                cookies=self.cookies,
-                                timeout=self.timeout)
-            self.cookies = resp.cookies
-            self.cookies['over18'] = '1'
-
-            if resp.status_code != 200:
-                logging.error('Processing index error, status_code = %d, Url = %s',
-                              resp.status_code, ptt_index_url)
-                resp.raise_for_status()
-
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            divs = soup.find("div",
-                             "r-list-container action-bar-margin bbs-screen")
-            children = divs.findChildren("div",
-                                         recursive=False)
-
-            article_link_list = []
-            for div in children:
-                # ex. link would be <a href="/bbs/PublicServan/M.1127742013.A.240.html">Re: [問題] 職等</a>
-                if 'r-list-sep' in div['class']:
+            if last_page in crawled_pages:
+                logging.debug('Skip crawled index: %d', last_page)
+                last_page -= 1
+                continue
+
+            _, article_link_list = self._get_index_page(last_page)
+            self.writer.put(self._output_index_to_database, article_link_list)
+
+            if self.since_date:
+                in_window_list = [(article_id, link, index) for article_id, link, index in article_link_list
+                                  if not self._is_before_since_date(article_id)]
+                if article_link_list and not in_window_list:
+                    # Pages before this one are older still
+                    logging.info('Index %d is before %s', last_page, self.since_date)
                     break
-                elif 'r-ent' in div['class']:
-                    try:
-                        href = div.find('a')['href']
-                        link = self.PTT_URL + href
-                        article_id = re.sub(
-                            '\.html', '', href.split('/')[-1])
-                        article_link_list.append((article_id, link, last_page))
-                    except Exception as e:
-                        logging.warning('%s href 404', div)
-                else:
-                    continue
-            self._output_index_to_database(article_link_list)
+                article_link_list = in_window_list
 
-            page_article_count = self.db_session.query(ArticleIndex) \
-                .join(Article, Article.web_id == ArticleIndex.web_id) \
-                .filter(ArticleIndex.board_id == board.id, ArticleIndex.index == last_page)\
-                .count()
+            if not self.upgrade_action:
+                missing_web_ids = set(self.crawled.missing([article_id for article_id, _, _ in article_link_list]))
+                article_link_list = [(article_id, link, index) for article_id, link, index in article_link_list
+                                     if article_id in missing_web_ids]
 
-            if not self.upgrade_action and page_article_count == len(article_link_list):
-                pass
-            else:
+            if article_link_list:
                 article_list = []
                 for article_id, link, _ in article_link_list:
                     try:
@@ -479,31 +657,14 @@ class PttArticleCrawler:
                                                        self.timeout))
                         time.sleep(self.DELAY_TIME)
                     except Exception as e:
+                        ARTICLES.inc(result='error')
                         logging.exception(
                             'Processing article error, Url = %s', link)
 
-                len_article_list = len(article_list)
-                if self.start_date:
-                    tmp_article_list = []
-                    for article in article_list:
-                        try:
-                            aritcle_date = datetime.strptime(article['date'],
-                                                             '%a %b %d %H:%M:%S %Y')
-                            if self.start_date <= aritcle_date:
-                                tmp_article_list.append(article)
-                        except Exception as e:
-                            # 避免因為原文的日期被砍，導致無法繼續處理
-                            len_article_list -= 1
-                            logging.error('%s', e)
-                            logging.error('article: %s , date format: %s',
-                                          article['article_id'], article['date'])
-
-                    if len(tmp_article_list) < len_article_list:
-                        self.start_index = last_page
-                        article_list = tmp_article_list
-
                 if self.database_output:
-                    self._output_database(article_list)
+                    # error responses are counted by parse, they are no records
+                    self.writer.put(self._output_database,
+                                    [article for article in article_list if 'error' not in article])
 
                 if self.json_output:
                     self._output_json(article_list, last_page)
@@ -511,50 +672,258 @@ class PttArticleCrawler:
             last_page -= 1
             time.sleep(self.NEXT_PAGE_DELAY_TIME)
 
+    @staticmethod
+    def _web_id_order(web_id: str) -> Tuple[datetime, str]:
+        return (web_id_datetime(web_id) or datetime.min, web_id)
+
+    def _output_tail(self, board_id: int, tail_index: int, tail_web_id: str):
+        with self.group_commit.record(count=0):
+            board = self.write_session.query(Board).get(board_id)
+            board.tail_index = tail_index
+            board.tail_web_id = tail_web_id
+
+    def _output_tail_page(self, article_list: List[Dict[str, object]], failed_web_ids: List[str]):
+        """Write the articles of a tail page, queue the ones which failed to be
+        fetched or written as jobs of --worker once the batch is committed"""
+        if self.database_output:
+            written_web_ids = set(self._output_database(article_list) or [])
+            failed_web_ids = failed_web_ids + [article['article_id'] for article in article_list
+                                               if article['article_id'] not in written_web_ids]
+        if failed_web_ids:
+            self.group_commit.after_commit(partial(self._requeue_tail, failed_web_ids))
+
+    def _requeue_tail(self, web_ids: List[str]):
+        count = self.work_queue.enqueue(self.board, web_ids)
+        logging.warning('Tail of %s: %d articles failed, %d queued for --worker',
+                        self.board, len(web_ids), count)
+
     @log()
-    def _crawling_from_db(self):
+    def _crawling_tail(self):
+        """Crawl the articles posted since the last --tail run of the board.
+
+        Pages are fetched from the newest one back to the first page listing an
+        article up to the newest web_id of the last run. The first run only
+        crawls the newest page. The tail of the board moves after the articles
+        are written. Articles which fail, an error response of the site or a
+        record which is not written, are behind the tail then, they are queued
+        as jobs of `[WorkQueue]` for `--worker` crawlers.
+        """
         board, _ = self.db.get_or_create(self.db_session, Board, {
                                          'name': self.board}, {'name': self.board})
+        tail = self._web_id_order(board.tail_web_id) if board.tail_web_id else None
+
+        pages = []
+        index = None
+        while True:
+            index, article_link_list = self._get_index_page(index)
+            self.writer.put(self._output_index_to_database, article_link_list)
+            new_link_list = [(article_id, link, page) for article_id, link, page in article_link_list
+                             if tail is None or self._web_id_order(article_id) > tail]
+            pages.append((index, new_link_list))
+            if (tail is None or len(new_link_list) < len(article_link_list) or
+                    index <= (board.tail_index or 1)):
+                break
+            index -= 1
+            time.sleep(self.NEXT_PAGE_DELAY_TIME)
 
-        # exist_article_list = self.db_session \
-        #     .query(Article.web_id) \
-        #     .filter(Article.board_id == board.id).all()
+        newest_index = pages[0][0]
+        newest_web_id = board.tail_web_id
+        for index, article_link_list in reversed(pages):
+            if article_link_list:
+                newest_web_id = max((article_id for article_id, _, _ in article_link_list),
+                                    key=self._web_id_order)
+            if self.since_date:
+                article_link_list = [(article_id, link, page) for article_id, link, page in article_link_list
+                                     if not self._is_before_since_date(article_id)]
+            article_list = []
+            failed_web_ids = []
+            for article_id, link, _ in article_link_list:
+                try:
+                    logging.info('Processing article: %s, Url = %s',
+                                 article_id, link)
+                    article = self.parse(link,
+                                         article_id,
+                                         self.board,
+                                         self.timeout)
+                    if 'error' in article:
+                        logging.warning('Processing article error, Url = %s', link)
+                        failed_web_ids.append(article_id)
+                    else:
+                        article_list.append(article)
+                    time.sleep(self.DELAY_TIME)
+                except Exception:
+                    ARTICLES.inc(result='error')
+                    logging.exception(
+                        'Processing article error, Url = %s', link)
+                    failed_web_ids.append(article_id)
+            if article_list or failed_web_ids:
+                self.writer.put(self._output_tail_page, article_list, failed_web_ids)
+            if article_list and self.json_output:
+                self._output_json(article_list, index)
+
+        logging.info('Tail of %s: %d new articles, index %s -> %d',
+                     self.board, sum(len(link_list) for _, link_list in pages),
+                     board.tail_index, newest_index)
+        self.writer.put(self._output_tail, board.id, newest_index, newest_web_id)
+
+    def _iter_web_id_pages(self, board: Board) -> Iterator[List[str]]:
+        """Web ids to crawl from the database, keyset paginated by web_id"""
+        if self.upgrade_action and self.hot:
+            scheduler = RecrawlScheduler.from_config(self.db_session, board.id, self.article_config)
+            # hottest first
+            web_id_list = scheduler.next_batch(self.article_config.getint('HotBatchSize', fallback=100))
+            if self.since_date:
+                web_id_list = [web_id for web_id in web_id_list if not self._is_before_since_date(web_id)]
+            yield web_id_list
+            return
+
+        since_ranges = web_id_ranges(self.since_date) if self.since_date else []
+        last_web_id = None
+        while True:
+            if self.upgrade_action:
+                query = self.db_session \
+                    .query(ArticleIndex.web_id) \
+                    .join(Article, ArticleIndex.web_id == Article.web_id) \
+                    .filter(Article.board_id == board.id)
+            else:
+                query = self.db_session \
+                    .query(ArticleIndex.web_id) \
+                    .outerjoin(Article, ArticleIndex.web_id == Article.web_id) \
+                    .filter(Article.id.is_(None), ArticleIndex.board_id == board.id)
+            if since_ranges:
+                query = query.filter(or_(*[ArticleIndex.web_id.between(first, last)
+                                           for first, last in since_ranges]))
+            if last_web_id is not None:
+                query = query.filter(ArticleIndex.web_id > last_web_id)
+            web_id_list = [web_id for web_id, in
+                           query.order_by(ArticleIndex.web_id).limit(self.DB_PAGE_SIZE)]
+            if not web_id_list:
+                return
+            last_web_id = web_id_list[-1]
+            if self.since_date:
+                # the ranges let older web ids of shorter epochs through
+                web_id_list = [web_id for web_id in web_id_list if not self._is_before_since_date(web_id)]
+            if web_id_list:
+                yield web_id_list
+
+    @log()
+    def _crawling_from_db(self):
+        board, _ = self.db.get_or_create(self.db_session, Board, {
+                                         'name': self.board}, {'name': self.board})
 
-        if self.upgrade_action:
-            article_index_list = self.db_session \
-                .query(ArticleIndex)\
-                .filter(Article.board_id == board.id).all()
-        else:
-            article_index_list = self.db_session \
-                .query(ArticleIndex) \
-                .outerjoin(Article, ArticleIndex.web_id == Article.web_id) \
-                .filter(Article.id.is_(None), ArticleIndex.board_id == board.id).all()
-                # .filter(ArticleIndex.web_id.notin_(exist_article_list)).all()
         article_list = []
         count = 0
-        for article_index in article_index_list:
-            link = self.PTT_URL + \
-                self.PTT_Article_Format.format(board=article_index.board.name,
-                                               web_id=article_index.web_id)
-            logging.debug('Processing Url = %s', link)
-            article_id = article_index.web_id
-            try:
-                article_list.append(self.parse(link,
-                                            article_id,
-                                            self.board,
-                                            self.timeout))
-                count += 1
-                if count == 20:
-                    self._output_database(article_list)
-                    article_list = []
-                    count = 0
-            except Exception:
-                pass
-            finally:
-                time.sleep(self.DELAY_TIME)
-    
+        for web_id_list in self._iter_web_id_pages(board):
+            for article_id in web_id_list:
+                link = self.PTT_URL + \
+                    self.PTT_Article_Format.format(board=board.name,
+                                                   web_id=article_id)
+                logging.debug('Processing Url = %s', link)
+                try:
+                    article = self.parse(link,
+                                         article_id,
+                                         self.board,
+                                         self.timeout)
+                    if 'error' in article:
+                        logging.warning('Processing article error, Url = %s', link)
+                        continue
+                    article_list.append(article)
+                    count += 1
+                    if count == 20:
+                        self.writer.put(self._output_database, article_list)
+                        article_list = []
+                        count = 0
+                except Exception:
+                    ARTICLES.inc(result='error')
+                finally:
+                    time.sleep(self.DELAY_TIME)
+
         if article_list:
-            self._output_database(article_list)
+            self.writer.put(self._output_database, article_list)
+
+    @log()
+    def _enqueue_from_db(self):
+        """Queue the work list of --database for --worker crawlers, --upgrade
+        queues the done and failed jobs again"""
+        board, _ = self.db.get_or_create(self.db_session, Board, {
+                                         'name': self.board}, {'name': self.board})
+        count = 0
+        for web_id_list in self._iter_web_id_pages(board):
+            count += self.work_queue.enqueue(board.name, web_id_list, reset=self.upgrade_action)
+        logging.info('Queued %d jobs of %s, jobs by status: %s',
+                     count, board.name, self.work_queue.counts(board.name))
+
+    def _output_jobs(self, result: List[Dict[str, object]]):
+        """Write the articles of claimed jobs, complete the jobs once they are
+        committed and give the jobs of the failed records back for a retry"""
+        written_web_ids = set(self._output_database(result) or [])
+        failed_web_ids = [record['article_id'] for record in result
+                          if record['article_id'] not in written_web_ids]
+        # the queue may share the database, its writes wait for the batch
+        if failed_web_ids:
+            self.group_commit.after_commit(partial(self.work_queue.fail, failed_web_ids))
+        self.group_commit.after_commit(partial(self.work_queue.complete, sorted(written_web_ids)))
+
+    @log()
+    def _crawling_worker(self):
+        """Crawl the jobs of the work queue until none are left, or forever
+        with a `[WorkQueue] PollInterval`.
+
+        Jobs are completed once their articles are committed. While leases of
+        other workers are held, their jobs may come back, so the worker waits
+        for them before it stops.
+        """
+        batch_size = self.config.getint('WorkQueue', 'BatchSize', fallback=20)
+        poll_interval = self.config.getfloat('WorkQueue', 'PollInterval', fallback=0)
+        crawled = failed = 0
+        while True:
+            web_id_list = self.work_queue.claim(self.board, batch_size)
+            if not web_id_list:
+                if poll_interval <= 0 and not self.work_queue.has_leased(self.board):
+                    break
+                time.sleep(poll_interval or self.NEXT_PAGE_DELAY_TIME)
+                self.work_queue.heartbeat()
+                continue
+
+            article_list = []
+            failed_web_ids = []
+            for article_id in web_id_list:
+                link = self.PTT_URL + \
+                    self.PTT_Article_Format.format(board=self.board,
+                                                   web_id=article_id)
+                logging.debug('Processing Url = %s', link)
+                try:
+                    article = self.parse(link,
+                                         article_id,
+                                         self.board,
+                                         self.timeout)
+                    if 'error' in article:
+                        logging.warning('Processing article error, Url = %s', link)
+                        failed_web_ids.append(article_id)
+                    else:
+                        article_list.append(article)
+                except Exception:
+                    ARTICLES.inc(result='error')
+                    logging.exception('Processing article error, Url = %s', link)
+                    failed_web_ids.append(article_id)
+                finally:
+                    time.sleep(self.DELAY_TIME)
+                    self.work_queue.heartbeat()
+
+            if failed_web_ids:
+                self.work_queue.fail(failed_web_ids)
+            done_web_ids = [article['article_id'] for article in article_list]
+            if self.json_output and article_list:
+                self._output_json(article_list, done_web_ids[0])
+            if self.database_output:
+                self.writer.put(self._output_jobs, article_list)
+            else:
+                self.work_queue.complete(done_web_ids)
+            crawled += len(done_web_ids)
+            failed += len(failed_web_ids)
+
+        logging.info('Worker %s crawled %d articles of %s, %d failed',
+                     self.work_queue.worker_id, crawled, self.board, failed)
 
 
 def parse_args() -> Dict[str, str]:
@@ -563,6 +932,8 @@ def parse_args() -> Dict[str, str]:
     add_article_arg_parser(parser)
 
     args = parser.parse_args()
+    if args.enqueue and not args.database:
+        parser.error('--enqueue requires --database')
     arguments = vars(args)
     return arguments
 
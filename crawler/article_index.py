@@ -13,6 +13,8 @@ from models import ArticleIndex, Board, PttDatabase
 from utils import load_config, log
 
 from .crawler_arg import add_article_index_arg_parser, get_base_parser
+from .metrics import DB_WRITE_SECONDS, HTTP_REQUEST_SECONDS, HTTP_REQUESTS, INDEX_PAGES
+from .writer import PttDatabaseWriter
 
 
 class PttArticleIndexCrawler(object):
@@ -65,9 +67,9 @@ class PttArticleIndexCrawler(object):
             self.article_config['NextPageDelaytime'])
 
     def _init_database(self):
-        self.db = PttDatabase(dbtype=self.database_config['Type'],
-                              dbname=self.database_config['Name'])
+        self.db = PttDatabase.from_config(self.database_config)
         self.db_session = self.db.get_session()
+        self.writer = PttDatabaseWriter.from_config(self.db, self.database_config, name='article_index')
 
     def _getDBLastPage(self):
         board, _ = self.db.get_or_create(self.db_session,
@@ -107,9 +109,17 @@ class PttArticleIndexCrawler(object):
 
     @log('Output_Database')
     def _output_database(self, result: List[Dict[str, object]]):
-        self.db.bulk_update(self.db_session, ArticleIndex, result)
+        with DB_WRITE_SECONDS.time(writer='article_index'), \
+                self.writer.group_commit.record(count=len(result)):
+            self.db.bulk_copy_upsert(self.writer.session, ArticleIndex, result, auto_commit=False)
 
     def crawling(self):
+        try:
+            self._crawling()
+        finally:
+            self.writer.close()
+
+    def _crawling(self):
         board = self.db.get(self.db_session,
                             Board,
                             {'name': self.board_name})
@@ -123,10 +133,16 @@ class PttArticleIndexCrawler(object):
             logging.info('Processing index: %d, Url = %s',
                          self.end_index, ptt_index_url)
 
-            resp = requests.get(url=ptt_index_url,
-                                headers=self.headers,
-                                cookies=self.cookies,
-                                timeout=None)
+            try:
+                with HTTP_REQUEST_SECONDS.time(kind='index'):
+                    resp = requests.get(url=ptt_index_url,
+                                        headers=self.headers,
+                                        cookies=self.cookies,
+                                        timeout=None)
+            except requests.RequestException:
+                HTTP_REQUESTS.inc(kind='index', status='error')
+                raise
+            HTTP_REQUESTS.inc(kind='index', status=resp.status_code)
             self.cookies = resp.cookies
             self.cookies['over18'] = '1'
 
@@ -168,7 +184,8 @@ class PttArticleIndexCrawler(object):
                     logging.exception(
                         'Processing article error, Url = %s', link)
 
-            self._output_database(article_list)
+            INDEX_PAGES.inc(crawler='article_index')
+            self.writer.put(self._output_database, article_list)
 
             self.end_index -= 1
             time.sleep(self.NEXT_PAGE_DELAY_TIME)
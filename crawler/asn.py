@@ -1,67 +1,433 @@
 import argparse
 import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional
 
 from ipwhois.asn import IPASN
+from ipwhois.exceptions import ASNLookupError
+from ipwhois.experimental import get_bulk_asn_whois
 from ipwhois.net import Net
+from sqlalchemy import or_
 
-from models import IpAsn, PttDatabase
+from models import IpAddress, IpAsn, PttDatabase
 from utils import load_config, log
 
+from .asn_cache import IpAsnCache
+from .asn_prefix import PrefixDict, PrefixTable
 from .crawler_arg import add_asn_arg_parser, get_base_parser
+from .metrics import (ASN_ENRICHMENT_QUEUE_DEPTH, ASN_LOOKUP_SECONDS, ASN_LOOKUPS, DB_WRITE_ERRORS,
+                      DB_WRITE_SECONDS)
+from .writer import PttDatabaseWriter
 
 
 class PttIpAsnCrawler(object):
+    WORKERS = 4
+    BULK_SIZE = 100
+    BATCH_SIZE = 1000
+    TIMEOUT = 30
+
     def __init__(self, arguments: Dict):
         self.db_input = arguments['database'] or False
-        self.ip_list = ('' if self.db_input else arguments['ip_list'])
+        self.pending_input = arguments['pending'] or False
+        self.build_prefix_table = arguments['build_prefix_table'] or False
+        self.rib_file = arguments['rib_file']
+        self.ip_list = arguments['ip_list'] or ''
 
         config_path = (arguments['config_path'] or 'config.ini')
         self.config = load_config(config_path)
         self.database_config = self.config['Database']
 
+        self._init_config()
         self._init_database()
+        self._init_prefix_table()
+        self.cache = IpAsnCache(self.db, self.db_session,
+                                ttl_days=self.refresh_days,
+                                retry_minutes=self.retry_minutes,
+                                retry_max_days=self.retry_max_days)
 
         if arguments['verbose']:
             logging.getLogger().setLevel(logging.DEBUG)
 
+    def _init_config(self):
+        self.WORKERS = self.config.getint('IpAsn', 'Workers', fallback=self.WORKERS)
+        self.BULK_SIZE = self.config.getint('IpAsn', 'BulkSize', fallback=self.BULK_SIZE)
+        self.BATCH_SIZE = self.config.getint('IpAsn', 'BatchSize', fallback=self.BATCH_SIZE)
+        self.TIMEOUT = self.config.getint('IpAsn', 'Timeout', fallback=self.TIMEOUT)
+        self.refresh_days = self.config.getint('IpAsn', 'RefreshDays', fallback=0)
+        self.retry_minutes = self.config.getint('IpAsn', 'RetryMinutes', fallback=60)
+        self.retry_max_days = self.config.getint('IpAsn', 'RetryMaxDays', fallback=30)
+        self.prefix_table_path = self.config.get('IpAsn', 'PrefixTable', fallback='')
+
     def _init_database(self):
-        self.db = PttDatabase(dbtype=self.database_config['Type'],
-                              dbname=self.database_config['Name'])
+        self.db = PttDatabase.from_config(self.database_config)
         self.db_session = self.db.get_session()
 
-    def _get_ip_list(self):
-        if self.db_input:
-            return list(map(lambda ipasn: str(ipasn.ip),
-                            self.db_session.query(IpAsn).order_by(IpAsn.asn).all()))
+    def _init_prefix_table(self):
+        self.prefix_table = None
+        if self.prefix_table_path and os.path.exists(self.prefix_table_path) \
+                and not self.build_prefix_table:
+            self.prefix_table = PrefixTable.load(self.prefix_table_path)
+            logging.info('Prefix table loaded: %d intervals', len(self.prefix_table))
+
+    def _init_cidr_table(self):
+        """In-memory index of the CIDRs of ips resolved by a real lookup.
+
+        The CIDRs stored so far are a `PrefixTable` built once, those resolved
+        during the run are added to a `PrefixDict`.
+        """
+        cidr_records = {}
+        query = self.db_session \
+            .query(IpAsn.asn, IpAsn.asn_cidr, IpAsn.asn_country_code, IpAsn.asn_date,
+                   IpAsn.asn_description, IpAsn.asn_registry) \
+            .filter(IpAsn.asn.isnot(None),
+                    IpAsn.asn_cidr.isnot(None),
+                    or_(IpAsn.asn_inferred.is_(None), IpAsn.asn_inferred.is_(False)))
+        for asn, asn_cidr, asn_country_code, asn_date, asn_description, asn_registry in query:
+            record = {'asn': asn,
+                      'asn_country_code': asn_country_code,
+                      'asn_date': str(asn_date or '')[:10],
+                      'asn_description': asn_description,
+                      'asn_registry': asn_registry}
+            # Whois may answer several CIDRs for one IP
+            for cidr in (asn_cidr or '').split(','):
+                if cidr.strip():
+                    cidr_records[cidr.strip()] = record
+        self.cidr_table = PrefixTable.from_prefixes(cidr_records.items())
+        self.run_cidrs = PrefixDict()
+        logging.info('CIDR table loaded: %d intervals', len(self.cidr_table))
+
+    def _add_cidr_records(self, records: Iterable[Dict[str, object]]):
+        for record in records:
+            record = dict(record, asn_date=str(record.get('asn_date') or '')[:10])
+            for cidr in (record['asn_cidr'] or '').split(','):
+                if cidr.strip():
+                    self.run_cidrs.add(cidr, record)
+
+    def _lookup_cidrs(self, ip: str) -> Optional[Dict[str, object]]:
+        """Most specific of the stored and the run CIDRs covering `ip`"""
+        results = [result for result in (self.cidr_table.lookup(ip), self.run_cidrs.lookup(ip)) if result]
+        if not results:
+            return None
+        return max(results, key=lambda result: int(result['asn_cidr'].rsplit('/', 1)[1]))
+
+    def _get_ip_list(self) -> List[str]:
+        if self.pending_input:
+            # Unresolved IPs due for a retry, and resolved IPs older than RefreshDays
+            return [ip for ip, in self.db_session.query(IpAsn.ip)
+                    .filter(self.cache.due_condition())
+                    .order_by(IpAsn.ip)]
+        elif self.db_input:
+            return [ip for ip, in self.db_session.query(IpAsn.ip).order_by(IpAsn.asn)]
         else:
-            return self.ip_list.split(',')
+            return [IpAddress.normalize(ip) for ip in self.ip_list.split(',')]
+
+    @staticmethod
+    def _parse_asn_date(asn_date: str):
+        try:
+            return datetime.strptime(asn_date, '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return None
+
+    def _lookup_bulk(self, ip_list: List[str]) -> Dict[str, Dict[str, object]]:
+        """Lookup with Team Cymru bulk whois, one round-trip for the whole list.
+
+        Response lines are `AS | IP | BGP Prefix | CC | Registry | Allocated | AS Name`,
+        IPs which are not announced come back with `NA` and are left out.
+        """
+        try:
+            with ASN_LOOKUP_SECONDS.time(method='bulk'):
+                response = get_bulk_asn_whois(ip_list, retry_count=1, timeout=self.TIMEOUT)
+        except (ASNLookupError, ValueError) as e:
+            ASN_LOOKUPS.inc(len(ip_list), method='bulk', result='error')
+            logging.warning('ASN bulk lookup failed: %s', e)
+            return {}
+
+        ip_set = set(ip_list)
+        results = {}
+        for line in response.splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) < 7 or fields[0] in ('AS', 'NA') or fields[1] not in ip_set:
+                continue
+            results[fields[1]] = {'asn': fields[0],
+                                  'asn_cidr': fields[2],
+                                  'asn_country_code': fields[3].upper(),
+                                  'asn_registry': fields[4],
+                                  'asn_date': fields[5],
+                                  'asn_description': '|'.join(fields[6:])}
+        ASN_LOOKUPS.inc(len(results), method='bulk', result='hit')
+        ASN_LOOKUPS.inc(len(ip_set) - len(results), method='bulk', result='miss')
+        return results
+
+    def _lookup(self, ip: str) -> Dict[str, object]:
+        try:
+            with ASN_LOOKUP_SECONDS.time(method='single'):
+                result = IPASN(Net(ip)).lookup(retry_count=1)
+            ASN_LOOKUPS.inc(method='single', result='hit')
+            return result
+        except Exception as e:
+            ASN_LOOKUPS.inc(method='single', result='error')
+            logging.warning('ASN lookup failed, ip = %s: %s', ip, e)
+            return None
+
+    def _build_row(self, ip: str, result: Dict[str, object], lookup_datetime: datetime,
+                   inferred: bool = False) -> Dict[str, object]:
+        return {'ip': ip,
+                'asn': result.get('asn'),
+                'asn_cidr': result.get('asn_cidr'),
+                'asn_country_code': result.get('asn_country_code'),
+                'asn_date': self._parse_asn_date(result.get('asn_date')),
+                'asn_description': result.get('asn_description'),
+                'asn_registry': result.get('asn_registry'),
+                'lookup_datetime': lookup_datetime,
+                'asn_inferred': inferred,
+                'lookup_failures': 0,
+                'retry_datetime': None}
+
+    def _resolve_chunk(self, ip_list: List[str]) -> List[Dict[str, object]]:
+        lookup_datetime = datetime.now()
+        bulk_results = self._lookup_bulk(ip_list)
+
+        ip_result = []
+        for ip in ip_list:
+            result = bulk_results.get(ip) or self._lookup(ip)
+            if not result:
+                continue
+            ip_result.append(self._build_row(ip, result, lookup_datetime))
+        return ip_result
+
+    def _resolve_offline(self, ip_list: List[str], lookup_datetime: datetime):
+        """Resolve from the prefix table and the CIDRs of resolved ips, returns (results, misses)"""
+        ip_result = []
+        miss_list = []
+        for ip in ip_list:
+            for lookup in (self.prefix_table.lookup if self.prefix_table else None, self._lookup_cidrs):
+                # Records without country code (e.g. ASN not seen in ip_asn yet) go to the network
+                result = lookup(ip) if lookup else None
+                if result and result.get('asn_country_code'):
+                    ip_result.append(self._build_row(ip, result, lookup_datetime, inferred=True))
+                    break
+            else:
+                miss_list.append(ip)
+        ASN_LOOKUPS.inc(len(ip_result), method='offline', result='hit')
+        ASN_LOOKUPS.inc(len(miss_list), method='offline', result='miss')
+        return ip_result, miss_list
+
+    def _resolve_network(self, executor: ThreadPoolExecutor, ip_list: List[str]) -> List[Dict[str, object]]:
+        chunks = [ip_list[i:i + self.BULK_SIZE]
+                  for i in range(0, len(ip_list), self.BULK_SIZE)]
+        ip_result = []
+        for results in executor.map(self._resolve_chunk, chunks):
+            ip_result.extend(results)
+        self._add_cidr_records(ip_result)
+        return ip_result
+
+    def _resolve(self, executor: ThreadPoolExecutor, ip_list: List[str]) -> List[Dict[str, object]]:
+        lookup_datetime = datetime.now()
+        ip_result, miss_list = self._resolve_offline(ip_list, lookup_datetime)
+
+        # Lookup one ip of each /24 first, the others are usually covered by its CIDR
+        block_ips = OrderedDict()
+        for ip in miss_list:
+            block_ips.setdefault(ip.rsplit('.', 1)[0], ip)
+        block_ip_list = list(block_ips.values())
+        ip_result += self._resolve_network(executor, block_ip_list)
+
+        block_ip_set = set(block_ip_list)
+        offline_result, miss_list = self._resolve_offline([ip for ip in miss_list if ip not in block_ip_set],
+                                                          lookup_datetime)
+        ip_result += offline_result
+        ip_result += self._resolve_network(executor, miss_list)
+
+        logging.debug('Inferred %d, looked up %d',
+                      sum(1 for row in ip_result if row['asn_inferred']),
+                      sum(1 for row in ip_result if not row['asn_inferred']))
+        return ip_result
 
     @log('Output_Database')
-    def _output_database(self, result: List[Dict[str, str]]):
-        self.db.bulk_update(self.db_session, IpAsn, result)
+    def _output_database(self, result: List[Dict[str, object]]):
+        try:
+            with DB_WRITE_SECONDS.time(writer='asn'):
+                self.db.bulk_copy_upsert(self.db_session, IpAsn, result)
+        except Exception:
+            DB_WRITE_ERRORS.inc(writer='asn')
+            self.db_session.rollback()
+            raise
+
+    def _resolve_rows(self, executor: ThreadPoolExecutor, ip_list: List[str]) -> List[Dict[str, object]]:
+        """Rows of `ip_list`, the failure rows of the ips which are not resolved included"""
+        ip_result = self._resolve(executor, ip_list)
+
+        resolved_ip_set = {row['ip'] for row in ip_result}
+        ip_result += self.cache.failure_rows([ip for ip in ip_list if ip not in resolved_ip_set],
+                                             datetime.now())
+        return ip_result
+
+    def _resolve_batch(self, executor: ThreadPoolExecutor, ip_list: List[str]):
+        self._output_database(self._resolve_rows(executor, ip_list))
+
+    @log('Build_Prefix_Table')
+    def _build_prefix_table(self):
+        """Write the prefix table from `--rib-file`, or from the CIDRs stored in ip_asn"""
+        if not self.prefix_table_path:
+            raise ValueError('PrefixTable is not set in [IpAsn] config')
+
+        asn_records = {}
+        cidr_records = {}
+        query = self.db_session \
+            .query(IpAsn.asn, IpAsn.asn_cidr, IpAsn.asn_country_code, IpAsn.asn_date,
+                   IpAsn.asn_description, IpAsn.asn_registry) \
+            .filter(IpAsn.asn.isnot(None), IpAsn.asn_cidr.isnot(None))
+        for asn, asn_cidr, asn_country_code, asn_date, asn_description, asn_registry in query:
+            record = {'asn': asn,
+                      'asn_country_code': asn_country_code,
+                      'asn_date': str(asn_date or '')[:10],
+                      'asn_description': asn_description,
+                      'asn_registry': asn_registry}
+            asn_records[asn] = record
+            # Whois may answer several CIDRs for one IP
+            for cidr in asn_cidr.split(','):
+                cidr_records[cidr.strip()] = record
+
+        if self.rib_file:
+            prefix_table = PrefixTable.from_pyasn(self.rib_file, asn_records)
+        else:
+            prefix_table = PrefixTable.from_prefixes(cidr_records.items())
+        prefix_table.save(self.prefix_table_path)
+        logging.info('Prefix table saved: %d intervals, path = %s',
+                     len(prefix_table), self.prefix_table_path)
 
     @log()
     def crawling(self):
-        ip_list = self._get_ip_list()
+        if self.build_prefix_table:
+            self._build_prefix_table()
+            return
 
-        ip_result = []
+        ip_list = list(OrderedDict.fromkeys(ip for ip in self._get_ip_list() if ip))
+        ip_list = self.cache.filter(ip_list)
+        self._init_cidr_table()
+        logging.info('Resolving %d ips', len(ip_list))
+
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            for i in range(0, len(ip_list), self.BATCH_SIZE):
+                self._resolve_batch(executor, ip_list[i:i + self.BATCH_SIZE])
+                logging.info('Resolved %d/%d ips', min(i + self.BATCH_SIZE, len(ip_list)), len(ip_list))
+
+        self.cache.log_stats()
+
+
+class PttIpAsnEnricher(threading.Thread):
+    """Background consumer resolving the ips seen by the crawler write paths.
+
+    Write paths `enqueue` the unresolved ips they store, the thread resolves
+    them in batches of `batch_size`, or whatever is queued after `interval`
+    seconds, with its own `PttIpAsnCrawler`. The crawler session of the thread
+    only reads, the rows are written by `writer`, the single writer of the
+    crawler, in its group commit. `close` resolves what is still queued for
+    up to `drain_seconds`. Ips left in the queue then, or dropped because the
+    queue is full, stay unresolved for `crawler asn --pending`.
+    """
+
+    QUEUE_SIZE = 100000
+
+    def __init__(self, config_path: str, writer: PttDatabaseWriter, batch_size: int = 100,
+                 interval: float = 30, drain_seconds: float = 60):
+        super().__init__(name='PttIpAsnEnricher', daemon=True)
+        self.crawler = PttIpAsnCrawler({'config_path': config_path,
+                                        'database': False,
+                                        'pending': False,
+                                        'ip_list': None,
+                                        'build_prefix_table': False,
+                                        'rib_file': None,
+                                        'verbose': False})
+        self.writer = writer
+        self.batch_size = batch_size
+        self.interval = interval
+        self.drain_seconds = drain_seconds
+        self.queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self._stop_event = threading.Event()
+        self._drain_deadline = None
+
+    @classmethod
+    def from_config(cls, config_path: str, config, writer: PttDatabaseWriter) -> Optional['PttIpAsnEnricher']:
+        """Started enricher when `[IpAsn] Enrichment` is on, else None"""
+        if not config.getboolean('IpAsn', 'Enrichment', fallback=False):
+            return None
+        enricher = cls(config_path,
+                       writer,
+                       batch_size=config.getint('IpAsn', 'EnrichmentBatchSize', fallback=100),
+                       interval=config.getfloat('IpAsn', 'EnrichmentInterval', fallback=30),
+                       drain_seconds=config.getfloat('IpAsn', 'EnrichmentDrainSeconds', fallback=60))
+        enricher.start()
+        return enricher
+
+    def enqueue(self, ip_list: Iterable[str]):
         for ip in ip_list:
-            if ip:
-                net = Net(ip)
-                obj = IPASN(net)
-                result = {'ip': ip}
-                result.update(obj.lookup())
-                result['asn_date'] = datetime.strptime(result['asn_date'],
-                                                       '%Y-%m-%d')
-                ip_result.append(result)
-
-                if len(ip_result) % 100 == 0:
-                    self._output_database(ip_result)
-                    ip_result = []
-
-        self._output_database(ip_result)
+            try:
+                self.queue.put_nowait(ip)
+            except queue.Full:
+                logging.warning('ASN enrichment queue is full, ip = %s is left for --pending', ip)
+                break
+        ASN_ENRICHMENT_QUEUE_DEPTH.set(self.queue.qsize())
+
+    def _take_batch(self) -> List[str]:
+        ip_list = []
+        deadline = time.time() + self.interval
+        while len(ip_list) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                ip_list.append(self.queue.get(timeout=min(timeout, 1)))
+            except queue.Empty:
+                if self._stop_event.is_set():
+                    break
+        ASN_ENRICHMENT_QUEUE_DEPTH.set(self.queue.qsize())
+        return ip_list
+
+    def _is_drained(self) -> bool:
+        if not self._stop_event.is_set():
+            return False
+        return self.queue.empty() or time.monotonic() >= self._drain_deadline
+
+    def _output_database(self, result: List[Dict[str, object]]):
+        try:
+            with self.writer.group_commit.record(), DB_WRITE_SECONDS.time(writer='asn'):
+                self.crawler.db.bulk_copy_upsert(self.writer.session, IpAsn, result, auto_commit=False)
+        except Exception:
+            DB_WRITE_ERRORS.inc(writer='asn')
+            logging.exception('ASN enrichment write failed, %d rows', len(result))
+
+    def run(self):
+        self.crawler._init_cidr_table()
+        with ThreadPoolExecutor(max_workers=self.crawler.WORKERS) as executor:
+            while not self._is_drained():
+                ip_list = list(OrderedDict.fromkeys(self._take_batch()))
+                try:
+                    ip_list = self.crawler.cache.filter(ip_list)
+                    if not ip_list:
+                        continue
+                    self.writer.put(self._output_database, self.crawler._resolve_rows(executor, ip_list))
+                    logging.info('ASN enrichment resolved %d ips', len(ip_list))
+                except Exception:
+                    self.crawler.db_session.rollback()
+                    logging.exception('ASN enrichment failed, ip_list = %s', ip_list)
+        if not self.queue.empty():
+            logging.warning('ASN enrichment stopped, %d queued ips are left for --pending', self.queue.qsize())
+        self.crawler.cache.log_stats()
+
+    def close(self):
+        """Resolve what is still queued, for up to `drain_seconds`, and stop.
+        The writer is still open, it writes the last rows."""
+        self._drain_deadline = time.monotonic() + self.drain_seconds
+        self._stop_event.set()
+        self.join()
+        self.crawler.db_session.close()
 
 
 def parse_args() -> Dict[str, str]:
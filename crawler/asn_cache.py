@@ -0,0 +1,114 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from sqlalchemy import and_, or_
+
+from models import IpAsn, PttDatabase
+
+
+class IpAsnCache(object):
+    """Lookup cache on top of the ip_asn rows.
+
+    A resolved ip is a hit while its `lookup_datetime` is younger than
+    `ttl_days` (0 = never expires). A failed ip is a negative hit until its
+    `retry_datetime`, the retry delay doubles with every failure from
+    `retry_minutes` up to `retry_max_days`. An expired ip whose refresh failed
+    keeps its answer and waits for its `retry_datetime` the same way.
+    """
+
+    def __init__(self, db: PttDatabase, session, ttl_days: int = 0,
+                 retry_minutes: int = 60, retry_max_days: int = 30):
+        self.db = db
+        self.session = session
+        self.ttl_days = ttl_days
+        self.retry_minutes = retry_minutes
+        self.retry_max_days = retry_max_days
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.expired = 0
+        self.misses = 0
+        self._failures = {}
+
+    def _expired_before(self, now: datetime):
+        return (now - timedelta(days=self.ttl_days)) if self.ttl_days > 0 else None
+
+    def due_condition(self, now: datetime = None):
+        """SQL condition of the ip_asn rows which need a lookup"""
+        now = now or datetime.now()
+        condition = [and_(IpAsn.asn.is_(None),
+                          or_(IpAsn.retry_datetime.is_(None), IpAsn.retry_datetime <= now))]
+        expired_before = self._expired_before(now)
+        if expired_before:
+            condition += [and_(IpAsn.asn.isnot(None),
+                               or_(IpAsn.lookup_datetime.is_(None),
+                                   IpAsn.lookup_datetime < expired_before),
+                               or_(IpAsn.retry_datetime.is_(None), IpAsn.retry_datetime <= now))]
+        return or_(*condition)
+
+    def filter(self, ip_list: List[str]) -> List[str]:
+        """Returns the ips of `ip_list` which are not answered by the cache"""
+        now = datetime.now()
+        expired_before = self._expired_before(now)
+
+        rows = {}
+        for i in range(0, len(ip_list), self.db.IN_CHUNK_SIZE):
+            chunk = ip_list[i:i + self.db.IN_CHUNK_SIZE]
+            query = self.session \
+                .query(IpAsn.ip, IpAsn.asn, IpAsn.lookup_datetime,
+                       IpAsn.lookup_failures, IpAsn.retry_datetime) \
+                .filter(IpAsn.ip.in_(chunk))
+            for ip, asn, lookup_datetime, lookup_failures, retry_datetime in query:
+                rows[ip] = (asn, self._to_datetime(lookup_datetime), self._to_datetime(retry_datetime))
+                self._failures[ip] = lookup_failures or 0
+
+        miss_list = []
+        for ip in ip_list:
+            if ip not in rows:
+                self.misses += 1
+                miss_list.append(ip)
+                continue
+
+            asn, lookup_datetime, retry_datetime = rows[ip]
+            if asn is not None:
+                if retry_datetime and retry_datetime > now:
+                    self.negative_hits += 1
+                elif expired_before and (lookup_datetime is None or lookup_datetime < expired_before):
+                    self.expired += 1
+                    miss_list.append(ip)
+                else:
+                    self.hits += 1
+            elif retry_datetime and retry_datetime > now:
+                self.negative_hits += 1
+            else:
+                self.misses += 1
+                miss_list.append(ip)
+        return miss_list
+
+    def failure_rows(self, ip_list: List[str], lookup_datetime: datetime) -> List[Dict[str, object]]:
+        """ip_asn mappings recording failed lookups with their next retry time"""
+        rows = []
+        for ip in ip_list:
+            failures = self._failures.get(ip, 0) + 1
+            self._failures[ip] = failures
+            delay = min(timedelta(minutes=self.retry_minutes * (2 ** (failures - 1))),
+                        timedelta(days=self.retry_max_days))
+            rows.append({'ip': ip,
+                         'lookup_failures': failures,
+                         'retry_datetime': lookup_datetime + delay})
+        return rows
+
+    def log_stats(self):
+        logging.info('ASN cache: hits = %d, negative hits = %d, expired = %d, misses = %d',
+                     self.hits, self.negative_hits, self.expired, self.misses)
+
+    @staticmethod
+    def _to_datetime(value):
+        # MyDateTime hands back the raw string on SQLite
+        if isinstance(value, str):
+            try:
+                return datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                return None
+        return value
@@ -0,0 +1,218 @@
+import ipaddress
+import json
+import logging
+import mmap
+import struct
+from array import array
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class PrefixTable(object):
+    """Offline IPv4 prefix -> ASN record index with longest-prefix-match lookups.
+
+    Nested prefixes are flattened into non-overlapping [start, end] intervals
+    owned by the most specific prefix, so a lookup is one binary search over
+    `starts`. Each interval keeps the network and length of its prefix, and
+    the id of an ASN record shared by all prefixes with the same details.
+    The table is saved as `header | records json | interval arrays` and loaded
+    with mmap, the interval arrays are used in place without being parsed.
+    """
+
+    MAGIC = b'PTTPFX01'
+    HEADER = struct.Struct('<8sII')
+    ITEM_TYPE = 'I'
+    RECORD_FIELDS = ('asn', 'asn_country_code', 'asn_date',
+                     'asn_description', 'asn_registry')
+    ARRAY_COUNT = 5
+
+    def __init__(self, starts, ends, networks, prefixlens, record_ids,
+                 records: List[Dict[str, str]], buffer=None):
+        self.starts = starts
+        self.ends = ends
+        self.networks = networks
+        self.prefixlens = prefixlens
+        self.record_ids = record_ids
+        self.records = records
+        self._buffer = buffer
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_prefixes(cls, prefixes: Iterable[Tuple[str, Dict[str, str]]]) -> 'PrefixTable':
+        """Build from (cidr, record) pairs, IPv6 and invalid prefixes are skipped"""
+        records = []
+        record_index = {}
+        prefix_list = []
+        for cidr, record in prefixes:
+            try:
+                network = ipaddress.ip_network(cidr.strip(), strict=False)
+            except ValueError:
+                logging.debug('Invalid prefix %s', cidr)
+                continue
+            if network.version != 4:
+                continue
+            record = tuple(record.get(field) for field in cls.RECORD_FIELDS)
+            if record not in record_index:
+                record_index[record] = len(records)
+                records.append(dict(zip(cls.RECORD_FIELDS, record)))
+            prefix_list.append((int(network.network_address),
+                                int(network.broadcast_address),
+                                network.prefixlen,
+                                record_index[record]))
+
+        # Containing prefixes sort before the prefixes they contain
+        prefix_list.sort(key=lambda prefix: (prefix[0], prefix[2]))
+
+        arrays = [array(cls.ITEM_TYPE) for _ in range(cls.ARRAY_COUNT)]
+        starts, ends, networks, prefixlens, record_ids = arrays
+
+        def emit(start, end, prefix):
+            network, _, prefixlen, record_id = prefix
+            if start > end:
+                return
+            if ends and ends[-1] + 1 == start and networks[-1] == network \
+                    and prefixlens[-1] == prefixlen:
+                ends[-1] = end
+                return
+            starts.append(start)
+            ends.append(end)
+            networks.append(network)
+            prefixlens.append(prefixlen)
+            record_ids.append(record_id)
+
+        stack = []
+        position = 0
+        for prefix in prefix_list:
+            while stack and stack[-1][1] < prefix[0]:
+                top = stack.pop()
+                emit(position, top[1], top)
+                position = max(position, top[1] + 1)
+            if stack:
+                emit(position, prefix[0] - 1, stack[-1])
+            stack.append(prefix)
+            position = prefix[0]
+        while stack:
+            top = stack.pop()
+            emit(position, top[1], top)
+            position = max(position, top[1] + 1)
+
+        return cls(*arrays, records)
+
+    @classmethod
+    def from_pyasn(cls, path: str, asn_records: Dict[str, Dict[str, str]] = None) -> 'PrefixTable':
+        """Build from a pyasn style `prefix<TAB>asn` dump.
+
+        The dump only carries the ASN, the other fields are filled from
+        `asn_records` (asn -> record) when given.
+        """
+        asn_records = asn_records or {}
+
+        def prefixes():
+            with open(path, 'r', encoding='utf-8') as ribfile:
+                for line in ribfile:
+                    line = line.strip()
+                    if not line or line.startswith(';'):
+                        continue
+                    cidr, asn = line.split()[:2]
+                    record = dict(asn_records.get(asn, {}))
+                    record['asn'] = asn
+                    yield cidr, record
+
+        return cls.from_prefixes(prefixes())
+
+    def save(self, path: str):
+        records = json.dumps(self.records, ensure_ascii=False).encode('utf-8')
+        records += b' ' * (-len(records) % array(self.ITEM_TYPE).itemsize)
+        with open(path, 'wb') as tablefile:
+            tablefile.write(self.HEADER.pack(self.MAGIC, len(self.starts), len(records)))
+            tablefile.write(records)
+            for items in (self.starts, self.ends, self.networks, self.prefixlens, self.record_ids):
+                tablefile.write(array(self.ITEM_TYPE, items).tobytes())
+
+    @classmethod
+    def load(cls, path: str) -> 'PrefixTable':
+        with open(path, 'rb') as tablefile:
+            buffer = mmap.mmap(tablefile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, records_size = cls.HEADER.unpack_from(buffer, 0)
+        if magic != cls.MAGIC:
+            buffer.close()
+            raise ValueError('{path} is not a prefix table'.format(path=path))
+
+        offset = cls.HEADER.size
+        records = json.loads(buffer[offset:offset + records_size].decode('utf-8'))
+        offset += records_size
+
+        view = memoryview(buffer)
+        item_size = array(cls.ITEM_TYPE).itemsize
+        arrays = []
+        for _ in range(cls.ARRAY_COUNT):
+            arrays.append(view[offset:offset + count * item_size].cast(cls.ITEM_TYPE))
+            offset += count * item_size
+        return cls(*arrays, records, buffer=buffer)
+
+    def lookup(self, ip: str) -> Optional[Dict[str, str]]:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version != 4:
+            return None
+
+        value = int(address)
+        index = bisect_right(self.starts, value) - 1
+        if index < 0 or value > self.ends[index]:
+            return None
+        result = dict(self.records[self.record_ids[index]])
+        result['asn_cidr'] = '{network}/{prefixlen}'.format(network=ipaddress.IPv4Address(self.networks[index]),
+                                                            prefixlen=self.prefixlens[index])
+        return result
+
+
+class PrefixDict(object):
+    """Longest-prefix-match index of prefixes added one by one.
+
+    One dict of network -> record per prefix length, a lookup probes the
+    lengths in use from the longest. Adding a prefix is O(1), for the CIDRs
+    resolved during a run, where rebuilding a `PrefixTable` every batch would
+    be quadratic.
+    """
+
+    def __init__(self):
+        self.networks = {}
+
+    def __len__(self):
+        return sum(len(networks) for networks in self.networks.values())
+
+    def add(self, cidr: str, record: Dict[str, str]):
+        """Add an IPv4 prefix, IPv6 and invalid prefixes are skipped"""
+        try:
+            network = ipaddress.ip_network(cidr.strip(), strict=False)
+        except ValueError:
+            logging.debug('Invalid prefix %s', cidr)
+            return
+        if network.version != 4:
+            return
+        self.networks.setdefault(network.prefixlen, {})[int(network.network_address)] = \
+            {field: record.get(field) for field in PrefixTable.RECORD_FIELDS}
+
+    def lookup(self, ip: str) -> Optional[Dict[str, str]]:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version != 4:
+            return None
+
+        value = int(address)
+        for prefixlen in sorted(self.networks, reverse=True):
+            network = value & (0xFFFFFFFF << (32 - prefixlen)) & 0xFFFFFFFF
+            record = self.networks[prefixlen].get(network)
+            if record is not None:
+                result = dict(record)
+                result['asn_cidr'] = '{network}/{prefixlen}'.format(network=ipaddress.IPv4Address(network),
+                                                                    prefixlen=prefixlen)
+                return result
+        return None
@@ -0,0 +1,127 @@
+import hashlib
+import logging
+import math
+import threading
+from typing import Iterable, List, Set
+
+from sqlalchemy import func
+
+from models import Article, ArticleIndex, PttDatabase
+
+
+class BloomFilter(object):
+    """Bloom filter of strings, sized for `capacity` items at `error_rate`.
+
+    The `hash_count` bit positions of an item are derived from one blake2b
+    digest by double hashing.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class CrawledWebIds(object):
+    """Web ids of the crawled articles of a board, for the skip decisions of `--add`.
+
+    Boards with up to `set_limit` crawled articles are held in a set. Larger
+    boards are held in a Bloom filter, whose positives are confirmed with one
+    query per call of `missing`, so the answers are exact either way.
+    `refresh` loads the articles stored since the last refresh, the writer
+    `add`s the articles it commits.
+    """
+
+    FETCH_SIZE = 10000
+
+    def __init__(self, db: PttDatabase, session, board_id: int, set_limit: int = 1000000):
+        self.db = db
+        self.session = session
+        self.board_id = board_id
+        self.set_limit = set_limit
+        self.web_ids = None
+        self.last_article_id = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, db: PttDatabase, session, board_id: int, article_config) -> 'CrawledWebIds':
+        crawled = cls(db, session, board_id,
+                      set_limit=article_config.getint('CrawledSetLimit', fallback=1000000))
+        crawled.refresh()
+        return crawled
+
+    @property
+    def is_exact(self) -> bool:
+        return isinstance(self.web_ids, set)
+
+    def refresh(self):
+        if self.web_ids is None:
+            count = self.session.query(func.count(Article.id)) \
+                .filter(Article.board_id == self.board_id) \
+                .scalar()
+            if count > self.set_limit:
+                self.web_ids = BloomFilter(count * 2)
+                logging.info('Crawled web ids: %d articles, Bloom filter of %d KiB',
+                             count, len(self.web_ids.bits) // 1024)
+            else:
+                self.web_ids = set()
+
+        query = self.session.query(Article.id, Article.web_id) \
+            .filter(Article.board_id == self.board_id,
+                    Article.id > self.last_article_id) \
+            .order_by(Article.id) \
+            .yield_per(self.FETCH_SIZE)
+        with self._lock:
+            for article_id, web_id in query:
+                self.web_ids.add(web_id)
+                self.last_article_id = article_id
+
+    def add(self, web_ids: Iterable[str]):
+        with self._lock:
+            for web_id in web_ids:
+                self.web_ids.add(web_id)
+
+    def missing(self, web_ids: List[str]) -> List[str]:
+        """`web_ids` which are not crawled, in their order"""
+        candidates = [web_id for web_id in web_ids if web_id in self.web_ids]
+        if candidates and not self.is_exact:
+            crawled = set()
+            for i in range(0, len(candidates), self.db.IN_CHUNK_SIZE):
+                crawled.update(web_id for web_id, in self.session.query(Article.web_id)
+                               .filter(Article.web_id.in_(candidates[i:i + self.db.IN_CHUNK_SIZE])))
+            candidates = crawled
+        candidates = set(candidates)
+        return [web_id for web_id in web_ids if web_id not in candidates]
+
+    def crawled_pages(self) -> Set[int]:
+        """Index pages whose indexed articles are all crawled.
+
+        The last indexed page may have been indexed before it was full, it is
+        never part of the result.
+        """
+        pages = self.session.query(ArticleIndex.index) \
+            .outerjoin(Article, Article.web_id == ArticleIndex.web_id) \
+            .filter(ArticleIndex.board_id == self.board_id) \
+            .group_by(ArticleIndex.index) \
+            .having(func.count(Article.id) == func.count(ArticleIndex.web_id))
+        pages = {index for index, in pages}
+        if pages:
+            pages.discard(self.session.query(func.max(ArticleIndex.index))
+                          .filter(ArticleIndex.board_id == self.board_id)
+                          .scalar())
+        return pages
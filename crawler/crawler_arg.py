@@ -46,9 +46,19 @@ def add_article_arg_parser(parser: argparse.ArgumentParser):
                              nargs=2)
     input_group.add_argument('--database',
                              action='store_true')
+    input_group.add_argument('--tail',
+                             action='store_true',
+                             help='fetch the articles posted since the last --tail run')
+    input_group.add_argument('--worker',
+                             action='store_true',
+                             help='fetch the articles of the work queue, along with any number of other workers')
     parser.add_argument('--board-name',
                         type=str.lower,
                         required=True)
+    parser.add_argument('--since-date',
+                        type=valid_date_type,
+                        help='skip articles posted before "YYYY-MM-DD", '
+                             'by the post time of their web id, implied by --start-date')
     action_group = parser.add_mutually_exclusive_group(required=True)
     action_group.add_argument('--add',
                               action='store_false',
@@ -58,6 +68,12 @@ def add_article_arg_parser(parser: argparse.ArgumentParser):
                               action='store_true',
                               dest='upgrade',
                               help='upgrade existing article version')
+    parser.add_argument('--hot',
+                        action='store_true',
+                        help='with --database --upgrade, only re-crawl the articles due by their push velocity')
+    parser.add_argument('--enqueue',
+                        action='store_true',
+                        help='with --database, queue the articles for --worker instead of fetching them')
 
     # Output
     parser.add_argument('--json-folder',
@@ -73,6 +89,15 @@ def add_asn_arg_parser(parser: argparse.ArgumentParser):
     input_group.add_argument('--ip-list',
                              type=str)
     input_group.add_argument('--database', action='store_true')
+    input_group.add_argument('--pending',
+                             action='store_true',
+                             help='only lookup unresolved ips and ips older than RefreshDays')
+    input_group.add_argument('--build-prefix-table',
+                             action='store_true',
+                             help='build the offline prefix table from ip_asn or --rib-file')
+    parser.add_argument('--rib-file',
+                        type=str,
+                        help='pyasn style "prefix<TAB>asn" dump used by --build-prefix-table')
 
 
 def add_user_arg_parser(parser: argparse.ArgumentParser):
@@ -86,3 +111,9 @@ def add_user_arg_parser(parser: argparse.ArgumentParser):
     parser.add_argument('--json-prefix',
                         type=str,
                         default='')
+
+
+def add_prune_arg_parser(parser: argparse.ArgumentParser):
+    parser.add_argument('--board-name',
+                        type=str.lower,
+                        help='only rotate the article histories of this board')
@@ -0,0 +1,331 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# Seconds, from a cached page to a slow ptt.cc response or a large commit
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{name}="{value}"'.format(name=name, value=_escape(value))
+                          for name, value in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """Metric of the Prometheus text format, one series per set of label values"""
+
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{name} labels are {labelnames}, got {labels}'.format(
+                name=self.name, labelnames=self.labelnames, labels=sorted(labels)))
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._series.items()]
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {name} {doc}'.format(name=self.name, doc=self.documentation),
+                 '# TYPE {name} {type}'.format(name=self.name, type=self.TYPE)]
+        for name, labels, value in self.samples():
+            lines.append('{name}{labels} {value}'.format(name=name,
+                                                         labels=_format_labels(labels),
+                                                         value=_format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Observations counted in cumulative `le` buckets, with their sum and count"""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def totals(self, **labels) -> Tuple[float, int]:
+        """Sum and count of the observations"""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return (series[1], series[2]) if series else (0.0, 0)
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Estimate of the `q` quantile, interpolated in its bucket like
+        Prometheus `histogram_quantile`"""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            if not series or not series[2]:
+                return None
+            counts = list(series[0])
+            total = series[2]
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                upper = self.buckets[i]
+                lower = self.buckets[i - 1] if i else 0.0
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return None
+
+    def samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        with self._lock:
+            series = [(key, list(counts), total, count)
+                      for key, (counts, total, count) in self._series.items()]
+        samples = []
+        for key, counts, total, count in series:
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket', key + (('le', _format_value(upper)),), cumulative))
+            samples.append((self.name + '_sum', key, total))
+            samples.append((self.name + '_count', key, count))
+        return samples
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    @property
+    def metrics(self) -> List[Metric]:
+        with self._lock:
+            return list(self._metrics)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.counter('ptt_http_requests_total',
+                                 'Requests to ptt.cc by page kind and status code, error when none came back',
+                                 ('kind', 'status'))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram('ptt_http_request_seconds',
+                                          'Fetch latency of ptt.cc pages', ('kind',))
+PARSE_SECONDS = REGISTRY.histogram('ptt_parse_seconds',
+                                   'HTML parse time of an article')
+INDEX_PAGES = REGISTRY.counter('ptt_index_pages_total',
+                               'Index pages crawled', ('crawler',))
+ARTICLES = REGISTRY.counter('ptt_articles_total',
+                            'Articles fetched, by result', ('result',))
+USERS = REGISTRY.counter('ptt_users_total',
+                         'User last login records read, by result', ('result',))
+DB_WRITE_SECONDS = REGISTRY.histogram('ptt_db_write_seconds',
+                                      'Time of a database write batch', ('writer',))
+DB_WRITE_ERRORS = REGISTRY.counter('ptt_db_write_errors_total',
+                                   'Database write batches and article records which raised', ('writer',))
+DB_COMMIT_SECONDS = REGISTRY.histogram('ptt_db_commit_seconds',
+                                       'Time of a group commit')
+DB_COMMITTED_RECORDS = REGISTRY.counter('ptt_db_committed_records_total',
+                                        'Records committed by group commits')
+WRITER_QUEUE_DEPTH = REGISTRY.gauge('ptt_writer_queue_depth',
+                                    'Batches waiting for the database writer thread')
+BROWSER_SEND_KEYS_SECONDS = REGISTRY.histogram('ptt_browser_send_keys_seconds',
+                                               'Time of a PttBrowser.send_keys round trip, delay included')
+BROWSER_DISCONNECTS = REGISTRY.counter('ptt_browser_disconnects_total',
+                                       'PttBrowser connections lost')
+ASN_LOOKUPS = REGISTRY.counter('ptt_asn_lookups_total',
+                               'ASN lookups by method and result', ('method', 'result'))
+ASN_LOOKUP_SECONDS = REGISTRY.histogram('ptt_asn_lookup_seconds',
+                                        'Network ASN lookup latency', ('method',))
+ASN_ENRICHMENT_QUEUE_DEPTH = REGISTRY.gauge('ptt_asn_enrichment_queue_depth',
+                                            'Ips waiting for the background ASN enrichment')
+WORK_QUEUE_JOBS = REGISTRY.counter('ptt_work_queue_jobs_total',
+                                   'Work queue jobs of this worker, by action', ('action',))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Metrics %s - %s', self.address_string(), format % args)
+
+
+class MetricsExporter(object):
+    """Serves the metrics of `registry` over HTTP at `http://address:port/metrics`,
+    and/or writes them to `file_path` every `file_interval` seconds.
+
+    The file is replaced atomically, so it can be read by the node_exporter
+    textfile collector. It is written a last time on `close`.
+    """
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY, address: str = '127.0.0.1', port: int = 0,
+                 file_path: str = '', file_interval: float = 15):
+        self.registry = registry
+        self.file_path = file_path
+        self.file_interval = file_interval
+        self._server = None
+        self._threads = []
+        self._stop_event = threading.Event()
+        if port:
+            handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+            self._server = ThreadingHTTPServer((address, port), handler)
+            self._server.daemon_threads = True
+            self._threads.append(threading.Thread(target=self._server.serve_forever,
+                                                  name='MetricsServer', daemon=True))
+            logging.info('Metrics served on http://%s:%d/metrics', address, self._server.server_port)
+        if file_path:
+            self._threads.append(threading.Thread(target=self._run_file_writer,
+                                                  name='MetricsFileWriter', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    @classmethod
+    def from_config(cls, config) -> Optional['MetricsExporter']:
+        """Started exporter of the `[Metrics]` section, None when neither
+        `HttpPort` nor `File` is set"""
+        port = config.getint('Metrics', 'HttpPort', fallback=0)
+        file_path = config.get('Metrics', 'File', fallback='')
+        if not (port or file_path):
+            return None
+        return cls(address=config.get('Metrics', 'HttpAddress', fallback='127.0.0.1'),
+                   port=port,
+                   file_path=file_path,
+                   file_interval=config.getfloat('Metrics', 'FileInterval', fallback=15))
+
+    def write_file(self):
+        temp_path = '{path}.{pid}.tmp'.format(path=self.file_path, pid=os.getpid())
+        with open(temp_path, 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(self.registry.render())
+        os.replace(temp_path, self.file_path)
+
+    def _run_file_writer(self):
+        while not self._stop_event.wait(self.file_interval):
+            try:
+                self.write_file()
+            except OSError:
+                logging.exception('Metrics file write failed, path = %s', self.file_path)
+
+    def log_summary(self):
+        """Log count, p50 and p95 of every histogram series"""
+        for metric in self.registry.metrics:
+            if not isinstance(metric, Histogram):
+                continue
+            for name, labels, count in metric.samples():
+                if name != metric.name + '_count' or not count:
+                    continue
+                logging.info('Metrics %s%s: count = %d, p50 = %.3fs, p95 = %.3fs',
+                             metric.name, _format_labels(labels), count,
+                             metric.quantile(0.5, **dict(labels)), metric.quantile(0.95, **dict(labels)))
+
+    def close(self):
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self.file_path:
+            self.write_file()
+        self.log_summary()
@@ -0,0 +1,168 @@
+import argparse
+import logging
+import time
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from sqlalchemy import exists, func, select
+
+from models import Article, ArticleHistory, ArticleHistoryPush, Board, PttDatabase, Push
+from utils import load_config, log
+
+from .crawler_arg import add_prune_arg_parser, get_base_parser
+
+
+class HistoryPruner(object):
+    """Set based article history rotation.
+
+    Histories beyond the newest `version_rotate` versions of an article are
+    found with one `row_number()` window query per batch of articles, then
+    deleted with their push links and the push bodies no version links to
+    anymore. Every batch is its own transaction, `batch_delay` seconds between
+    batches leave room for other writers of the database.
+    """
+
+    def __init__(self, db: PttDatabase, session, version_rotate: int,
+                 batch_size: int = 500, batch_delay: float = 0.0):
+        self.db = db
+        self.session = session
+        self.version_rotate = version_rotate
+        self.batch_size = min(batch_size, db.IN_CHUNK_SIZE)
+        self.batch_delay = batch_delay
+
+    def _over_limit_histories(self, article_ids: List[int]) -> List[Tuple[int, int]]:
+        """(history id, article id) of the versions to rotate out"""
+        ranked = select([ArticleHistory.id.label('id'),
+                         ArticleHistory.article_id.label('article_id'),
+                         func.row_number().over(partition_by=ArticleHistory.article_id,
+                                                order_by=(ArticleHistory.start_at.desc(),
+                                                          ArticleHistory.id.desc())).label('version')]) \
+            .where(ArticleHistory.article_id.in_(article_ids)) \
+            .alias('ranked')
+        query = select([ranked.c.id, ranked.c.article_id]) \
+            .where(ranked.c.version > self.version_rotate)
+        return self.session.execute(query).fetchall()
+
+    def _delete_histories(self, history_ids: List[int], article_ids: List[int]):
+        for i in range(0, len(history_ids), self.db.IN_CHUNK_SIZE):
+            chunk = history_ids[i:i + self.db.IN_CHUNK_SIZE]
+            self.session.query(ArticleHistoryPush) \
+                .filter(ArticleHistoryPush.article_history_id.in_(chunk)) \
+                .delete(synchronize_session=False)
+            self.session.query(ArticleHistory) \
+                .filter(ArticleHistory.id.in_(chunk)) \
+                .delete(synchronize_session=False)
+        self.session.query(Push) \
+            .filter(Push.article_id.in_(article_ids),
+                    ~exists().where(ArticleHistoryPush.push_id == Push.id)) \
+            .delete(synchronize_session=False)
+
+    def _article_batches(self, board_id: int = None) -> Iterator[List[int]]:
+        """Keyset paginated article ids"""
+        last_id = None
+        while True:
+            query = self.session.query(Article.id)
+            if board_id is not None:
+                query = query.filter(Article.board_id == board_id)
+            if last_id is not None:
+                query = query.filter(Article.id > last_id)
+            article_ids = [article_id for article_id, in
+                           query.order_by(Article.id).limit(self.batch_size)]
+            if not article_ids:
+                return
+            yield article_ids
+            last_id = article_ids[-1]
+
+    def prune(self, article_ids: Iterable[int] = None, board_id: int = None) -> int:
+        """Rotate the histories of `article_ids`, or of every article (of `board_id`).
+
+        Returns the number of deleted histories.
+        """
+        if article_ids is not None:
+            article_ids = sorted(set(article_ids))
+            batches = (article_ids[i:i + self.batch_size]
+                       for i in range(0, len(article_ids), self.batch_size))
+        else:
+            batches = self._article_batches(board_id)
+
+        count = 0
+        for batch in batches:
+            rows = self._over_limit_histories(batch)
+            if not rows:
+                continue
+            try:
+                self._delete_histories([history_id for history_id, _ in rows],
+                                       sorted({article_id for _, article_id in rows}))
+                self.session.commit()
+            except Exception:
+                self.session.rollback()
+                raise
+            count += len(rows)
+            logging.debug('Pruned %d histories of %d articles', len(rows), len(batch))
+            if self.batch_delay:
+                time.sleep(self.batch_delay)
+        return count
+
+
+class PttHistoryPruner(object):
+    """Maintenance command rotating article histories left by `PruneInline = false`"""
+
+    @log('Initialize')
+    def __init__(self, arguments: Dict):
+        config_path = (arguments['config_path'] or 'config.ini')
+
+        self._init_config(config_path)
+        self._init_database()
+
+        self.board = arguments['board_name']
+
+        self.pruner = HistoryPruner(self.db, self.db_session,
+                                    self.VERSION_ROTATE,
+                                    batch_size=self.article_config.getint('PruneBatchSize', fallback=500),
+                                    batch_delay=self.article_config.getfloat('PruneBatchDelay', fallback=0.5))
+
+        if arguments['verbose']:
+            logging.getLogger().setLevel(logging.DEBUG)
+
+    def _init_config(self, config_path: str):
+        self.config = load_config(config_path)
+        self.article_config = self.config['PttArticle']
+        self.database_config = self.config['Database']
+
+        self.VERSION_ROTATE = int(self.article_config['VersionRotate']) or 30
+
+    def _init_database(self):
+        self.db = PttDatabase.from_config(self.database_config)
+        self.db_session = self.db.get_session()
+
+    @log()
+    def pruning(self):
+        board_id = None
+        if self.board:
+            board = self.db.get(self.db_session, Board, {'name': self.board})
+            if not board:
+                logging.warning('Board %s is not found', self.board)
+                return
+            board_id = board.id
+
+        count = self.pruner.prune(board_id=board_id)
+        logging.info('Pruned %d histories, VersionRotate = %d', count, self.VERSION_ROTATE)
+
+
+def parse_args() -> Dict[str, str]:
+    base_subparser = get_base_parser()
+    parser = argparse.ArgumentParser(parents=[base_subparser])
+    add_prune_arg_parser(parser)
+
+    args = parser.parse_args()
+    arguments = vars(args)
+    return arguments
+
+
+def main():
+    args = parse_args()
+    pruner = PttHistoryPruner(args)
+    pruner.pruning()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import heapq
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, or_, select, true
+
+from models import Article, ArticleHistory, ArticleHistoryPush
+from utils import PTT_TIMEZONE, web_id_ranges, web_id_timestamp
+
+
+class RecrawlScheduler(object):
+    """Push velocity based re-crawl order of the articles of a board.
+
+    The velocity of an article is the pushes per hour between its two latest
+    history versions, or since it was posted when it has one version. An
+    article is due `pushes_per_crawl / velocity` minutes after its latest
+    version, kept between `min_interval` and `max_interval` minutes. Articles
+    posted more than `max_age_days` ago are never re-crawled. Due articles are
+    taken from a heap, most pushes expected since their latest version first.
+
+    History versions start in host local time, `now` is host local time too,
+    the post time of a web_id is compared in it.
+    """
+
+    def __init__(self, session, board_id: int, min_interval: float = 10, max_interval: float = 1440,
+                 pushes_per_crawl: float = 20, max_age_days: float = 7):
+        self.session = session
+        self.board_id = board_id
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.pushes_per_crawl = pushes_per_crawl
+        self.max_age_days = max_age_days
+
+    @classmethod
+    def from_config(cls, session, board_id: int, article_config) -> 'RecrawlScheduler':
+        return cls(session, board_id,
+                   min_interval=article_config.getfloat('HotMinInterval', fallback=10),
+                   max_interval=article_config.getfloat('HotMaxInterval', fallback=1440),
+                   pushes_per_crawl=article_config.getfloat('HotPushesPerCrawl', fallback=20),
+                   max_age_days=article_config.getfloat('HotMaxAgeDays', fallback=7))
+
+    def _versions(self, now: datetime) -> Dict[str, List[Tuple[datetime, int]]]:
+        """(start_at, push count) of the two latest versions of the recent articles"""
+        # web ids encode Taiwan time
+        oldest = now - timedelta(days=self.max_age_days)
+        ranges = web_id_ranges(oldest.astimezone(PTT_TIMEZONE).replace(tzinfo=None))
+        ranked = select([Article.web_id.label('web_id'),
+                         ArticleHistory.id.label('id'),
+                         ArticleHistory.start_at.label('start_at'),
+                         func.row_number().over(partition_by=ArticleHistory.article_id,
+                                                order_by=(ArticleHistory.start_at.desc(),
+                                                          ArticleHistory.id.desc())).label('version')]) \
+            .select_from(Article.__table__.join(ArticleHistory.__table__,
+                                                ArticleHistory.article_id == Article.id)) \
+            .where(Article.board_id == self.board_id) \
+            .where(or_(*[Article.web_id.between(first, last) for first, last in ranges]) if ranges else true()) \
+            .alias('ranked')
+        query = select([ranked.c.web_id,
+                        ranked.c.start_at,
+                        func.count(ArticleHistoryPush.push_id)]) \
+            .select_from(ranked.outerjoin(ArticleHistoryPush.__table__,
+                                          ArticleHistoryPush.article_history_id == ranked.c.id)) \
+            .where(ranked.c.version <= 2) \
+            .group_by(ranked.c.web_id, ranked.c.id, ranked.c.start_at)
+
+        versions = defaultdict(list)
+        oldest_timestamp = oldest.timestamp()
+        for web_id, start_at, push_count in self.session.execute(query):
+            # the ranges let older web ids of shorter epochs through
+            if (web_id_timestamp(web_id) or 0) >= oldest_timestamp:
+                versions[web_id].append((start_at, push_count))
+        return versions
+
+    @staticmethod
+    def velocity(web_id: str, versions: List[Tuple[datetime, int]]) -> Optional[float]:
+        """Pushes per hour, None when it is unknown"""
+        versions = sorted(versions, reverse=True)
+        last_at, last_count = versions[0]
+        if len(versions) > 1:
+            previous_at, previous_count = versions[1]
+        else:
+            timestamp = web_id_timestamp(web_id)
+            if timestamp is None:
+                return None
+            previous_at, previous_count = datetime.fromtimestamp(timestamp), 0
+        hours = max((last_at - previous_at).total_seconds() / 3600, 1 / 60)
+        return max(last_count - previous_count, 0) / hours
+
+    def interval(self, velocity: Optional[float]) -> timedelta:
+        if not velocity:
+            minutes = self.max_interval
+        else:
+            minutes = min(max(self.pushes_per_crawl / velocity * 60, self.min_interval), self.max_interval)
+        return timedelta(minutes=minutes)
+
+    def next_batch(self, limit: int, now: datetime = None) -> List[str]:
+        """Web ids of the `limit` due articles, hottest first"""
+        now = now or datetime.now()
+        heap = []
+        versions = self._versions(now)
+        for web_id, article_versions in versions.items():
+            velocity = self.velocity(web_id, article_versions)
+            last_at = max(start_at for start_at, _ in article_versions)
+            if last_at + self.interval(velocity) > now:
+                continue
+            hours = (now - last_at).total_seconds() / 3600
+            expected = (velocity or 0) * hours
+            heapq.heappush(heap, (-expected, -hours, web_id))
+
+        due = len(heap)
+        batch = [heapq.heappop(heap)[2] for _ in range(min(limit, due))]
+        logging.info('Re-crawl: %d recent articles, %d due, %d taken',
+                     len(versions), due, len(batch))
+        return batch
@@ -7,15 +7,23 @@ import sys
 import time
 from typing import Dict, List
 import shutil
+from collections import OrderedDict
+from functools import partial
 from selenium.common.exceptions import WebDriverException
 from selenium.webdriver import Chrome, ChromeOptions
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.keys import Keys
 
-from models import IpAsn, PttDatabase, User, UserLastRecord
+from sqlalchemy import func, or_, select, union_all
+
+from models import (Article, ArticleHistory, ArticleHistoryPush, IpAddress, IpAsn,
+                    PttDatabase, Push, User, UserLastRecord)
 from utils import load_config, log
 import logging
+from .asn import PttIpAsnEnricher
 from .crawler_arg import add_user_arg_parser, get_base_parser
+from .metrics import BROWSER_DISCONNECTS, BROWSER_SEND_KEYS_SECONDS, DB_WRITE_SECONDS, USERS
+from .writer import PttDatabaseWriter
 
 
 class PttDisconnectException(WebDriverException):
@@ -71,12 +79,15 @@ class PttBrowser(object):
                     os.remove(image_path)
 
         logging.debug('Send buffer: %s', buffer)
-        ActionChains(self.browser). \
-            send_keys(buffer). \
-            send_keys(Keys.ENTER). \
-            perform()
-        time.sleep(self.ACT_DELAY_TIME)
-        if self._is_lose_connect():
+        with BROWSER_SEND_KEYS_SECONDS.time():
+            ActionChains(self.browser). \
+                send_keys(buffer). \
+                send_keys(Keys.ENTER). \
+                perform()
+            time.sleep(self.ACT_DELAY_TIME)
+            lose_connect = self._is_lose_connect()
+        if lose_connect:
+            BROWSER_DISCONNECTS.inc()
             raise PttDisconnectException()
         return self
 
@@ -107,6 +118,7 @@ class PttUserCrawler(object):
         self._init_config(config_path)
         self._init_database()
         self._init_browser()
+        self.asn_enricher = PttIpAsnEnricher.from_config(config_path, self.config, self.writer)
 
         self.ptt_browser_buffer_logger = logging.getLogger(__name__ + '.log')
 
@@ -130,10 +142,18 @@ class PttUserCrawler(object):
             self.json_output = False
             self.database_output = False
 
+        user_config = self.config['PttUser']
+        self.refresh_limit = user_config.getint('RefreshLimit', fallback=0)
+        self.refresh_time_budget = user_config.getfloat('RefreshTimeBudget', fallback=0)
+        self.refresh_stale_days = user_config.getint('RefreshStaleDays', fallback=0)
+        self.refresh_active_days = user_config.getint('RefreshActiveDays', fallback=7)
+
     def _init_database(self):
-        self.db = PttDatabase(dbtype=self.config['Database']['Type'],
-                              dbname=self.config['Database']['Name'])
+        self.db = PttDatabase.from_config(self.config['Database'])
         self.db_session = self.db.get_session()
+        self.writer = PttDatabaseWriter.from_config(self.db, self.config['Database'], name='user')
+        self.write_session = self.writer.session
+        self.group_commit = self.writer.group_commit
 
     def _init_browser(self):
         if sys.platform.startswith('linux'):
@@ -154,11 +174,73 @@ class PttUserCrawler(object):
 
     def _get_id_list(self) -> List[str]:
         if self.db_input:
-            return list(map(lambda user: user.username,
-                            self.db_session.query(User).order_by(User.login_times, User.id).all()))
+            return self._get_refresh_queue()
         else:
             return self.id_list.split(',')
 
+    def _get_refresh_queue(self) -> List[str]:
+        """Usernames whose last record is stale, in refresh priority order.
+
+        Users seen posting or pushing in the last `RefreshActiveDays` days come
+        first, most recently seen first. The other stale users follow, never
+        crawled users first and then by the age of their last record.
+        At most `RefreshLimit` users are returned (0 means no limit).
+        """
+        now = datetime.datetime.now()
+        active_since = now - datetime.timedelta(days=self.refresh_active_days)
+        stale_before = now - datetime.timedelta(days=self.refresh_stale_days)
+
+        # Crawl time of the history version is used as "seen at", push datetimes
+        # on ptt.cc have no year.
+        article_seen = select([Article.user_id.label('user_id'),
+                               ArticleHistory.start_at.label('seen_at')]) \
+            .select_from(Article.__table__.join(ArticleHistory.__table__,
+                                                ArticleHistory.article_id == Article.id)) \
+            .where(ArticleHistory.start_at >= active_since)
+        push_seen = select([Push.push_user_id.label('user_id'),
+                            ArticleHistory.start_at.label('seen_at')]) \
+            .select_from(Push.__table__
+                         .join(ArticleHistoryPush.__table__, ArticleHistoryPush.push_id == Push.id)
+                         .join(ArticleHistory.__table__,
+                               ArticleHistory.id == ArticleHistoryPush.article_history_id)) \
+            .where(ArticleHistory.start_at >= active_since)
+        seen = union_all(article_seen, push_seen).alias('seen')
+        last_seen = select([seen.c.user_id,
+                            func.max(seen.c.seen_at).label('seen_at')]) \
+            .group_by(seen.c.user_id) \
+            .alias('last_seen')
+
+        last_crawled = self.db_session \
+            .query(UserLastRecord.user_id.label('user_id'),
+                   func.max(UserLastRecord.created_at).label('created_at')) \
+            .group_by(UserLastRecord.user_id) \
+            .subquery('last_crawled')
+
+        query = self.db_session.query(User.username) \
+            .outerjoin(last_seen, last_seen.c.user_id == User.id) \
+            .outerjoin(last_crawled, last_crawled.c.user_id == User.id) \
+            .filter(User.username != '',
+                    or_(last_crawled.c.created_at.is_(None),
+                        last_crawled.c.created_at < stale_before)) \
+            .order_by(last_seen.c.seen_at.is_(None),
+                      last_seen.c.seen_at.desc(),
+                      last_crawled.c.created_at.isnot(None),
+                      last_crawled.c.created_at,
+                      User.login_times,
+                      User.id)
+        if self.refresh_limit > 0:
+            query = query.limit(self.refresh_limit)
+
+        id_list = [username for username, in query.all()]
+        logging.info('Refresh queue: %d users', len(id_list))
+        return id_list
+
+    def _is_time_budget_exceeded(self, start_time: float) -> bool:
+        """RefreshTimeBudget bounds the --database refresh queue, an --id list is crawled whole"""
+        if not self.db_input or self.refresh_time_budget <= 0:
+            return False
+        return (time.time() - start_time) > self.refresh_time_budget * 60
+
     def _output_json(self, result: Dict[str, object], count):
         json_path = '{prefix}user_{count}.json'.format(prefix=self.json_prefix,
                                                        count=count)
@@ -167,46 +249,89 @@ class PttUserCrawler(object):
                       sort_keys=True,
                       indent=4)
 
+    def _get_last_records(self, user_ids: List[int]) -> Dict[int, tuple]:
+        """Latest (last_login_datetime, last_login_ip) of each user"""
+        last_records = {}
+        for i in range(0, len(user_ids), self.db.IN_CHUNK_SIZE):
+            chunk = user_ids[i:i + self.db.IN_CHUNK_SIZE]
+            last_id_list = self.write_session \
+                .query(func.max(UserLastRecord.id)) \
+                .filter(UserLastRecord.user_id.in_(chunk)) \
+                .group_by(UserLastRecord.user_id)
+            rows = self.write_session \
+                .query(UserLastRecord.user_id,
+                       UserLastRecord.last_login_datetime,
+                       UserLastRecord.last_login_ip) \
+                .filter(UserLastRecord.id.in_(last_id_list.subquery()))
+            for user_id, last_login_datetime, last_login_ip in rows:
+                last_records[user_id] = (last_login_datetime, last_login_ip)
+        return last_records
+
     @log('Output_Database')
     def _output_database(self, result: List[Dict[str, object]]):
+        start = time.perf_counter()
+        records = OrderedDict()
+        last_login_datetimes = {}
+        last_login_ips = {}
         for record in result:
-            user, is_new_user = self.db.get_or_create(self.db_session,
-                                                      User,
-                                                      {'username': record['username']},
-                                                      {'username': record['username'],
-                                                          'login_times': int(record['login_times']),
-                                                          'valid_article_count': int(record['valid_article_count'])})
-            if not is_new_user:
-                user.login_times = int(record['login_times'])
-                user.valid_article_count = int(record['valid_article_count'])
-                self.db_session.commit()
-
-            last_login_datetime = datetime.datetime.strptime(record['last_login_datetime'],
-                                                             '%m/%d/%Y %H:%M:%S %a')
-            last_record = UserLastRecord(last_login_datetime=last_login_datetime,
-                                         last_login_ip=record['last_login_ip'])
-            last_record.user_id = user.id
-            if record['last_login_ip']:
-                _, _ = self.db.get_or_create(self.db_session,
-                                             IpAsn,
-                                             {'ip': record['last_login_ip']},
-                                             {'ip': record['last_login_ip'],
-                                              'asn': None,
-                                              'asn_cidr': None,
-                                              'asn_country_code': None,
-                                              'asn_date': None,
-                                              'asn_description': None,
-                                              'asn_raw': None,
-                                              'asn_registry': None})
-
-            self.db_session.add(last_record)
-            self.db_session.commit()
+            try:
+                last_login_datetime = datetime.datetime.strptime(record['last_login_datetime'],
+                                                                 '%m/%d/%Y %H:%M:%S %a')
+            except (TypeError, ValueError):
+                logging.warning('last_login_datetime format error, record = %s', record)
+                continue
+            records[record['username']] = record
+            last_login_datetimes[record['username']] = last_login_datetime
+            last_login_ips[record['username']] = IpAddress.normalize(record['last_login_ip'])
+        if not records:
+            return
+
+        with self.group_commit.record(count=len(records)):
+            users = self.db.get_or_create_all(self.write_session,
+                                              User,
+                                              'username',
+                                              [{'username': record['username'],
+                                                'login_times': int(record['login_times']),
+                                                'valid_article_count': int(record['valid_article_count'])}
+                                               for record in records.values()],
+                                              auto_commit=False)
+            for username, record in records.items():
+                users[username].login_times = int(record['login_times'])
+                users[username].valid_article_count = int(record['valid_article_count'])
+
+            ip_list = {ip for ip in last_login_ips.values() if ip}
+            ip_asn_list = self.db.get_or_create_all(self.write_session,
+                                                    IpAsn,
+                                                    'ip',
+                                                    [{'ip': ip} for ip in ip_list],
+                                                    auto_commit=False)
+
+            # Only keep last login records which differ from the previous one
+            last_records = self._get_last_records([user.id for user in users.values()])
+            last_record_list = []
+            for username, record in records.items():
+                user = users[username]
+                last_record = (last_login_datetimes[username], last_login_ips[username])
+                if last_records.get(user.id) == last_record:
+                    continue
+                last_record_list.append(UserLastRecord(user_id=user.id,
+                                                       last_login_datetime=last_login_datetimes[username],
+                                                       last_login_ip=last_login_ips[username]))
+
+            self.db.bulk_insert(self.write_session, last_record_list, auto_commit=False)
+        DB_WRITE_SECONDS.observe(time.perf_counter() - start, writer='user')
+
+        if self.asn_enricher:
+            self.group_commit.after_commit(partial(self.asn_enricher.enqueue,
+                                                   [ip for ip, ip_asn in ip_asn_list.items()
+                                                    if ip_asn.asn is None]))
 
     def _output(self, result: Dict[str, object], count):
         if self.json_output:
             self._output_json(result, count)
         if self.database_output:
-            self._output_database(result)
+            # The crawler thread may keep appending to result
+            self.writer.put(self._output_database, list(result))
 
     def _login_ptt(self, browser, userid, userpwd):
         browser.connect(self.PTT_WEB_URL)
@@ -222,12 +347,26 @@ class PttUserCrawler(object):
 
     @log()
     def crawling(self):
+        try:
+            self._crawling()
+        finally:
+            try:
+                if self.asn_enricher:
+                    # the ips of the open batch are queued once it is committed
+                    try:
+                        self.writer.commit()
+                    finally:
+                        self.asn_enricher.close()
+            finally:
+                self.writer.close()
 
+    def _crawling(self):
         delaytime = float(self.config['PttUser']['Delaytime'])
         userid = self.config['PttUser']['UserId']
         userpwd = self.config['PttUser']['UserPwd']
 
         id_list = self._get_id_list()
+        start_time = time.time()
 
         crawler_result = []
 
@@ -245,6 +384,11 @@ class PttUserCrawler(object):
             err_count = 0
             while len(id_queue) > 0:
                 for user_id in id_list:
+                    if self._is_time_budget_exceeded(start_time):
+                        logging.info('Time budget exceeded, %d users left',
+                                     len(id_queue))
+                        id_queue = []
+                        break
                     try:
                         browser.send_keys('Q').send_keys(user_id)
                         buffer = browser.get_buffer()
@@ -257,6 +401,7 @@ class PttUserCrawler(object):
                         search_result = pat.match(buffer)
 
                         if search_result:
+                            USERS.inc(result='parsed')
                             login_times = search_result.group(1)
                             valid_article_count = search_result.group(2)
                             last_login_datetime = search_result.group(3)
@@ -273,6 +418,7 @@ class PttUserCrawler(object):
                                 count += 1
                                 crawler_result = []
                         else:
+                            USERS.inc(result='error')
                             logging.error('User "%s" has error', user_id)
                             self.ptt_browser_buffer_logger.error('Buffer:\n%s',
                                                                  buffer)
@@ -0,0 +1,205 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List
+
+from sqlalchemy import and_, case, func, or_, select
+
+from models import CrawlJob, PttDatabase
+
+from .metrics import WORK_QUEUE_JOBS
+
+
+class CrawlWorkQueue(object):
+    """Articles to crawl shared by any number of article crawler --worker.
+
+    Jobs are the `crawl_job` rows of a board. A worker claims a batch of
+    pending jobs with a lease of `lease_seconds`, extends the lease with
+    `heartbeat` while it crawls, and marks the jobs `complete` once their
+    articles are committed. A job whose lease runs out, when its worker died
+    or hangs, is claimable again, up to `max_attempts` claims before it is
+    failed.
+
+    On PostgreSQL a claim takes the rows with `FOR UPDATE SKIP LOCKED`, so
+    workers never wait on each other. On SQLite, the database or a queue file
+    of its own, writes are serialized and one UPDATE claims the rows, tagged
+    with a token of the claim to read them back.
+    """
+
+    def __init__(self, db: PttDatabase, worker_id: str = None, lease_seconds: float = 300,
+                 max_attempts: int = 3):
+        self.db = db
+        self.worker_id = worker_id or '{host}-{pid}'.format(host=socket.gethostname(), pid=os.getpid())
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(max_attempts, 1)
+        self.table = CrawlJob.__table__
+        self._leased = set()
+        self._last_heartbeat = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, db: PttDatabase, config) -> 'CrawlWorkQueue':
+        """Queue of the `[WorkQueue]` section, in `db` unless it names a SQLite file"""
+        queue_file = config.get('WorkQueue', 'Database', fallback='')
+        if queue_file:
+            db = PttDatabase('sqlite', dbname=queue_file,
+                             sqlite_pragmas={'journal_mode': 'WAL', 'busy_timeout': 30000})
+            CrawlJob.__table__.create(db.engine, checkfirst=True)
+        return cls(db,
+                   worker_id=config.get('WorkQueue', 'WorkerId', fallback='') or None,
+                   lease_seconds=config.getfloat('WorkQueue', 'LeaseSeconds', fallback=300),
+                   max_attempts=config.getint('WorkQueue', 'MaxAttempts', fallback=3))
+
+    def _chunks(self, web_ids: List[str]) -> Iterable[List[str]]:
+        for i in range(0, len(web_ids), self.db.IN_CHUNK_SIZE):
+            yield web_ids[i:i + self.db.IN_CHUNK_SIZE]
+
+    def enqueue(self, board: str, web_ids: List[str], reset: bool = False) -> int:
+        """Add the jobs of `web_ids` which are not queued yet, with `reset` the
+        done and failed jobs are pending again. Count of the new pending jobs."""
+        count = 0
+        now = datetime.now()
+        with self.db.engine.begin() as connection:
+            for chunk in self._chunks(list(dict.fromkeys(web_ids))):
+                exist = {web_id for web_id, in connection.execute(
+                    select([self.table.c.web_id]).where(self.table.c.web_id.in_(chunk)))}
+                new_jobs = [{'web_id': web_id,
+                             'board': board,
+                             'status': CrawlJob.PENDING,
+                             'attempts': 0,
+                             'updated_at': now}
+                            for web_id in chunk if web_id not in exist]
+                if new_jobs:
+                    connection.execute(self.table.insert(), new_jobs)
+                    count += len(new_jobs)
+                if reset and exist:
+                    result = connection.execute(
+                        self.table.update()
+                        .where(and_(self.table.c.web_id.in_(list(exist)),
+                                    self.table.c.status.in_([CrawlJob.DONE, CrawlJob.FAILED])))
+                        .values(status=CrawlJob.PENDING, attempts=0, worker=None,
+                                lease_token=None, lease_until=None, updated_at=now))
+                    count += result.rowcount
+        return count
+
+    def _expired(self, now: datetime):
+        return and_(self.table.c.status == CrawlJob.LEASED, self.table.c.lease_until < now)
+
+    def _claim_statement(self, board: str, limit: int, now: datetime, token: str = None):
+        """UPDATE leasing up to `limit` claimable jobs of `board` tagged with
+        `token`, or without one the PostgreSQL claim, which skips the rows
+        locked by other claims and returns the web ids"""
+        table = self.table
+        claimable = and_(table.c.board == board,
+                         table.c.attempts < self.max_attempts,
+                         or_(table.c.status == CrawlJob.PENDING, self._expired(now)))
+        candidates = select([table.c.web_id]) \
+            .where(claimable) \
+            .order_by(table.c.web_id) \
+            .limit(limit)
+        if token is None:
+            candidates = candidates.with_for_update(skip_locked=True)
+        statement = table.update() \
+            .where(table.c.web_id.in_(candidates)) \
+            .values(status=CrawlJob.LEASED,
+                    worker=self.worker_id,
+                    lease_token=token,
+                    lease_until=now + timedelta(seconds=self.lease_seconds),
+                    attempts=table.c.attempts + 1,
+                    updated_at=now)
+        return statement if token else statement.returning(table.c.web_id)
+
+    def claim(self, board: str, limit: int) -> List[str]:
+        """Lease up to `limit` jobs of `board` to this worker, in web_id order"""
+        table = self.table
+        now = datetime.now()
+        with self.db.engine.begin() as connection:
+            # Leases lost on the last attempt
+            connection.execute(table.update()
+                               .where(and_(table.c.board == board, self._expired(now),
+                                           table.c.attempts >= self.max_attempts))
+                               .values(status=CrawlJob.FAILED, lease_token=None, updated_at=now))
+            if self.db.dbtype == 'postgresql':
+                web_ids = [web_id for web_id, in connection.execute(self._claim_statement(board, limit, now))]
+            else:
+                token = uuid.uuid4().hex
+                connection.execute(self._claim_statement(board, limit, now, token))
+                web_ids = [web_id for web_id, in connection.execute(
+                    select([table.c.web_id]).where(table.c.lease_token == token))]
+
+        web_ids.sort()
+        with self._lock:
+            self._leased.update(web_ids)
+        self._last_heartbeat = time.monotonic()
+        WORK_QUEUE_JOBS.inc(len(web_ids), action='claimed')
+        logging.debug('Worker %s claimed %d jobs of %s', self.worker_id, len(web_ids), board)
+        return web_ids
+
+    def heartbeat(self, force: bool = False):
+        """Extend the leases of the jobs held by this worker, at most once per
+        third of the lease unless `force`"""
+        if not force and time.monotonic() - self._last_heartbeat < self.lease_seconds / 3:
+            return
+        with self._lock:
+            web_ids = list(self._leased)
+        now = datetime.now()
+        with self.db.engine.begin() as connection:
+            for chunk in self._chunks(web_ids):
+                connection.execute(self.table.update()
+                                   .where(and_(self.table.c.web_id.in_(chunk),
+                                               self.table.c.worker == self.worker_id,
+                                               self.table.c.status == CrawlJob.LEASED))
+                                   .values(lease_until=now + timedelta(seconds=self.lease_seconds),
+                                           updated_at=now))
+        self._last_heartbeat = time.monotonic()
+
+    def _release(self, web_ids: List[str]):
+        with self._lock:
+            self._leased.difference_update(web_ids)
+
+    def complete(self, web_ids: List[str]):
+        """Mark jobs done, whoever holds their lease"""
+        now = datetime.now()
+        with self.db.engine.begin() as connection:
+            for chunk in self._chunks(web_ids):
+                connection.execute(self.table.update()
+                                   .where(self.table.c.web_id.in_(chunk))
+                                   .values(status=CrawlJob.DONE, lease_token=None,
+                                           lease_until=None, updated_at=now))
+        self._release(web_ids)
+        WORK_QUEUE_JOBS.inc(len(web_ids), action='completed')
+
+    def fail(self, web_ids: List[str]):
+        """Give leased jobs back for a retry, or fail them on their last attempt"""
+        now = datetime.now()
+        table = self.table
+        with self.db.engine.begin() as connection:
+            for chunk in self._chunks(web_ids):
+                connection.execute(table.update()
+                                   .where(and_(table.c.web_id.in_(chunk),
+                                               table.c.worker == self.worker_id,
+                                               table.c.status == CrawlJob.LEASED))
+                                   .values(status=case([(table.c.attempts >= self.max_attempts, CrawlJob.FAILED)],
+                                                       else_=CrawlJob.PENDING),
+                                           lease_token=None, lease_until=None, updated_at=now))
+        self._release(web_ids)
+        WORK_QUEUE_JOBS.inc(len(web_ids), action='failed')
+
+    def counts(self, board: str) -> Dict[int, int]:
+        """Job count by status of `board`"""
+        with self.db.engine.connect() as connection:
+            return dict(connection.execute(select([self.table.c.status, func.count()])
+                                           .where(self.table.c.board == board)
+                                           .group_by(self.table.c.status)).fetchall())
+
+    def has_leased(self, board: str) -> bool:
+        """Whether other workers still hold leases of `board`, whose jobs may
+        come back when they fail"""
+        with self.db.engine.connect() as connection:
+            return connection.execute(select([func.count()])
+                                      .where(and_(self.table.c.board == board,
+                                                  self.table.c.status == CrawlJob.LEASED))).scalar() > 0
@@ -0,0 +1,110 @@
+import logging
+import queue
+import threading
+from typing import Callable
+
+from models import PttDatabase
+
+from .metrics import DB_COMMIT_SECONDS, DB_COMMITTED_RECORDS, DB_WRITE_ERRORS, WRITER_QUEUE_DEPTH
+
+
+class PttDatabaseWriter(object):
+    """Single writer of a crawler, owning its own database session.
+
+    Fetch and parse code hands `put(write, records)` to the writer thread
+    through a queue of `queue_size` batches. `put` blocks while the queue is
+    full, so crawling never runs more than `queue_size` batches ahead of the
+    database and the memory they hold stays bounded. The write functions use
+    `session` and `group_commit` of the writer, the crawler keeps its own
+    session for reads.
+
+    With `queue_size = 0` nothing is queued, `put` writes on the calling
+    thread. `name` labels the write errors of the writer in the metrics.
+    """
+
+    IDLE_TIMEOUT = 0.5
+
+    def __init__(self, db: PttDatabase, queue_size: int = 4, name: str = ''):
+        self.db = db
+        self.name = name
+        self.session = db.get_session()
+        self.group_commit = db.group_commit(self.session)
+        self.group_commit.on_commit = self._observe_commit
+        self.queue = None
+        self._thread = None
+        if queue_size > 0:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._run, name='PttDatabaseWriter', daemon=True)
+            self._thread.start()
+
+    @classmethod
+    def from_config(cls, db: PttDatabase, database_config, name: str = '') -> 'PttDatabaseWriter':
+        return cls(db, queue_size=database_config.getint('WriterQueueSize', fallback=4), name=name)
+
+    @staticmethod
+    def _observe_commit(records: int, seconds: float):
+        DB_COMMIT_SECONDS.observe(seconds)
+        DB_COMMITTED_RECORDS.inc(records)
+
+    def put(self, write: Callable[..., None], *args):
+        if self._thread is None:
+            self._write(write, args)
+            return
+        if not self._thread.is_alive():
+            raise RuntimeError('Database writer is closed')
+        self.queue.put((write, args))
+        WRITER_QUEUE_DEPTH.set(self.queue.qsize())
+
+    def _write(self, write: Callable[..., None], args):
+        try:
+            write(*args)
+        except Exception:
+            DB_WRITE_ERRORS.inc(writer=self.name)
+            logging.exception('Database write %s failed', getattr(write, '__name__', write))
+
+    def _commit_and_close(self):
+        try:
+            self.group_commit.commit()
+        except Exception:
+            logging.exception('Database writer commit failed')
+        finally:
+            self.session.close()
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.IDLE_TIMEOUT)
+                WRITER_QUEUE_DEPTH.set(self.queue.qsize())
+            except queue.Empty:
+                # Nothing to write, CommitInterval still holds for the open batch
+                try:
+                    self.group_commit.commit_due()
+                except Exception:
+                    logging.exception('Database writer commit failed')
+                continue
+            try:
+                if item is None:
+                    self._commit_and_close()
+                    return
+                self._write(*item)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait for the queued batches to be written"""
+        if self._thread is not None:
+            self.queue.join()
+
+    def commit(self):
+        """Write what is queued and commit it, the after commit callbacks of
+        the batch run before this returns"""
+        self.put(self.group_commit.commit)
+        self.flush()
+
+    def close(self):
+        """Write what is still queued, commit it and stop"""
+        if self._thread is None:
+            self._commit_and_close()
+        elif self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
@@ -25,6 +25,19 @@ target_metadata = None
 # ... etc.
 
 
+def get_url():
+    """Database url of the crawler config (`-x config=PATH`, default config.ini),
+    falls back to sqlalchemy.url of alembic.ini"""
+    config_path = context.get_x_argument(as_dictionary=True).get('config', 'config.ini')
+    if not os.path.exists(config_path):
+        return config.get_main_option("sqlalchemy.url")
+
+    sys.path.append(os.getcwd())
+    from models.base import PttDatabase
+    from utils import load_config
+    return PttDatabase.from_config(load_config(config_path)['Database']).engine.url
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -37,7 +50,7 @@ def run_migrations_offline():
     script output.
 
     """
-    url = config.get_main_option("sqlalchemy.url")
+    url = get_url()
     context.configure(
         url=url, target_metadata=target_metadata,
         literal_binds=True)
@@ -58,8 +71,10 @@ def run_migrations_online():
     from models.base import Base
     target_metadata = Base.metadata
 
+    options = config.get_section(config.config_ini_section)
+    options['sqlalchemy.url'] = str(get_url())
     connectable = engine_from_config(
-        config.get_section(config.config_ini_section),
+        options,
         prefix='sqlalchemy.',
         poolclass=pool.NullPool)
 
@@ -68,7 +83,8 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             compare_type=True,
-            render_as_batch=True)
+            # SQLite can only ALTER TABLE through table copies
+            render_as_batch=connection.dialect.name == 'sqlite')
 
         with context.begin_transaction():
             context.run_migrations()
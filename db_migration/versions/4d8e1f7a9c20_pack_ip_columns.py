@@ -0,0 +1,148 @@
+"""pack ip columns
+
+Revision ID: 4d8e1f7a9c20
+Revises: e2a7d39c0f58
+Create Date: 2026-10-19 13:20:51.774016
+
+"""
+import ipaddress
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d8e1f7a9c20'
+down_revision = 'e2a7d39c0f58'
+branch_labels = None
+depends_on = None
+
+CHUNK_SIZE = 10000
+
+# table, key column, ip column, nullable
+IP_COLUMNS = [
+    ('article', 'id', 'post_ip', True),
+    ('push', 'id', 'push_ip', True),
+    ('user_last_record', 'id', 'last_login_ip', False),
+]
+
+IP_ASN_COLUMNS = ['asn', 'asn_date', 'asn_registry', 'asn_cidr', 'asn_country_code',
+                  'asn_description', 'asn_raw', 'lookup_datetime', 'asn_inferred',
+                  'lookup_failures', 'retry_datetime']
+
+
+def to_packed(value):
+    try:
+        return ipaddress.ip_address(value.strip()).packed if value else None
+    except ValueError:
+        logging.warning('Invalid ip dropped: %s', value)
+        return None
+
+
+def to_text(value):
+    return str(ipaddress.ip_address(bytes(value))) if value is not None else None
+
+
+def _iter_rows(connection, table, key, columns):
+    """Keyset paginated scan of `table` ordered by `key`"""
+    last_key = None
+    while True:
+        query = sa.select([table.c[key]] + [table.c[c] for c in columns]) \
+            .order_by(table.c[key]) \
+            .limit(CHUNK_SIZE)
+        if last_key is not None:
+            query = query.where(table.c[key] > last_key)
+        rows = connection.execute(query).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_key = rows[-1][0]
+
+
+def _convert_column(table_name, key, column, convert, new_type, nullable):
+    connection = op.get_bind()
+    new_column = column + '_new'
+    with op.batch_alter_table(table_name, schema=None) as batch_op:
+        batch_op.add_column(sa.Column(new_column, new_type, nullable=True))
+
+    table = sa.table(table_name, sa.column(key), sa.column(column), sa.column(new_column))
+    update = table.update() \
+        .where(table.c[key] == sa.bindparam('_key')) \
+        .values({new_column: sa.bindparam('_value')})
+    for rows in _iter_rows(connection, table, key, [column]):
+        values = [{'_key': row_key, '_value': convert(value)}
+                  for row_key, value in rows if value is not None]
+        if values:
+            connection.execute(update, values)
+
+    with op.batch_alter_table(table_name, schema=None) as batch_op:
+        batch_op.drop_column(column)
+        batch_op.alter_column(new_column,
+                              new_column_name=column,
+                              existing_type=new_type,
+                              nullable=nullable)
+
+
+def _convert_ip_asn(convert, ip_type):
+    connection = op.get_bind()
+    op.create_table('ip_asn_new',
+                    sa.Column('ip', ip_type, nullable=False),
+                    sa.Column('asn', sa.String(length=256), nullable=True),
+                    sa.Column('asn_date', sa.DateTime(), nullable=True),
+                    sa.Column('asn_registry', sa.String(length=256), nullable=True),
+                    sa.Column('asn_cidr', sa.String(length=256), nullable=True),
+                    sa.Column('asn_country_code', sa.String(length=4), nullable=True),
+                    sa.Column('asn_description', sa.String(length=256), nullable=True),
+                    sa.Column('asn_raw', sa.String(), nullable=True),
+                    sa.Column('lookup_datetime', sa.DateTime(), nullable=True),
+                    sa.Column('asn_inferred', sa.Boolean(create_constraint=False), nullable=True),
+                    sa.Column('lookup_failures', sa.Integer(), nullable=True),
+                    sa.Column('retry_datetime', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('ip', name=op.f('pk_ip_asn_new'))
+                    )
+
+    old_table = sa.table('ip_asn', *[sa.column(c) for c in ['ip'] + IP_ASN_COLUMNS])
+    new_table = sa.table('ip_asn_new', *[sa.column(c) for c in ['ip'] + IP_ASN_COLUMNS])
+    for rows in _iter_rows(connection, old_table, 'ip', IP_ASN_COLUMNS):
+        values = []
+        for row in rows:
+            ip = convert(row[0])
+            if ip is None:
+                continue
+            value = dict(zip(IP_ASN_COLUMNS, row[1:]))
+            value['ip'] = ip
+            values.append(value)
+        if values:
+            connection.execute(new_table.insert(), values)
+
+    op.drop_table('ip_asn')
+    op.rename_table('ip_asn_new', 'ip_asn')
+    # Primary key names are schema wide on PostgreSQL
+    if connection.dialect.name == 'postgresql':
+        op.execute('ALTER TABLE ip_asn RENAME CONSTRAINT pk_ip_asn_new TO pk_ip_asn')
+
+
+def upgrade():
+    _convert_ip_asn(to_packed, sa.LargeBinary())
+    for table_name, key, column, _ in IP_COLUMNS:
+        _convert_column(table_name, key, column, to_packed, sa.LargeBinary(), True)
+        op.create_index(op.f('ix_{table}_{column}'.format(table=table_name, column=column)),
+                        table_name, [column], unique=False)
+
+
+def downgrade():
+    for table_name, key, column, nullable in IP_COLUMNS:
+        op.drop_index(op.f('ix_{table}_{column}'.format(table=table_name, column=column)),
+                      table_name=table_name)
+        # Empty last_login_ip were stored as NULL
+        _convert_column(table_name, key, column, to_text, sa.String(length=40), True)
+        if not nullable:
+            connection = op.get_bind()
+            table = sa.table(table_name, sa.column(column))
+            connection.execute(table.update().where(table.c[column].is_(None)).values({column: ''}))
+            with op.batch_alter_table(table_name, schema=None) as batch_op:
+                batch_op.alter_column(column,
+                                      existing_type=sa.String(length=40),
+                                      nullable=False)
+    _convert_ip_asn(to_text, sa.String(length=40))
@@ -0,0 +1,212 @@
+"""normalize push storage
+
+Revision ID: a7c3e9f1b284
+Revises: 4d8e1f7a9c20
+Create Date: 2026-10-19 16:42:07.318520
+
+"""
+import hashlib
+import ipaddress
+import logging
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e9f1b284'
+down_revision = '4d8e1f7a9c20'
+branch_labels = None
+depends_on = None
+
+CHUNK_SIZE = 500
+
+PUSH_TAGS = {'推': 1, '噓': 2, '→': 3}
+PUSH_TAG_NAMES = {v: k for k, v in PUSH_TAGS.items()}
+
+PUSH_COLUMNS = ['floor', 'push_tag', 'push_user_id', 'push_content', 'push_ip', 'push_datetime']
+
+
+def to_tag(value):
+    return PUSH_TAGS.get((value or '').strip(), 0)
+
+
+def to_tag_name(value):
+    return PUSH_TAG_NAMES.get(value, '')
+
+
+def content_hash(push_tag, push_user_id, push_content, push_ip, push_datetime):
+    """Same hash as models.Push.content_hash_of"""
+    if push_ip is not None:
+        push_ip = str(ipaddress.ip_address(bytes(push_ip)))
+    if isinstance(push_datetime, str):
+        push_datetime = datetime.strptime(push_datetime[:19], '%Y-%m-%d %H:%M:%S')
+    if push_datetime is not None:
+        push_datetime = push_datetime.strftime('%m/%d %H:%M:%S')
+    key = '\t'.join(str(v) if v is not None else '' for v in
+                    (push_tag, push_user_id, push_content, push_ip, push_datetime))
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def _iter_keys(connection, table, key):
+    """Keyset paginated scan of the `key` column of `table`"""
+    last_key = None
+    while True:
+        query = sa.select([table.c[key]]).order_by(table.c[key]).limit(CHUNK_SIZE)
+        if last_key is not None:
+            query = query.where(table.c[key] > last_key)
+        keys = [k for k, in connection.execute(query)]
+        if not keys:
+            return
+        yield keys[0], keys[-1]
+        last_key = keys[-1]
+
+
+def _rename_table(old_name, new_name):
+    op.rename_table(old_name, new_name)
+    # Primary key and sequence names are schema wide on PostgreSQL
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('ALTER TABLE {table} RENAME CONSTRAINT pk_{old} TO pk_{new}'.format(
+            table=new_name, old=old_name, new=new_name))
+        op.execute('ALTER SEQUENCE {old}_id_seq RENAME TO {new}_id_seq'.format(
+            old=old_name, new=new_name))
+
+
+def _create_push_table():
+    op.create_table('push',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('article_id', sa.Integer(), nullable=False),
+                    sa.Column('floor', sa.Integer(), nullable=False),
+                    sa.Column('content_hash', sa.BigInteger(), nullable=False),
+                    sa.Column('push_tag', sa.SmallInteger(), nullable=False),
+                    sa.Column('push_user_id', sa.Integer(), nullable=False),
+                    sa.Column('push_content', sa.String(length=128), nullable=False),
+                    sa.Column('push_ip', sa.LargeBinary(), nullable=True),
+                    sa.Column('push_datetime', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['article_id'], ['article.id'], name=op.f(
+                        'fk_push_article_id_article'), ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(
+                        ['push_user_id'], ['user.id'], name=op.f('fk_push_push_user_id_user')),
+                    sa.PrimaryKeyConstraint('id', name=op.f('pk_push')),
+                    sa.UniqueConstraint('article_id', 'floor', 'content_hash',
+                                        name=op.f('uq_push_article_id_floor_content_hash'))
+                    )
+    op.create_table('article_history_push',
+                    sa.Column('article_history_id', sa.Integer(), nullable=False),
+                    sa.Column('push_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['article_history_id'], ['article_history.id'], name=op.f(
+                        'fk_article_history_push_article_history_id_article_history'), ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['push_id'], ['push.id'], name=op.f(
+                        'fk_article_history_push_push_id_push'), ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('article_history_id', 'push_id',
+                                            name=op.f('pk_article_history_push'))
+                    )
+
+
+def _create_old_push_table():
+    op.create_table('push',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('article_history_id', sa.Integer(), nullable=False),
+                    sa.Column('floor', sa.Integer(), nullable=False),
+                    sa.Column('push_tag', sa.String(length=2), nullable=False),
+                    sa.Column('push_user_id', sa.Integer(), nullable=False),
+                    sa.Column('push_content', sa.String(length=128), nullable=False),
+                    sa.Column('push_ip', sa.LargeBinary(), nullable=True),
+                    sa.Column('push_datetime', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['article_history_id'], ['article_history.id'], name=op.f(
+                        'fk_push_article_history_id_article_history'), ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(
+                        ['push_user_id'], ['user.id'], name=op.f('fk_push_push_user_id_user')),
+                    sa.PrimaryKeyConstraint('id', name=op.f('pk_push'))
+                    )
+
+
+def upgrade():
+    connection = op.get_bind()
+    op.drop_index(op.f('ix_push_push_ip'), table_name='push')
+    _rename_table('push', 'push_old')
+    _create_push_table()
+
+    article = sa.table('article', sa.column('id'))
+    history = sa.table('article_history', sa.column('id'), sa.column('article_id'))
+    old_push = sa.table('push_old', sa.column('article_history_id'), *[sa.column(c) for c in PUSH_COLUMNS])
+    push = sa.table('push', sa.column('id'), sa.column('article_id'), sa.column('content_hash'),
+                    *[sa.column(c) for c in PUSH_COLUMNS])
+    link = sa.table('article_history_push', sa.column('article_history_id'), sa.column('push_id'))
+
+    # Pushes are deduplicated per article, so articles are converted a chunk at a time
+    push_id = 0
+    dropped = 0
+    for first_id, last_id in _iter_keys(connection, article, 'id'):
+        query = sa.select([history.c.article_id, old_push.c.article_history_id] +
+                          [old_push.c[c] for c in PUSH_COLUMNS]) \
+            .select_from(old_push.join(history, history.c.id == old_push.c.article_history_id)) \
+            .where(history.c.article_id.between(first_id, last_id)) \
+            .order_by(old_push.c.article_history_id, old_push.c.floor)
+
+        push_ids = {}
+        push_values = []
+        link_values = set()
+        for row in connection.execute(query):
+            article_id, history_id = row[0], row[1]
+            value = dict(zip(PUSH_COLUMNS, row[2:]))
+            value['content_hash'] = content_hash(value['push_tag'], value['push_user_id'],
+                                                 value['push_content'], value['push_ip'],
+                                                 value['push_datetime'])
+            key = (article_id, value['floor'], value['content_hash'])
+            if key not in push_ids:
+                push_id += 1
+                push_ids[key] = push_id
+                value.update({'id': push_id,
+                              'article_id': article_id,
+                              'push_tag': to_tag(value['push_tag'])})
+                push_values.append(value)
+            else:
+                dropped += 1
+            link_values.add((history_id, push_ids[key]))
+
+        if push_values:
+            connection.execute(push.insert(), push_values)
+            connection.execute(link.insert(), [{'article_history_id': history_id, 'push_id': pid}
+                                               for history_id, pid in sorted(link_values)])
+
+    logging.info('%d push bodies kept, %d duplicates dropped', push_id, dropped)
+    if push_id and connection.dialect.name == 'postgresql':
+        op.execute("SELECT setval('push_id_seq', {push_id})".format(push_id=push_id))
+    op.drop_table('push_old')
+    op.create_index(op.f('ix_push_push_ip'), 'push', ['push_ip'], unique=False)
+    op.create_index(op.f('ix_article_history_push_push_id'), 'article_history_push',
+                    ['push_id'], unique=False)
+
+
+def downgrade():
+    connection = op.get_bind()
+    op.drop_index(op.f('ix_article_history_push_push_id'), table_name='article_history_push')
+    op.drop_index(op.f('ix_push_push_ip'), table_name='push')
+    _rename_table('push', 'push_new')
+    _create_old_push_table()
+
+    history = sa.table('article_history', sa.column('id'))
+    new_push = sa.table('push_new', sa.column('id'), *[sa.column(c) for c in PUSH_COLUMNS])
+    link = sa.table('article_history_push', sa.column('article_history_id'), sa.column('push_id'))
+    push = sa.table('push', sa.column('article_history_id'), *[sa.column(c) for c in PUSH_COLUMNS])
+
+    for first_id, last_id in _iter_keys(connection, history, 'id'):
+        query = sa.select([link.c.article_history_id] + [new_push.c[c] for c in PUSH_COLUMNS]) \
+            .select_from(link.join(new_push, new_push.c.id == link.c.push_id)) \
+            .where(link.c.article_history_id.between(first_id, last_id)) \
+            .order_by(link.c.article_history_id, new_push.c.floor)
+        values = []
+        for row in connection.execute(query):
+            value = dict(zip(PUSH_COLUMNS, row[1:]))
+            value['article_history_id'] = row[0]
+            value['push_tag'] = to_tag_name(value['push_tag'])
+            values.append(value)
+        if values:
+            connection.execute(push.insert(), values)
+
+    op.drop_table('article_history_push')
+    op.drop_table('push_new')
+    op.create_index(op.f('ix_push_push_ip'), 'push', ['push_ip'], unique=False)
@@ -0,0 +1,25 @@
+"""add article history rotation index
+
+Revision ID: d41b6e2c8f93
+Revises: a7c3e9f1b284
+Create Date: 2026-10-19 17:25:40.106734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41b6e2c8f93'
+down_revision = 'a7c3e9f1b284'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_article_history_article_id_start_at'), 'article_history',
+                    ['article_id', 'start_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_article_history_article_id_start_at'), table_name='article_history')
@@ -12,7 +12,7 @@ from sqlalchemy import func
 
 from models import (Article, ArticleHistory, Board, IpAsn, PttDatabase, Push,
                     User, UserLastRecord)
-from utils import load_config, log
+from utils import PROFILER, load_config, log
 
 
 class ExportFormat(Enum):
@@ -37,8 +37,7 @@ class PttExportHelper(object):
         if not os.path.exists(self.output_folder):
             os.makedirs(self.output_folder)
 
-        self.db = PttDatabase(dbtype=self.config['Database']['Type'],
-                              dbname=self.config['Database']['Name'])
+        self.db = PttDatabase.from_config(self.config['Database'])
         self.db_session = self.db.get_session()
 
     @log('Get Data')
@@ -341,6 +340,7 @@ def main():
     args = parse_argument()
     helper = PttExportHelper()
     helper.go(args)
+    PROFILER.log_summary()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,6 @@
-from .base import Base, PttDatabase, MyDateTime
-from .article import Article, ArticleHistory, ArticleIndex, Board, Push
+from .base import Base, PttDatabase, GroupCommit, MyDateTime, IpAddress, ip_in_network
+from .article import (Article, ArticleHistory, ArticleHistoryPush, ArticleIndex, Board, Push,
+                      PushTag)
 from .asn import IpAsn
 from .user import User, UserLastRecord
+from .crawl_job import CrawlJob
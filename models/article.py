@@ -1,9 +1,35 @@
 import datetime
+import hashlib
+import logging
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, Sequence, String
-from sqlalchemy.orm import backref, relationship
+from sqlalchemy import (BigInteger, Column, DateTime, ForeignKey, Index, Integer, Sequence,
+                        SmallInteger, String, TypeDecorator, UniqueConstraint)
+from sqlalchemy.orm import relationship
 
-from . import Base, MyDateTime
+from . import Base, IpAddress, MyDateTime
+
+
+class PushTag(TypeDecorator):
+    """Push tag stored as a small integer, text on the Python side"""
+    impl = SmallInteger
+
+    TAGS = {'推': 1, '噓': 2, '→': 3}
+    NAMES = {v: k for k, v in TAGS.items()}
+    UNKNOWN = 0
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, int):
+            return value
+        tag = self.TAGS.get(value.strip())
+        if tag is None:
+            logging.warning('Unknown push tag: %s', value)
+            return self.UNKNOWN
+        return tag
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self.NAMES.get(value, '')
 
 
 class Board(Base):
@@ -13,6 +39,11 @@ class Board(Base):
                 primary_key=True)
     name = Column(String(64),
                   nullable=False)
+    # newest index page and web_id seen by the article crawler --tail
+    tail_index = Column(Integer,
+                        nullable=True)
+    tail_web_id = Column(String(20),
+                         nullable=True)
 
     articles = relationship("Article", backref="Board")
 
@@ -46,8 +77,9 @@ class Article(Base):
                       nullable=False)
     post_datetime = Column(MyDateTime,
                            nullable=True)
-    post_ip = Column(String(20),
-                     nullable=True)
+    post_ip = Column(IpAddress,
+                     nullable=True,
+                     index=True)
 
     user = relationship("User", backref="Article")
     board = relationship("Board", backref="Article")
@@ -70,6 +102,7 @@ post_ip={post_ip})>'.format(id=self.id,
 
 class ArticleHistory(Base):
     __tablename__ = 'article_history'
+    __table_args__ = (Index('ix_article_history_article_id_start_at', 'article_id', 'start_at'),)
     id = Column(Integer,
                 Sequence('article_history_id_seq'),
                 primary_key=True)
@@ -89,7 +122,8 @@ class ArticleHistory(Base):
 
     article = relationship(
         "Article", backref="ArticleHistory")
-    push_list = relationship("Push", backref="ArticleHistory",
+    push_list = relationship("Push", secondary="article_history_push",
+                             backref="ArticleHistory",
                              order_by="desc(Push.push_datetime)")
 
     def __repr__(self):
@@ -108,44 +142,70 @@ post_ip={post_ip})>'.format(id=self.id,
                             post_ip=self.article.post_ip)
 
 
+class ArticleHistoryPush(Base):
+    __tablename__ = 'article_history_push'
+    article_history_id = Column(Integer,
+                                ForeignKey('article_history.id',
+                                           ondelete='CASCADE'),
+                                primary_key=True)
+    push_id = Column(Integer,
+                     ForeignKey('push.id',
+                                ondelete='CASCADE'),
+                     primary_key=True,
+                     index=True)
+
+
 class Push(Base):
+    """Push body shared by every history version of its article which shows it"""
     __tablename__ = 'push'
+    __table_args__ = (UniqueConstraint('article_id', 'floor', 'content_hash'),)
     id = Column(Integer,
                 Sequence('push_id_seq'),
                 primary_key=True)
-    article_history_id = Column(Integer,
-                                ForeignKey('article_history.id',
-                                           ondelete='CASCADE'),
-                                nullable=False)
+    article_id = Column(Integer,
+                        ForeignKey('article.id',
+                                   ondelete='CASCADE'),
+                        nullable=False)
     floor = Column(Integer,
                    nullable=False)
-    push_tag = Column(String(2),
+    content_hash = Column(BigInteger,
+                          nullable=False)
+    push_tag = Column(PushTag,
                       nullable=False)
     push_user_id = Column(Integer,
                           ForeignKey('user.id'),
                           nullable=False)
     push_content = Column(String(128),
                           nullable=False)
-    push_ip = Column(String(40),
-                     nullable=True)
+    push_ip = Column(IpAddress,
+                     nullable=True,
+                     index=True)
     push_datetime = Column(MyDateTime,
                            nullable=True)
-    article_history = relationship("ArticleHistory",
-                                   backref=backref("Push", cascade='all,delete'))
-    # article_history = relationship("ArticleHistory",
-    #                                backref=backref("Push", passive_deletes=True))
+
+    article = relationship("Article", backref="Push")
     user = relationship("User", backref="Push")
 
+    @staticmethod
+    def content_hash_of(push_tag, push_user_id, push_content, push_ip, push_datetime) -> int:
+        """Signed 64 bit hash of the push fields, part of the push identity with its floor"""
+        if push_datetime is not None and not isinstance(push_datetime, str):
+            push_datetime = push_datetime.strftime('%m/%d %H:%M:%S')
+        key = '\t'.join(str(v) if v is not None else '' for v in
+                        (push_tag, push_user_id, push_content, push_ip, push_datetime))
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big', signed=True)
+
     def __repr__(self):
-        return '<Article(id={id}, \
-article_history_id={article_history_id}, \
+        return '<Push(id={id}, \
+article_id={article_id}, \
 floor={floor}, \
 push_tag={push_tag}, \
 push_user_id={push_user_id}, \
 push_content={push_content}, \
 push_ip={push_ip}, \
 push_datetime={push_datetime})>'.format(id=self.id,
-                                        article_history_id=self.article_history_id,
+                                        article_id=self.article_id,
                                         floor=self.floor,
                                         push_tag=self.push_tag,
                                         push_user_id=self.push_user_id,
@@ -1,12 +1,12 @@
 from datetime import datetime
-from sqlalchemy import Column, DateTime, String
+from sqlalchemy import Boolean, Column, DateTime, Integer, String
 
-from . import Base, MyDateTime
+from . import Base, IpAddress, MyDateTime
 
 
 class IpAsn(Base):
     __tablename__ = 'ip_asn'
-    ip = Column(String(40),
+    ip = Column(IpAddress,
                 primary_key=True)
     asn = Column(String(256),
                  nullable=True)
@@ -22,3 +22,15 @@ class IpAsn(Base):
                              nullable=True)
     asn_raw = Column(String,
                      nullable=True)
+    lookup_datetime = Column(MyDateTime,
+                             nullable=True)
+    # Filled from the covering prefix of another ip instead of a lookup
+    asn_inferred = Column(Boolean(create_constraint=False),
+                          nullable=True,
+                          default=False)
+    # Negative cache of failed lookups, retried after `retry_datetime`
+    lookup_failures = Column(Integer,
+                             nullable=True,
+                             default=0)
+    retry_datetime = Column(MyDateTime,
+                            nullable=True)
@@ -1,10 +1,20 @@
+import io
+import ipaddress
 import logging
 import os
-from typing import Dict, List
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote_plus
 
-from sqlalchemy import DateTime, create_engine
+from sqlalchemy import (DateTime, LargeBinary, Sequence, TypeDecorator, and_, create_engine,
+                        event, func, inspect, text)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 Base = declarative_base()
 
@@ -25,12 +35,152 @@ class MyDateTime(DateTime):
         return MyDateTime(self.timezone)
 
 
+class IpAddress(TypeDecorator):
+    """IPv4/IPv6 address stored packed (4 or 16 bytes), text on the Python side"""
+    impl = LargeBinary
+
+    @staticmethod
+    def normalize(value) -> Optional[str]:
+        """Canonical text of an ip, None for empty or invalid values"""
+        if not value:
+            return None
+        try:
+            return str(ipaddress.ip_address(value.strip()))
+        except ValueError:
+            logging.warning('Invalid ip: %s', value)
+            return None
+
+    @staticmethod
+    def network_range(cidr: str) -> Tuple[bytes, bytes]:
+        """Packed (first, last) address of a CIDR"""
+        network = ipaddress.ip_network(cidr, strict=False)
+        return network.network_address.packed, network.broadcast_address.packed
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, bytes):
+            return value
+        value = self.normalize(value)
+        return ipaddress.ip_address(value).packed if value else None
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return str(ipaddress.ip_address(bytes(value)))
+
+
+def ip_in_network(column, cidr: str):
+    """Range condition of `column` (an IpAddress column) inside `cidr`"""
+    first, last = IpAddress.network_range(cidr)
+    return and_(column.between(first, last),
+                func.length(column) == len(first))
+
+
+class GroupCommit(object):
+    """Commits `session` once per `commit_size` records or `commit_interval`
+    milliseconds, whichever comes first.
+
+    Every record runs in a SAVEPOINT, a failed record is rolled back alone and
+    the records before it stay in the batch. The interval is checked when a
+    record completes, `commit` writes whatever is pending. A batch of only
+    `count=0` writes, pages of an index or the tail of a board, has nothing
+    to wait for and is committed at once, so it does not hold the write lock
+    while the crawler fetches. Callbacks of `after_commit` run once the
+    pending records are committed.
+
+    `begin` is the statement opening the batch transaction where the driver
+    does not open one before a SAVEPOINT on its own. `on_commit` is called
+    with the record count and the seconds of every commit.
+    """
+
+    def __init__(self, session, commit_size: int = 1, commit_interval: float = 0,
+                 begin: str = None):
+        self.session = session
+        self.commit_size = max(commit_size, 1)
+        self.commit_interval = commit_interval
+        self.begin = begin
+        self.pending = 0
+        # a record, of any count, left the batch transaction open
+        self._open = False
+        self._batch_start = None
+        self._callbacks = []
+        self.on_commit = None
+
+    @contextmanager
+    def record(self, count: int = 1):
+        if not self._open:
+            self._open = True
+            self._batch_start = time.monotonic()
+        if self.begin:
+            connection = self.session.connection()
+            if not connection.connection.in_transaction:
+                connection.execute(self.begin)
+        savepoint = self.session.begin_nested()
+        try:
+            yield
+            savepoint.commit()
+        except Exception:
+            savepoint.rollback()
+            # a failed first record leaves an empty transaction to release
+            self.commit_due()
+            raise
+
+        self.pending += count
+        self.commit_due()
+
+    def _is_due(self) -> bool:
+        if self.pending >= self.commit_size or not self.pending:
+            return True
+        return (self.commit_interval > 0 and
+                (time.monotonic() - self._batch_start) * 1000 >= self.commit_interval)
+
+    def commit_due(self):
+        """Commit the pending records if the batch is full or old enough"""
+        if self._open and self._is_due():
+            self.commit()
+
+    def after_commit(self, callback: Callable[[], None]):
+        if self._open:
+            self._callbacks.append(callback)
+        else:
+            callback()
+
+    def commit(self):
+        records = self.pending
+        start = time.perf_counter()
+        try:
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            self._callbacks = []
+            raise
+        finally:
+            self.pending = 0
+            self._open = False
+            self._batch_start = None
+        if self.on_commit:
+            self.on_commit(records, time.perf_counter() - start)
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
 class PttDatabase:
     DB_ENGINE = {
-        'sqlite': 'sqlite:///{DB}'
+        'sqlite': 'sqlite:///{DB}',
+        'postgresql': 'postgresql+psycopg2://{username}:{password}@{host}:{port}/{DB}'
     }
+    # Keep IN lists below SQLite's default limit of 999 bound variables
+    IN_CHUNK_SIZE = 500
+    # [Database] config key -> SQLite pragma of the tuning profile
+    SQLITE_PRAGMAS = OrderedDict([('JournalMode', 'journal_mode'),
+                                  ('Synchronous', 'synchronous'),
+                                  ('MmapSize', 'mmap_size'),
+                                  ('CacheSize', 'cache_size'),
+                                  ('BusyTimeout', 'busy_timeout')])
 
-    def __init__(self, dbtype, username='', password='', dbname=''):
+    def __init__(self, dbtype, username='', password='', dbname='',
+                 host='localhost', port=5432, pool_size=5, max_overflow=10,
+                 sqlite_pragmas: Dict[str, str] = None, commit_size=1, commit_interval=0):
 
         dbtype = dbtype.lower()
 
@@ -41,16 +191,74 @@ class PttDatabase:
             #     if not os.path.exists(folder):
             #         os.makedirs(folder)
 
-            engine_url = self.DB_ENGINE[dbtype].format(DB=dbname)
-            self.engine = create_engine(engine_url)
+            engine_url = self.DB_ENGINE[dbtype].format(DB=dbname,
+                                                       username=quote_plus(username),
+                                                       password=quote_plus(password),
+                                                       host=host,
+                                                       port=port)
+            engine_options = {}
+            if dbtype != 'sqlite':
+                engine_options.update(pool_size=pool_size,
+                                      max_overflow=max_overflow,
+                                      pool_pre_ping=True)
+            elif sqlite_pragmas:
+                # Keep one connection open instead of reconnecting for every
+                # transaction, so mmap and page cache survive between commits
+                engine_options.update(poolclass=QueuePool,
+                                      pool_size=1,
+                                      connect_args={'check_same_thread': False})
+            self.dbtype = dbtype
+            self.engine = create_engine(engine_url, **engine_options)
+            if dbtype == 'sqlite' and sqlite_pragmas:
+                self.sqlite_pragmas = sqlite_pragmas
+                event.listen(self.engine, 'connect', self._set_sqlite_pragmas)
+            self.commit_size = commit_size
+            self.commit_interval = commit_interval
             # Base.metadata.create_all(self.engine, checkfirst=True)
         else:
             raise ValueError("DBType is not found in DB_ENGINE")
 
+    @classmethod
+    def from_config(cls, database_config) -> 'PttDatabase':
+        """Database of a `[Database]` config section"""
+        return cls(dbtype=database_config['Type'],
+                   username=database_config.get('Username', ''),
+                   password=database_config.get('Password', ''),
+                   dbname=database_config['Name'],
+                   host=database_config.get('Host', 'localhost'),
+                   port=database_config.getint('Port', fallback=5432),
+                   pool_size=database_config.getint('PoolSize', fallback=5),
+                   max_overflow=database_config.getint('MaxOverflow', fallback=10),
+                   sqlite_pragmas=OrderedDict((pragma, database_config[key])
+                                              for key, pragma in cls.SQLITE_PRAGMAS.items()
+                                              if database_config.get(key)),
+                   commit_size=database_config.getint('CommitSize', fallback=1),
+                   commit_interval=database_config.getfloat('CommitInterval', fallback=0))
+
+    def _set_sqlite_pragmas(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma, value in self.sqlite_pragmas.items():
+                cursor.execute('PRAGMA {pragma} = {value}'.format(pragma=pragma, value=value))
+        finally:
+            cursor.close()
+
+    @property
+    def use_copy(self) -> bool:
+        return self.dbtype == 'postgresql'
+
     def get_session(self):
         Session = sessionmaker(bind=self.engine)
         return Session()
 
+    def group_commit(self, session) -> GroupCommit:
+        """Write batching of `session` with the CommitSize and CommitInterval of the config"""
+        # pysqlite only begins a transaction before DML, a SAVEPOINT outside of
+        # one would commit on release. IMMEDIATE takes the write lock up front,
+        # so the reads of a batch never go stale under another writer.
+        begin = 'BEGIN IMMEDIATE' if self.dbtype == 'sqlite' else None
+        return GroupCommit(session, self.commit_size, self.commit_interval, begin=begin)
+
     def get_or_create(self, session, model, condition: Dict, values: Dict, auto_commit=True):
         instance = session.query(model).filter_by(**condition).first()
         if instance:
@@ -64,6 +272,33 @@ class PttDatabase:
                 session.flush()
             return instance, True
 
+    def get_or_create_all(self, session, model, key: str, values: List[Dict], auto_commit=True) -> Dict:
+        """Bulk version of `get_or_create`, instances are matched on column `key`.
+
+        Existing rows are fetched with one IN query per chunk and the missing
+        ones are created. Returns a dict of key value -> instance.
+        """
+        column = getattr(model, key)
+        keys = list({v[key] for v in values})
+        instances = {}
+        for i in range(0, len(keys), self.IN_CHUNK_SIZE):
+            chunk = keys[i:i + self.IN_CHUNK_SIZE]
+            for instance in session.query(model).filter(column.in_(chunk)):
+                instances[getattr(instance, key)] = instance
+
+        new_instances = []
+        for v in values:
+            if v[key] not in instances:
+                instance = model(**v)
+                instances[v[key]] = instance
+                new_instances.append(instance)
+        session.add_all(new_instances)
+        if auto_commit:
+            session.commit()
+        else:
+            session.flush()
+        return instances
+
     def create(self, session, model, values: Dict, auto_commit=True):
         instance = model(**values)
         session.add(instance)
@@ -95,6 +330,130 @@ class PttDatabase:
         else:
             session.flush()
 
+    def bulk_upsert(self, session, model, objects: List[Dict], auto_commit=True):
+        """Insert or update mappings by primary key without a SELECT per object"""
+        pk = inspect(model).primary_key[0]
+        objects = list(OrderedDict((o[pk.key], o) for o in objects).values())
+        keys = [o[pk.key] for o in objects]
+        exist_keys = set()
+        for i in range(0, len(keys), self.IN_CHUNK_SIZE):
+            chunk = keys[i:i + self.IN_CHUNK_SIZE]
+            exist_keys.update(key for key, in session.query(pk).filter(pk.in_(chunk)))
+
+        session.bulk_update_mappings(model, [o for o in objects if o[pk.key] in exist_keys])
+        session.bulk_insert_mappings(model, [o for o in objects if o[pk.key] not in exist_keys])
+        if auto_commit:
+            session.commit()
+        else:
+            session.flush()
+
+    def _copy_value(self, column, value) -> str:
+        """`value` of `column` in the COPY text format"""
+        if isinstance(column.type, TypeDecorator):
+            value = column.type.process_bind_param(value, self.engine.dialect)
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return '\\\\x' + bytes(value).hex()
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        return str(value).replace('\\', '\\\\') \
+            .replace('\t', '\\t') \
+            .replace('\n', '\\n') \
+            .replace('\r', '\\r')
+
+    def _copy(self, session, table, table_name: str, objects: List[Dict]):
+        columns = [column for column in table.columns if column.key in objects[0]]
+        buffer = io.StringIO()
+        for o in objects:
+            buffer.write('\t'.join(self._copy_value(column, o.get(column.key)) for column in columns))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        preparer = self.engine.dialect.identifier_preparer
+        statement = 'COPY {table} ({columns}) FROM STDIN'.format(
+            table=table_name,
+            columns=', '.join(preparer.quote(column.name) for column in columns))
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(statement, buffer)
+        finally:
+            cursor.close()
+
+    def _next_ids(self, session, model, count: int) -> Optional[List[int]]:
+        """`count` values of the primary key sequence of `model`, None without one"""
+        pk = inspect(model).primary_key[0]
+        if not isinstance(pk.default, Sequence):
+            return None
+        query = text('SELECT nextval(:sequence) FROM generate_series(1, :count)')
+        return [next_id for next_id, in session.execute(query, {'sequence': pk.default.name,
+                                                                'count': count})]
+
+    def bulk_copy(self, session, model, objects: List[Dict], return_ids=False, auto_commit=True):
+        """Insert mappings, with COPY on PostgreSQL.
+
+        With `return_ids` the generated primary keys are set in `objects`,
+        COPY gets them from the table sequence beforehand.
+        """
+        if objects and self.use_copy:
+            pk = inspect(model).primary_key[0]
+            next_ids = self._next_ids(session, model, len(objects)) if return_ids else None
+            if next_ids:
+                for o, next_id in zip(objects, next_ids):
+                    o[pk.key] = next_id
+            table = model.__table__
+            self._copy(session, table, self.engine.dialect.identifier_preparer.format_table(table), objects)
+        else:
+            session.bulk_insert_mappings(model, objects, return_defaults=return_ids)
+        if auto_commit:
+            session.commit()
+        else:
+            session.flush()
+
+    def bulk_copy_upsert(self, session, model, objects: List[Dict], auto_commit=True):
+        """`bulk_upsert` through a COPY into a temporary table and one
+        `INSERT ... ON CONFLICT` per set of mapped columns on PostgreSQL"""
+        if not objects or not self.use_copy:
+            return self.bulk_upsert(session, model, objects, auto_commit=auto_commit)
+
+        preparer = self.engine.dialect.identifier_preparer
+        table = model.__table__
+        pk_columns = list(table.primary_key.columns)
+
+        # ON CONFLICT can not update a row twice in one statement
+        groups = OrderedDict()
+        for o in objects:
+            key = tuple(o[column.key] for column in pk_columns)
+            groups.setdefault(tuple(sorted(o)), OrderedDict())[key] = o
+
+        for group in groups.values():
+            group = list(group.values())
+            temp_name = preparer.quote('tmp_{table}_{id}'.format(table=table.name, id=uuid.uuid4().hex[:8]))
+            columns = [column for column in table.columns if column.key in group[0]]
+            update_columns = [column for column in columns if column not in pk_columns]
+            action = 'NOTHING'
+            if update_columns:
+                action = 'UPDATE SET ' + ', '.join('{c} = EXCLUDED.{c}'.format(c=preparer.quote(column.name))
+                                                   for column in update_columns)
+
+            session.execute('CREATE TEMPORARY TABLE {temp} (LIKE {table} INCLUDING DEFAULTS)'.format(
+                temp=temp_name, table=preparer.format_table(table)))
+            self._copy(session, table, temp_name, group)
+            session.execute('INSERT INTO {table} ({columns}) SELECT {columns} FROM {temp} '
+                            'ON CONFLICT ({pk}) DO {action}'.format(
+                                table=preparer.format_table(table),
+                                columns=', '.join(preparer.quote(column.name) for column in columns),
+                                temp=temp_name,
+                                pk=', '.join(preparer.quote(column.name) for column in pk_columns),
+                                action=action))
+            session.execute('DROP TABLE {temp}'.format(temp=temp_name))
+        if auto_commit:
+            session.commit()
+        else:
+            session.flush()
+
     def bulk_update(self, session, model, objects, auto_commit=True):
         o_list = []
         for o in objects:
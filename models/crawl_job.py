@@ -0,0 +1,37 @@
+from sqlalchemy import Column, Index, Integer, SmallInteger, String
+
+from . import Base, MyDateTime
+
+
+class CrawlJob(Base):
+    """Article of the distributed work queue of the article crawler --worker.
+
+    It has no foreign key, the queue may live in a database of its own.
+    """
+    __tablename__ = 'crawl_job'
+    __table_args__ = (Index('ix_crawl_job_board_status_lease_until', 'board', 'status', 'lease_until'),)
+
+    PENDING = 0
+    LEASED = 1
+    DONE = 2
+    FAILED = 3
+
+    web_id = Column(String(20),
+                    primary_key=True)
+    board = Column(String(64),
+                   nullable=False)
+    status = Column(SmallInteger,
+                    nullable=False,
+                    default=PENDING)
+    # worker holding the lease, and the token of the claim which took it
+    worker = Column(String(64),
+                    nullable=True)
+    lease_token = Column(String(32),
+                         nullable=True)
+    lease_until = Column(MyDateTime,
+                         nullable=True)
+    attempts = Column(Integer,
+                      nullable=False,
+                      default=0)
+    updated_at = Column(MyDateTime,
+                        nullable=True)
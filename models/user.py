@@ -3,7 +3,7 @@ import datetime
 from sqlalchemy import Column, DateTime, ForeignKey, Integer, Sequence, String
 from sqlalchemy.orm import relationship
 
-from . import Base
+from . import Base, IpAddress
 
 
 class User(Base):
@@ -43,8 +43,9 @@ class UserLastRecord(Base):
                      nullable=False)
     last_login_datetime = Column(DateTime,
                                  nullable=False)
-    last_login_ip = Column(String(40),
-                           nullable=False)
+    last_login_ip = Column(IpAddress,
+                           nullable=True,
+                           index=True)
     created_at = Column(DateTime,
                         nullable=False,
                         default=datetime.datetime.now)
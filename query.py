@@ -9,9 +9,9 @@ from typing import Dict, List
 from pyexcel_ods import save_data
 from sqlalchemy import case, func
 
-from models import (Article, ArticleHistory, Board, IpAsn, PttDatabase, Push,
-                    User, UserLastRecord)
-from utils import load_config, log, valid_date_type
+from models import (Article, ArticleHistory, ArticleHistoryPush, Board, IpAsn,
+                    PttDatabase, Push, User, UserLastRecord)
+from utils import PROFILER, load_config, log, valid_date_type
 
 
 def parse_argument():
@@ -71,8 +71,7 @@ class QueryHelper(object):
         self.output_folder = arguments['output_folder']
         self.output_prefix = arguments['output_prefix']
 
-        self.db = PttDatabase(dbtype=self.config['Database']['Type'],
-                              dbname=self.config['Database']['Name'])
+        self.db = PttDatabase.from_config(self.config['Database'])
         self.db_session = self.db.get_session()
 
     @log()
@@ -105,8 +104,9 @@ class QueryHelper(object):
             article_history_id_list.append(history.id)
 
         push_res = self.db_session.query(Push, tw_ip_label) \
+            .join(ArticleHistoryPush, ArticleHistoryPush.push_id == Push.id) \
             .join(IpAsn, IpAsn.ip == Push.push_ip) \
-            .filter(Push.article_history_id.in_(article_history_id_list)).all()
+            .filter(ArticleHistoryPush.article_history_id.in_(article_history_id_list)).all()
 
         push_tw_ip = sum(1 for _,  tw_ip in push_res
                          if tw_ip == True)
@@ -158,6 +158,7 @@ def main():
     args = parse_argument()
     helper = QueryHelper(args)
     helper.go()
+    PROFILER.log_summary()
 
 
 if __name__ == "__main__":
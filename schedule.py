@@ -30,6 +30,7 @@ class CrawlerModule(Enum):
     article = 2
     asn = 3
     user = 4
+    prune = 5
 
     def __str__(self):
         return self.name
@@ -0,0 +1,91 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from crawler.asn import PttIpAsnEnricher  # noqa: E402
+from crawler.writer import PttDatabaseWriter  # noqa: E402
+from models import Base, IpAsn, PttDatabase  # noqa: E402
+from sqlite_profile import PROFILES, write_config  # noqa: E402
+
+
+class PttIpAsnEnricherTest(unittest.TestCase):
+    """The enricher writes through the crawler writer, outlives database
+    errors and stops within its drain time"""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        config_path = write_config(self.folder.name, PROFILES['tuned'])
+        self.db = PttDatabase('sqlite', dbname=os.path.join(self.folder.name, 'ptt.db'))
+        Base.metadata.create_all(self.db.engine)
+        self.writer = PttDatabaseWriter(self.db)
+        self.enricher = PttIpAsnEnricher(config_path, self.writer, batch_size=10, interval=0.05,
+                                         drain_seconds=0.3)
+        # no network lookups, every ip resolves to one network
+        self.enricher.crawler._resolve_rows = self._resolve_rows
+        self.resolve_seconds = 0
+
+    def tearDown(self):
+        self.writer.close()
+        self.db.engine.dispose()
+        self.folder.cleanup()
+
+    def _resolve_rows(self, executor, ip_list):
+        time.sleep(self.resolve_seconds)
+        return [self.enricher.crawler._build_row(ip, {'asn': '3462',
+                                                      'asn_cidr': '10.0.0.0/8',
+                                                      'asn_country_code': 'TW'}, datetime.now())
+                for ip in ip_list]
+
+    def _stored_ips(self):
+        session = self.db.get_session()
+        try:
+            return {ip for ip, in session.query(IpAsn.ip).filter(IpAsn.asn.isnot(None))}
+        finally:
+            session.close()
+
+    def test_filter_error_does_not_stop_the_thread(self):
+        cache_filter = self.enricher.crawler.cache.filter
+        errors = []
+
+        def locked_once(ip_list):
+            if not errors:
+                errors.append(ip_list)
+                raise OperationalError('SELECT', {}, Exception('database is locked'))
+            return cache_filter(ip_list)
+
+        self.enricher.crawler.cache.filter = locked_once
+        self.enricher.start()
+        self.enricher.enqueue(['10.0.0.{}'.format(i) for i in range(5)])
+        time.sleep(0.3)
+        self.enricher.enqueue(['10.0.1.{}'.format(i) for i in range(5)])
+        self.enricher.close()
+        self.writer.commit()
+
+        self.assertTrue(errors)
+        self.assertEqual(self._stored_ips(), {'10.0.1.{}'.format(i) for i in range(5)})
+
+    def test_close_leaves_the_backlog_after_drain_seconds(self):
+        self.resolve_seconds = 0.1
+        self.enricher.start()
+        self.enricher.enqueue(['10.0.{}.{}'.format(i // 250, i % 250) for i in range(1000)])
+
+        start = time.monotonic()
+        self.enricher.close()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertFalse(self.enricher.queue.empty())
+
+        self.writer.commit()
+        stored = len(self._stored_ips())
+        self.assertGreater(stored, 0)
+        self.assertLess(stored, 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
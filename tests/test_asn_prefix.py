@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+
+from crawler.asn_prefix import PrefixDict, PrefixTable
+
+
+def record(asn: str):
+    return {'asn': asn, 'asn_country_code': 'TW', 'asn_date': '2000-01-01',
+            'asn_description': 'AS{}'.format(asn), 'asn_registry': 'apnic'}
+
+
+# 10.0.0.0/8 holds 10.1.0.0/16, which holds 10.1.2.0/24, and 10.200.0.0/16
+PREFIXES = [('10.1.2.0/24', record('3')),
+            ('10.0.0.0/8', record('1')),
+            ('10.1.0.0/16', record('2')),
+            ('10.200.0.0/16', record('4')),
+            ('192.168.0.0/24', record('5')),
+            ('2001:db8::/32', record('6')),
+            ('not a prefix', record('7'))]
+
+LOOKUPS = [('10.0.0.1', '1', '10.0.0.0/8'),
+           ('10.1.0.255', '2', '10.1.0.0/16'),
+           ('10.1.2.3', '3', '10.1.2.0/24'),
+           ('10.1.3.0', '2', '10.1.0.0/16'),
+           ('10.2.0.0', '1', '10.0.0.0/8'),
+           ('10.200.255.255', '4', '10.200.0.0/16'),
+           ('10.255.255.255', '1', '10.0.0.0/8'),
+           ('192.168.0.42', '5', '192.168.0.0/24')]
+
+
+class PrefixTableTest(unittest.TestCase):
+
+    def _assert_lookups(self, table):
+        for ip, asn, cidr in LOOKUPS:
+            result = table.lookup(ip)
+            self.assertEqual((result['asn'], result['asn_cidr']), (asn, cidr), ip)
+        for ip in ('9.255.255.255', '11.0.0.0', '192.168.1.0', '2001:db8::1', 'not an ip'):
+            self.assertIsNone(table.lookup(ip), ip)
+
+    def test_nested_prefixes_are_flattened(self):
+        table = PrefixTable.from_prefixes(PREFIXES)
+        self._assert_lookups(table)
+        # the /8 in three intervals around its /16s, 10.1.0.0/16 in two around its /24
+        self.assertEqual(len(table), 8)
+        self.assertTrue(all(end < start for end, start in zip(table.ends, table.starts[1:])))
+
+    def test_saved_table_is_loaded_with_mmap(self):
+        table = PrefixTable.from_prefixes(PREFIXES)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'ip_prefix.dat')
+            table.save(path)
+            loaded = PrefixTable.load(path)
+            self.assertEqual(len(loaded), len(table))
+            self.assertEqual(loaded.records, table.records)
+            self._assert_lookups(loaded)
+
+    def test_load_rejects_other_files(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'other.dat')
+            with open(path, 'wb') as other_file:
+                other_file.write(b'x' * 64)
+            with self.assertRaises(ValueError):
+                PrefixTable.load(path)
+
+
+class PrefixDictTest(unittest.TestCase):
+
+    def test_longest_prefix_matches(self):
+        prefixes = PrefixDict()
+        for cidr, prefix_record in PREFIXES:
+            prefixes.add(cidr, prefix_record)
+        self.assertEqual(len(prefixes), 5)
+        for ip, asn, cidr in LOOKUPS:
+            result = prefixes.lookup(ip)
+            self.assertEqual((result['asn'], result['asn_cidr']), (asn, cidr), ip)
+        self.assertIsNone(prefixes.lookup('11.0.0.0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from crawler.article import PttArticleCrawler  # noqa: E402
+from crawler.metrics import ARTICLES, DB_WRITE_ERRORS  # noqa: E402
+from mock_ptt import MockPtt, MockPttServer  # noqa: E402
+from models import Article, Base, Board, CrawlJob, PttDatabase  # noqa: E402
+from sqlite_profile import PROFILES, write_config  # noqa: E402
+
+BOARD = 'tail'
+
+
+class BurstCrawlTest(unittest.TestCase):
+    """Crawls of the mock ptt.cc while it answers bursts of 503"""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.config_path = write_config(self.folder.name, PROFILES['tuned'])
+        self.db = PttDatabase('sqlite', dbname=os.path.join(self.folder.name, 'ptt.db'))
+        Base.metadata.create_all(self.db.engine)
+        self.session = self.db.get_session()
+
+        self.site = MockPtt(pages=2, hot_every=0, pushes=3)
+        self.server = MockPttServer(self.site).__enter__()
+        self.ptt_url = PttArticleCrawler.PTT_URL
+        PttArticleCrawler.PTT_URL = self.server.url
+
+    def tearDown(self):
+        PttArticleCrawler.PTT_URL = self.ptt_url
+        self.server.close()
+        self.session.close()
+        self.db.engine.dispose()
+        self.folder.cleanup()
+
+    def _crawl(self, **mode):
+        arguments = {'config_path': self.config_path,
+                     'board_name': BOARD,
+                     'start_date': None,
+                     'since_date': None,
+                     'database': False,
+                     'tail': False,
+                     'worker': False,
+                     'enqueue': False,
+                     'index': None,
+                     'upgrade': False,
+                     'hot': False,
+                     'json_folder': self.folder.name,
+                     'json_prefix': '',
+                     'verbose': False}
+        arguments.update(mode)
+        crawler = PttArticleCrawler(arguments)
+        crawler.crawling()
+        crawler.db_session.close()
+        crawler.db.engine.dispose()
+        self.session.expire_all()
+
+    def _page_web_ids(self, page: int):
+        return {self.site.web_id(page, i) for i in range(20)}
+
+    def _crawled_web_ids(self):
+        return {web_id for web_id, in self.session.query(Article.web_id)}
+
+    def test_error_responses_are_not_written(self):
+        self.server.burst_every = 5
+        self.server.burst_length = 2
+        invalid = ARTICLES.value(result='invalid')
+        write_errors = DB_WRITE_ERRORS.value(writer='article')
+        self._crawl(index=[1, 2])
+
+        self.assertEqual(ARTICLES.value(result='invalid') - invalid, self.server.errors)
+        self.assertEqual(DB_WRITE_ERRORS.value(writer='article'), write_errors)
+        self.assertEqual(len(self._crawled_web_ids()), 40 - self.server.errors)
+
+    def test_tail_queues_failed_articles_for_workers(self):
+        self._crawl(tail=True)
+        self.assertEqual(self._crawled_web_ids(), self._page_web_ids(2))
+
+        # a page of new articles, crawled during a burst of 503 responses
+        self.site.pages = 3
+        self.server.burst_every = 5
+        self.server.burst_length = 2
+        self._crawl(tail=True)
+        self.assertGreater(self.server.errors, 0)
+
+        board = self.session.query(Board).filter_by(name=BOARD).one()
+        self.assertEqual(board.tail_index, 3)
+        self.assertEqual(board.tail_web_id, self.site.web_id(3, 19))
+        failed_web_ids = self._page_web_ids(3) - self._crawled_web_ids()
+        self.assertEqual(len(failed_web_ids), self.server.errors)
+        self.assertEqual({web_id for web_id, in self.session.query(CrawlJob.web_id)
+                          .filter(CrawlJob.status == CrawlJob.PENDING)}, failed_web_ids)
+
+        self.server.burst_every = 0
+        self._crawl(worker=True)
+        self.assertEqual(self._crawled_web_ids(), self._page_web_ids(2) | self._page_web_ids(3))
+        self.assertEqual({status for status, in self.session.query(CrawlJob.status)}, {CrawlJob.DONE})
+
+
+if __name__ == '__main__':
+    unittest.main()
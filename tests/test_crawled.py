@@ -0,0 +1,86 @@
+import unittest
+
+from crawler.crawled import BloomFilter, CrawledWebIds
+from models import Article, ArticleIndex, Base, Board, PttDatabase, User
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_added_items_are_found(self):
+        bloom = BloomFilter(1000)
+        items = ['M.{}.A.000'.format(1546300800 + i) for i in range(1000)]
+        for item in items:
+            bloom.add(item)
+        self.assertTrue(all(item in bloom for item in items))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('M.{}.A.000'.format(1546300800 + i))
+        false_positives = sum('G.{}.A.000'.format(1546300800 + i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class CrawledWebIdsTest(unittest.TestCase):
+    """Skip decisions of --add on an in-memory SQLite database"""
+
+    def setUp(self):
+        self.db = PttDatabase('sqlite')
+        Base.metadata.create_all(self.db.engine)
+        self.session = self.db.get_session()
+        self.board = Board(name='crawled')
+        self.user = User(username='author')
+        self.session.add_all([self.board, self.user])
+        self.session.flush()
+        # pages 1 to 3 of 3 articles, the first 7 are crawled
+        self.web_ids = ['M.{}.A.000'.format(1546300800 + i) for i in range(9)]
+        for i, web_id in enumerate(self.web_ids):
+            self.session.add(ArticleIndex(web_id=web_id, board_id=self.board.id, index=i // 3 + 1))
+        self._add_articles(self.web_ids[:7])
+
+    def tearDown(self):
+        self.session.close()
+        self.db.engine.dispose()
+
+    def _add_articles(self, web_ids):
+        for web_id in web_ids:
+            self.session.add(Article(web_id=web_id, user_id=self.user.id, board_id=self.board.id))
+        self.session.commit()
+
+    def _crawled(self, set_limit: int) -> CrawledWebIds:
+        crawled = CrawledWebIds(self.db, self.session, self.board.id, set_limit=set_limit)
+        crawled.refresh()
+        return crawled
+
+    def test_set_answers_missing_web_ids(self):
+        crawled = self._crawled(set_limit=100)
+        self.assertTrue(crawled.is_exact)
+        self.assertEqual(crawled.missing(list(reversed(self.web_ids))), self.web_ids[8:6:-1])
+
+    def test_refresh_and_add_keep_up_with_new_articles(self):
+        crawled = self._crawled(set_limit=100)
+        self._add_articles(self.web_ids[7:8])
+        crawled.refresh()
+        self.assertEqual(crawled.missing(self.web_ids), self.web_ids[8:])
+        crawled.add(self.web_ids[8:])
+        self.assertEqual(crawled.missing(self.web_ids), [])
+
+    def test_bloom_positives_are_confirmed(self):
+        crawled = self._crawled(set_limit=1)
+        self.assertFalse(crawled.is_exact)
+        self.assertEqual(crawled.missing(self.web_ids), self.web_ids[7:])
+
+        # positives of the filter which are not stored, as a false positive would be
+        crawled.add(self.web_ids[7:])
+        self.assertEqual(crawled.missing(self.web_ids), self.web_ids[7:])
+
+    def test_crawled_pages_skip_the_last_page(self):
+        crawled = self._crawled(set_limit=100)
+        self.assertEqual(crawled.crawled_pages(), {1, 2})
+
+        self._add_articles(self.web_ids[7:])
+        self.assertEqual(crawled.crawled_pages(), {1, 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
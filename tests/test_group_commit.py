@@ -0,0 +1,98 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+from crawler.article import PttArticleCrawler
+from crawler.writer import PttDatabaseWriter
+from models import Base, Board, PttDatabase
+
+
+class GroupCommitLockTest(unittest.TestCase):
+    """A batch must not keep the SQLite write lock from other connections"""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'ptt.db')
+        self.db = PttDatabase('sqlite', dbname=self.path,
+                              sqlite_pragmas={'journal_mode': 'WAL'},
+                              commit_size=100, commit_interval=1000)
+        Base.metadata.create_all(self.db.engine)
+        self.session = self.db.get_session()
+        self.group_commit = self.db.group_commit(self.session)
+
+    def tearDown(self):
+        self.session.close()
+        self.db.engine.dispose()
+        self.folder.cleanup()
+
+    def _other_connection_writes(self) -> bool:
+        connection = sqlite3.connect(self.path, timeout=0.1)
+        try:
+            connection.execute("INSERT INTO board (name) VALUES ('other')")
+            connection.commit()
+            return True
+        except sqlite3.OperationalError:
+            return False
+        finally:
+            connection.close()
+
+    def _add_board(self, name: str):
+        self.session.add(Board(name=name))
+        self.session.flush()
+
+    def test_zero_count_record_releases_lock(self):
+        with self.group_commit.record(count=0):
+            self._add_board('index')
+        self.assertTrue(self._other_connection_writes())
+
+    def test_open_batch_commits_after_interval(self):
+        with self.group_commit.record():
+            self._add_board('article')
+        with self.group_commit.record(count=0):
+            self._add_board('index')
+        self.assertFalse(self._other_connection_writes())
+
+        time.sleep(1.1)
+        # what the writer thread runs while its queue is idle
+        self.group_commit.commit_due()
+        self.assertTrue(self._other_connection_writes())
+        self.assertEqual(self.session.query(Board).count(), 3)
+
+    def test_idle_writer_commits_open_batch(self):
+        writer = PttDatabaseWriter(self.db)
+        writer.IDLE_TIMEOUT = 0.1
+
+        def write_index(name: str):
+            with writer.group_commit.record():
+                writer.session.add(Board(name=name))
+            with writer.group_commit.record(count=0):
+                writer.session.add(Board(name=name + ' index'))
+
+        writer.put(write_index, 'article')
+        writer.flush()
+        self.assertFalse(self._other_connection_writes())
+        time.sleep(1.3)
+        self.assertTrue(self._other_connection_writes())
+        writer.close()
+
+    def test_tail_without_new_articles_releases_lock(self):
+        self._add_board('tail')
+        self.session.commit()
+        crawler = SimpleNamespace(group_commit=self.group_commit, write_session=self.session)
+        PttArticleCrawler._output_tail(crawler, 1, 10, 'M.1546300800.A.000')
+        self.assertTrue(self._other_connection_writes())
+        self.assertEqual(self.session.query(Board).get(1).tail_index, 10)
+
+    def test_failed_first_record_releases_lock(self):
+        with self.assertRaises(RuntimeError):
+            with self.group_commit.record():
+                self._add_board('failed')
+                raise RuntimeError('parse error')
+        self.assertTrue(self._other_connection_writes())
+
+
+if __name__ == '__main__':
+    unittest.main()
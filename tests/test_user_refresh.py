@@ -0,0 +1,25 @@
+import time
+import unittest
+from types import SimpleNamespace
+
+from crawler.user import PttUserCrawler
+
+
+class RefreshTimeBudgetTest(unittest.TestCase):
+    """RefreshTimeBudget applies to the --database refresh queue only"""
+
+    def _is_exceeded(self, db_input: bool, budget_minutes: float, elapsed_minutes: float) -> bool:
+        crawler = SimpleNamespace(db_input=db_input, refresh_time_budget=budget_minutes)
+        return PttUserCrawler._is_time_budget_exceeded(crawler, time.time() - elapsed_minutes * 60)
+
+    def test_refresh_queue_stops_after_the_budget(self):
+        self.assertFalse(self._is_exceeded(True, 60, 30))
+        self.assertTrue(self._is_exceeded(True, 60, 61))
+        self.assertFalse(self._is_exceeded(True, 0, 600))
+
+    def test_id_list_is_crawled_whole(self):
+        self.assertFalse(self._is_exceeded(False, 60, 61))
+
+
+if __name__ == '__main__':
+    unittest.main()
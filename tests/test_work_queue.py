@@ -0,0 +1,128 @@
+import time
+import unittest
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from crawler.work_queue import CrawlWorkQueue
+from models import CrawlJob, PttDatabase
+
+BOARD = 'queue'
+
+
+class CrawlWorkQueueTest(unittest.TestCase):
+    """Leases of the work queue on an in-memory SQLite database"""
+
+    def setUp(self):
+        self.db = PttDatabase('sqlite')
+        CrawlJob.__table__.create(self.db.engine)
+        self.web_ids = ['M.15463008{:02d}.A.000'.format(i) for i in range(10)]
+
+    def tearDown(self):
+        self.db.engine.dispose()
+
+    def _queue(self, worker_id: str, **options) -> CrawlWorkQueue:
+        return CrawlWorkQueue(self.db, worker_id=worker_id, **options)
+
+    def _jobs(self):
+        """web_id -> (status, worker, attempts)"""
+        table = CrawlJob.__table__
+        with self.db.engine.connect() as connection:
+            return {web_id: (status, worker, attempts) for web_id, status, worker, attempts in
+                    connection.execute(select([table.c.web_id, table.c.status,
+                                               table.c.worker, table.c.attempts]))}
+
+    def test_enqueue_adds_new_jobs_once(self):
+        queue = self._queue('a')
+        self.assertEqual(queue.enqueue(BOARD, self.web_ids[:6]), 6)
+        self.assertEqual(queue.enqueue(BOARD, self.web_ids + self.web_ids[:2]), 4)
+        self.assertEqual(queue.counts(BOARD), {CrawlJob.PENDING: 10})
+
+    def test_enqueue_reset_queues_finished_jobs_again(self):
+        queue = self._queue('a', max_attempts=1)
+        queue.enqueue(BOARD, self.web_ids[:4])
+        queue.complete(queue.claim(BOARD, 2))
+        queue.fail(queue.claim(BOARD, 1))
+        self.assertEqual(queue.counts(BOARD), {CrawlJob.PENDING: 1, CrawlJob.DONE: 2, CrawlJob.FAILED: 1})
+
+        self.assertEqual(queue.enqueue(BOARD, self.web_ids[:4], reset=True), 3)
+        self.assertEqual(queue.counts(BOARD), {CrawlJob.PENDING: 4})
+        self.assertEqual({attempts for _, _, attempts in self._jobs().values()}, {0})
+
+    def test_claims_of_workers_do_not_overlap(self):
+        a, b = self._queue('a'), self._queue('b')
+        a.enqueue(BOARD, self.web_ids)
+        a.enqueue('other', ['M.1546300900.A.000'])
+
+        claimed_a = a.claim(BOARD, 4)
+        claimed_b = b.claim(BOARD, 4)
+        self.assertEqual(claimed_a, self.web_ids[:4])
+        self.assertEqual(claimed_b, self.web_ids[4:8])
+        self.assertEqual(a.claim(BOARD, 4) + b.claim(BOARD, 4), self.web_ids[8:])
+        self.assertEqual(a.claim(BOARD, 4), [])
+
+        jobs = self._jobs()
+        self.assertEqual({jobs[web_id][1] for web_id in claimed_b}, {'b'})
+        self.assertEqual(jobs['M.1546300900.A.000'][0], CrawlJob.PENDING)
+        self.assertTrue(a.has_leased(BOARD))
+
+    def test_heartbeat_keeps_the_lease(self):
+        a, b = self._queue('a', lease_seconds=0.2), self._queue('b', lease_seconds=0.2)
+        a.enqueue(BOARD, self.web_ids[:2])
+        a.claim(BOARD, 2)
+        for _ in range(3):
+            time.sleep(0.1)
+            a.heartbeat(force=True)
+        self.assertEqual(b.claim(BOARD, 2), [])
+
+    def test_expired_lease_is_claimed_again(self):
+        a, b = self._queue('a', lease_seconds=0.05), self._queue('b')
+        a.enqueue(BOARD, self.web_ids[:2])
+        self.assertEqual(a.claim(BOARD, 2), self.web_ids[:2])
+        time.sleep(0.1)
+
+        self.assertEqual(b.claim(BOARD, 2), self.web_ids[:2])
+        self.assertEqual(self._jobs()[self.web_ids[0]], (CrawlJob.LEASED, 'b', 2))
+        # the jobs of the late worker are no longer its own to fail
+        a.fail(self.web_ids[:2])
+        self.assertEqual(self._jobs()[self.web_ids[0]], (CrawlJob.LEASED, 'b', 2))
+
+    def test_attempts_are_exhausted(self):
+        queue = self._queue('a', lease_seconds=0.05, max_attempts=2)
+        queue.enqueue(BOARD, self.web_ids[:2])
+
+        queue.fail(queue.claim(BOARD, 1))
+        self.assertEqual(self._jobs()[self.web_ids[0]], (CrawlJob.PENDING, 'a', 1))
+        self.assertEqual(queue.claim(BOARD, 1), self.web_ids[:1])
+        queue.fail(self.web_ids[:1])
+        self.assertEqual(self._jobs()[self.web_ids[0]][0], CrawlJob.FAILED)
+
+        # a lease lost on the last attempt fails once it expires
+        self.assertEqual(queue.claim(BOARD, 1), self.web_ids[1:2])
+        self.assertEqual(queue.claim(BOARD, 1), [])
+        time.sleep(0.1)
+        self.assertEqual(queue.claim(BOARD, 1), self.web_ids[1:2])
+        time.sleep(0.1)
+        self.assertEqual(queue.claim(BOARD, 1), [])
+        self.assertEqual(queue.counts(BOARD), {CrawlJob.FAILED: 2})
+        self.assertFalse(queue.has_leased(BOARD))
+
+    def test_complete_releases_the_leases(self):
+        queue = self._queue('a')
+        queue.enqueue(BOARD, self.web_ids[:3])
+        queue.complete(queue.claim(BOARD, 3))
+        self.assertEqual(queue.counts(BOARD), {CrawlJob.DONE: 3})
+        self.assertFalse(queue.has_leased(BOARD))
+        self.assertEqual(queue._leased, set())
+
+    def test_postgresql_claim_skips_locked_rows(self):
+        queue = self._queue('a')
+        statement = str(queue._claim_statement(BOARD, 5, datetime.now())
+                        .compile(dialect=postgresql.dialect()))
+        self.assertIn('FOR UPDATE SKIP LOCKED', statement)
+        self.assertIn('RETURNING crawl_job.web_id', statement)
+
+
+if __name__ == '__main__':
+    unittest.main()
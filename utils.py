@@ -1,9 +1,20 @@
 import argparse
 import configparser
+import cProfile
+import functools
 import inspect
 import logging
-from datetime import datetime
-from typing import Dict, List
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+# Dates shown on ptt.cc are Taiwan time
+PTT_TIMEZONE = timezone(timedelta(hours=8))
 
 
 def _get_class_that_defined_method(meth):
@@ -21,19 +32,147 @@ def _get_class_that_defined_method(meth):
     return getattr(meth, '__objclass__', None)
 
 
+class StageProfiler(object):
+    """Wall and CPU time of the stages wrapped by `log`, aggregated per stage.
+
+    CPU time is the time of the calling thread. Stages named in
+    `profile_stages` are profiled every `sample_every` calls: with cProfile,
+    whose stats are merged per stage and saved to `profile_folder`, and with
+    tracemalloc, whose peak is process wide when other threads allocate at the
+    same time. A sampled call is not sampled again by the stages it calls.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {}
+        self.profile_stages = set()
+        self.sample_every = 1
+        self.profile_folder = ''
+        self.trace_memory = False
+        self._profiles = {}
+
+    def configure(self, profile_stages: Set[str] = (), sample_every: int = 1, profile_folder: str = '',
+                  trace_memory: bool = False):
+        self.profile_stages = set(profile_stages)
+        self.sample_every = max(sample_every, 1)
+        self.profile_folder = profile_folder
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def configure_from_config(self, config: configparser.ConfigParser):
+        """Profiling of the `[Profile]` section"""
+        stages = config.get('Profile', 'Stages', fallback='')
+        self.configure(profile_stages={stage.strip() for stage in stages.split(',') if stage.strip()},
+                       sample_every=config.getint('Profile', 'SampleEvery', fallback=1),
+                       profile_folder=config.get('Profile', 'Folder', fallback=''),
+                       trace_memory=config.getboolean('Profile', 'Tracemalloc', fallback=False))
+
+    def _stage(self, name: str) -> List:
+        stage = self.stats.get(name)
+        if stage is None:
+            with self._lock:
+                # calls, wall, cpu, max wall, sampled calls, peak memory
+                stage = self.stats.setdefault(name, [0, 0.0, 0.0, 0.0, 0, 0])
+        return stage
+
+    def record(self, name: str, wall: float, cpu: float):
+        stage = self._stage(name)
+        with self._lock:
+            stage[0] += 1
+            stage[1] += wall
+            stage[2] += cpu
+            stage[3] = max(stage[3], wall)
+
+    def should_sample(self, name: str) -> bool:
+        if name not in self.profile_stages or getattr(self._local, 'sampling', False):
+            return False
+        return self._stage(name)[0] % self.sample_every == 0
+
+    def sample(self, name: str, func, *args, **kwargs):
+        """Call `func` under cProfile and tracemalloc"""
+        self._local.sampling = True
+        profile = cProfile.Profile()
+        if self.trace_memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # Python < 3.9 resets the peak along with the traces of the older blocks
+                tracemalloc.clear_traces()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._local.sampling = False
+            peak = tracemalloc.get_traced_memory()[1] - start_memory if self.trace_memory else 0
+            with self._lock:
+                stage = self._stage(name)
+                stage[4] += 1
+                stage[5] = max(stage[5], peak)
+                if name in self._profiles:
+                    self._profiles[name].add(profile)
+                else:
+                    self._profiles[name] = pstats.Stats(profile)
+
+    def summary(self) -> List[str]:
+        with self._lock:
+            stats = sorted(((name, list(stage)) for name, stage in self.stats.items()),
+                           key=lambda item: item[1][1], reverse=True)
+        lines = ['{:<48} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'Stage', 'Calls', 'Wall (s)', 'CPU (s)', 'Mean (ms)', 'Max (ms)', 'Peak (KiB)')]
+        for name, (calls, wall, cpu, max_wall, sampled, peak) in stats:
+            lines.append('{:<48} {:>8d} {:>10.3f} {:>10.3f} {:>10.1f} {:>10.1f} {:>10}'.format(
+                name, calls, wall, cpu, wall / calls * 1000 if calls else 0, max_wall * 1000,
+                peak // 1024 if sampled and self.trace_memory else '-'))
+        return lines
+
+    def log_summary(self):
+        """Log the time breakdown of the stages and save the cProfile stats"""
+        if not self.stats:
+            return
+        logging.info('Stage times:\n%s', '\n'.join(self.summary()))
+        if self.profile_folder:
+            os.makedirs(self.profile_folder, exist_ok=True)
+            with self._lock:
+                profiles = list(self._profiles.items())
+            for name, stats in profiles:
+                path = os.path.join(self.profile_folder, re.sub(r'[^\w.-]', '_', name) + '.prof')
+                stats.dump_stats(path)
+                logging.info('Stage %s profile saved, path = %s', name, path)
+
+
+PROFILER = StageProfiler()
+
+
 def log(func_alias: str = None):
     def decorator(func):
+        func_name = None
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            func_name = '{cls}.{func}'.format(cls=_get_class_that_defined_method(func).__name__,
-                                              func=(func_alias or func.__name__))
+            nonlocal func_name
+            # The class does not exist yet when its methods are decorated
+            if func_name is None:
+                func_name = '{cls}.{func}'.format(cls=_get_class_that_defined_method(func).__name__,
+                                                  func=(func_alias or func.__name__))
             logging.info('Start: %s', func_name)
+            start_wall = time.perf_counter()
+            start_cpu = time.thread_time()
             try:
-                result = func(*args, **kwargs)
+                if PROFILER.should_sample(func_name):
+                    result = PROFILER.sample(func_name, func, *args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
                 logging.info('Finished: %s', func_name)
                 return result
             except Exception as e:
                 logging.info('Aborted: %s', func_name)
                 logging.exception('There was an exception in %s', func_name)
+            finally:
+                PROFILER.record(func_name,
+                                time.perf_counter() - start_wall,
+                                time.thread_time() - start_cpu)
         return wrapper
     return decorator
 
@@ -56,6 +195,38 @@ def valid_date_type(arg_date_str):
         raise argparse.ArgumentTypeError(msg)
 
 
+def web_id_timestamp(web_id: str) -> Optional[int]:
+    """Post epoch encoded in a web_id like M.1127742013.A.240"""
+    match = re.match(r'[MG]\.(\d+)\.A(\.[0-9A-F]{3})?$', web_id or '')
+    if not match:
+        return None
+    return int(match.group(1))
+
+
+def web_id_datetime(web_id: str) -> Optional[datetime]:
+    """Post datetime (Taiwan time) encoded in a web_id like M.1127742013.A.240"""
+    timestamp = web_id_timestamp(web_id)
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, PTT_TIMEZONE).replace(tzinfo=None)
+
+
+def web_id_ranges(date: datetime) -> List[Tuple[str, str]]:
+    """Text ranges of the M. and G. web_ids posted from `date` (Taiwan time).
+
+    Web ids compare as text in posting order only between epochs of as many
+    digits. The ranges are exact for the 10 digit epochs, from 2001-09-09,
+    older web ids fall in them and are told apart by `web_id_timestamp`.
+    No ranges from a date before them, every web id may be newer.
+    """
+    timestamp = int(date.replace(tzinfo=PTT_TIMEZONE).timestamp())
+    if len(str(timestamp)) != 10:
+        return []
+    # '/' sorts right after '.'
+    return [('{prefix}.{timestamp}'.format(prefix=prefix, timestamp=timestamp), prefix + '/')
+            for prefix in 'GM']
+
+
 def load_config(config_path: str = 'config.ini') -> configparser.ConfigParser:
     config = configparser.ConfigParser()
     config.read(config_path)